@@ -40,7 +40,11 @@ if (length(args) == 4) {
 }
 
 
-data <- read.csv(file=filename)
+if (filename == "-") {
+	data <- read.csv(file=file("stdin"))
+} else {
+	data <- read.csv(file=filename)
+}
 
 data$annotator <- factor(data$annotator)
 data$document <- factor(data$document)
@@ -0,0 +1,129 @@
+suppressMessages({
+	library(ordinal)
+	library(car)
+	library(emmeans)
+})
+
+# Long running counterpart of analyse-ordinal.r, see summaryanalysis/rpool.py
+# for the protocol. Packages are loaded once, afterwards the worker fits one
+# data frame per request until the connection is closed.
+
+args <- commandArgs(trailingOnly = TRUE)
+port <- as.integer(args[1])
+
+con <- socketConnection(host="127.0.0.1", port=port, blocking=TRUE, open="r+b", timeout=86400)
+
+read_exactly <- function(n) {
+	chunks <- list()
+	remaining <- n
+	while (remaining > 0) {
+		chunk <- readBin(con, "raw", n=remaining)
+		if (length(chunk) == 0) {
+			stop("connection closed")
+		}
+		chunks[[length(chunks) + 1]] <- chunk
+		remaining <- remaining - length(chunk)
+	}
+	do.call(c, chunks)
+}
+
+read_frame <- function() {
+	len <- readBin(read_exactly(4), "integer", n=1, size=4, endian="little")
+	if (len == 0) {
+		return(raw(0))
+	}
+	read_exactly(len)
+}
+
+write_frame <- function(text) {
+	body <- charToRaw(enc2utf8(text))
+	writeBin(length(body), con, size=4, endian="little")
+	writeBin(body, con)
+	flush(con)
+}
+
+analyse <- function(data, score_name, mode) {
+	mode_info <- unlist(strsplit(mode, ":"))
+
+	is_crossed <- mode_info[1] == "crossed"
+	adjust <- "tukey"
+	if (length(mode_info) > 1) {
+		adjust <- mode_info[2]
+	}
+
+	scores <- data$score
+	if (score_name == "rank") {
+		scores <- -scores
+	}
+	data$score <- factor(scores)
+
+	if (is_crossed) {
+		model <- clmm(score ~ system + (system|annotator) + (system|document), data=data)
+	} else {
+		model <- clmm(score ~ system + (system|annotator), data=data)
+	}
+
+	marginal <- emmeans(model, "system")
+	marginal <- pairs(marginal, infer=c(TRUE, TRUE), adjust=adjust)
+	marginal <- as.data.frame(marginal)
+
+	lines <- character(nrow(marginal))
+	for (idx in 1:nrow(marginal)) {
+		sign <- "o"
+		if (marginal[idx, "p.value"] < 0.05) {
+			sign <- "+"
+			if (marginal[idx, "estimate"] < 0.0) {
+				sign <- "-"
+			}
+		}
+		lines[idx] <- paste(unlist(marginal[idx, "contrast"])[1], sign, format(marginal[idx, "p.value"], digits=7), sep="\t")
+	}
+	lines
+}
+
+repeat {
+	header <- tryCatch(read_frame(), error=function(e) NULL)
+	if (is.null(header)) {
+		break
+	}
+	fields <- unlist(strsplit(rawToChar(header), "\t", fixed=TRUE))
+	command <- fields[1]
+
+	if (command == "quit") {
+		break
+	}
+
+	if (command == "ping") {
+		write_frame("ok\npong")
+		next
+	}
+
+	# fit <score_name> <mode> <rows> <system names...>, followed by a frame
+	# with int32 annotator, document and system codes and float64 scores
+	score_name <- fields[2]
+	mode <- fields[3]
+	n_rows <- as.integer(fields[4])
+	system_names <- fields[5:length(fields)]
+
+	payload <- read_frame()
+
+	response <- tryCatch({
+		columns <- readBin(payload, "integer", n=3 * n_rows, size=4, endian="little")
+		scores <- readBin(payload[(12 * n_rows + 1):length(payload)], "double", n=n_rows, size=8, endian="little")
+
+		data <- data.frame(
+			annotator=factor(columns[1:n_rows]),
+			document=factor(columns[(n_rows + 1):(2 * n_rows)]),
+			system=factor(system_names[columns[(2 * n_rows + 1):(3 * n_rows)] + 1]),
+			score=scores
+		)
+
+		paste(c("ok", analyse(data, score_name, mode)), collapse="\n")
+	}, error=function(e) {
+		paste("error", conditionMessage(e), sep="\t")
+	})
+
+	write_frame(response)
+}
+
+close(con)
@@ -0,0 +1,104 @@
+import argparse
+import re
+import runpy
+import subprocess
+import sys
+from collections import defaultdict
+
+
+# Entry point for python -m summaryanalysis <command> [args]. A command only
+# imports its own module when it is run, so that --help and the light
+# commands start without loading pandas, scipy or matplotlib.
+#
+# python -m summaryanalysis imports <command> reports where the import time
+# of a command goes, grouped by top level package.
+
+
+COMMANDS = {
+    "design-power": "design_power",
+    "sweep": "sweep",
+    "crn": "crn",
+    "power": "power",
+    "pseudopower": "pseudopower",
+    "analyticpower": "analyticpower",
+    "fasttests": "fasttests",
+    "budgetsearch": "budgetsearch",
+    "powerstore": "powerstore",
+    "annotationstore": "annotationstore",
+    "sample": "ordinal",
+    "plot": "plot_power_curvey",
+    "benchmark": "benchmark",
+    "stubanalyzer": "stubanalyzer",
+    "stubworker": "stubworker"
+}
+
+
+def run_command(command, args):
+    module = f"{__package__}.{COMMANDS[command]}"
+    sys.argv = [sys.argv[0]] + list(args)
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+def import_times(module):
+    # Self time in seconds of every module imported by module, from a fresh
+    # interpreter with -X importtime
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE, encoding="utf8", check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match is not None:
+            times[match.group(4)] = int(match.group(1)) / 1e6
+    return times
+
+
+def import_breakdown(times, package=None):
+    # Modules of this package are listed one by one, everything else by its
+    # top level package
+    package = package or __package__
+    totals = defaultdict(float)
+    for module, seconds in times.items():
+        if module.split(".")[0] == package:
+            totals[module] += seconds
+        else:
+            totals[module.split(".")[0]] += seconds
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def print_import_breakdown(command, limit=15):
+    times = import_times(f"{__package__}.{COMMANDS[command]}")
+    breakdown = import_breakdown(times)
+    for name, seconds in breakdown[:limit]:
+        print(f"{name:<40} {seconds * 1000:8.1f} ms")
+    if len(breakdown) > limit:
+        print(f"{f'{len(breakdown) - limit} others':<40} {sum(s for _, s in breakdown[limit:]) * 1000:8.1f} ms")
+    print(f"{'total':<40} {sum(times.values()) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        run_command(sys.argv[1], sys.argv[2:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(prog="python -m summaryanalysis", description="commands: " + ", ".join(COMMANDS) + ", run with <command> --help for their arguments")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("list")
+
+    imports_parser = subparsers.add_parser("imports")
+    imports_parser.add_argument("commands", nargs="+", choices=sorted(COMMANDS), metavar="command")
+    imports_parser.add_argument("-n", dest="limit", default=15, type=int)
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for command, module in COMMANDS.items():
+            print(f"{command:<16} {__package__}.{module}")
+    else:
+        for idx, command in enumerate(args.commands):
+            if idx > 0:
+                print()
+            print(f"{command}:")
+            print_import_breakdown(command, args.limit)
@@ -0,0 +1,224 @@
+import argparse
+import itertools as it
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.special
+import scipy.stats
+
+from . import ordinal
+from .design import as_design
+
+
+# Approximate power of the pairwise system contrasts of a design without
+# simulating. Every judgement is replaced by a normal observation of its
+# linear predictor on the latent scale, with the variance given by the
+# inverse Fisher information of the ordinal likelihood about the location
+# (averaged over the random effects with Gauss-Hermite quadrature). The
+# covariance of the coefficients is then that of the generalized least
+# squares estimate under the annotator and document random effects of the
+# model, with a common intercept standing in for a shift of all thresholds.
+# p-values are those of a normal test without adjustment, like the ":none"
+# modes of the regression backends.
+
+
+QUADRATURE_POINTS = 20
+
+
+def location_information(thresholds, locations):
+    # Fisher information of one ordinal judgement about its linear
+    # predictor, for every value in locations
+    locations = np.asarray(locations, dtype=float)
+    cumulative = scipy.special.expit(np.asarray(thresholds) - locations[..., np.newaxis])
+    cumulative = np.concatenate([np.zeros(locations.shape + (1,)), cumulative, np.ones(locations.shape + (1,))], axis=-1)
+    densities = cumulative * (1 - cumulative)
+
+    probabilities = np.diff(cumulative, axis=-1)
+    derivatives = -np.diff(densities, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(probabilities > 0, derivatives ** 2 / probabilities, 0.)
+    return terms.sum(axis=-1)
+
+
+def slope_coding(n_systems):
+    coding = np.eye(n_systems)
+    coding[0, :] = 1.
+    return coding
+
+
+def system_weights(model):
+    # Expected information per judgement of every system, averaged over the
+    # marginal distribution of its random effects
+    coding = slope_coding(len(model.systems))
+    covariance = coding.T @ model.annotator_covariance_matrix @ coding
+    if model.document_covariance_matrix is not None:
+        covariance += coding.T @ model.document_covariance_matrix @ coding
+    scales = np.sqrt(np.clip(np.diag(covariance), 0., None))
+
+    nodes, weights = np.polynomial.hermite_e.hermegauss(QUADRATURE_POINTS)
+    weights /= weights.sum()
+    locations = model.coefficients[:, np.newaxis] + scales[:, np.newaxis] * nodes
+    return location_information(model.thresholds, locations) @ weights
+
+
+def random_effect_matrix(factor, ids, n_ids, n_systems):
+    # Maps standard normal random effects (n_ids * n_systems) to the latent
+    # offsets of all judgements, ordered by system and then by observation
+    loadings = factor.T @ slope_coding(n_systems)
+    n_observations = len(ids)
+    rows = np.repeat(np.arange(n_systems * n_observations), n_systems)
+    systems = np.repeat(np.arange(n_systems), n_observations)
+    columns = (np.tile(ids, n_systems)[:, np.newaxis] * n_systems + np.arange(n_systems)).ravel()
+    values = loadings[:, systems].T.ravel()
+    return scipy.sparse.csr_matrix((values, (rows, columns)), shape=(n_systems * n_observations, n_ids * n_systems))
+
+
+def block_information(model, weights, annotators, documents):
+    # Information about the intercept and the non-reference systems from the
+    # judgements of one block, annotators and documents numbered from 0
+    n_systems = len(model.systems)
+    n = len(annotators)
+
+    effects = [random_effect_matrix(model.annotator_factor, annotators, annotators.max() + 1, n_systems)]
+    if model.document_factor is not None:
+        effects.append(random_effect_matrix(model.document_factor, documents, documents.max() + 1, n_systems))
+    z = scipy.sparse.hstack(effects).tocsr()
+
+    # Intercept and one indicator per non-reference system
+    x = np.zeros((n_systems * n, n_systems))
+    x[:, 0] = 1.
+    x[n:, 1:] = np.repeat(np.eye(n_systems)[1:, 1:], n, axis=0)
+
+    # V = Z Z' + W^-1, inverted with the Woodbury identity
+    w = np.repeat(weights, n)
+    wz = z.multiply(w[:, np.newaxis]).tocsr()
+    inner = np.eye(z.shape[1]) + (z.T @ wz).toarray()
+    zwx = wz.T @ x
+    return x.T @ (w[:, np.newaxis] * x) - zwx.T @ np.linalg.solve(inner, zwx)
+
+
+def coefficient_covariance(model, design):
+    # Covariance of the estimated coefficients of all systems, the first one
+    # being the reference with coefficient 0. Blocks share no annotators or
+    # documents, so their information adds up and blocks with the same
+    # layout are only computed once.
+    design = as_design(design)
+    n_systems = len(model.systems)
+    weights = system_weights(model)
+
+    layouts = {}
+    for block in range(design.n_blocks):
+        observations = design.blocks == block
+        annotators = np.unique(design.annotators[observations], return_inverse=True)[1]
+        documents = np.unique(design.documents[observations], return_inverse=True)[1]
+        key = (annotators.tobytes(), documents.tobytes())
+        if key not in layouts:
+            layouts[key] = [block_information(model, weights, annotators, documents), 0]
+        layouts[key][1] += 1
+
+    information = sum(layout_information * count for layout_information, count in layouts.values())
+
+    covariance = np.zeros((n_systems, n_systems))
+    covariance[1:, 1:] = np.linalg.inv(information)[1:, 1:]
+    return covariance
+
+
+def pairwise_power(model, design, alpha=0.05):
+    # Returns (better, worse, difference, standard error, power) for every
+    # pair of systems, power is that of finding the difference in the right
+    # direction
+    covariance = coefficient_covariance(model, design)
+    critical = scipy.stats.norm.isf(alpha / 2)
+
+    results = []
+    for idx_a, idx_b in it.combinations(range(len(model.systems)), 2):
+        if model.coefficients[idx_b] > model.coefficients[idx_a]:
+            idx_a, idx_b = idx_b, idx_a
+        difference = model.coefficients[idx_a] - model.coefficients[idx_b]
+        std_err = np.sqrt(covariance[idx_a, idx_a] + covariance[idx_b, idx_b] - 2 * covariance[idx_a, idx_b])
+        power = scipy.stats.norm.sf(critical - difference / std_err)
+        if difference == 0:
+            # Only half of the rejections point in the "right" direction
+            power = alpha / 2
+        results.append((model.systems[idx_a], model.systems[idx_b], difference, std_err, power))
+    return results
+
+
+def power_frame(model, designs, alpha=0.05):
+    # One row per design (blocks, docs, annotators) and pair of systems
+    rows = []
+    for design in designs:
+        for better, worse, difference, std_err, power in pairwise_power(model, ordinal.create_design(*design), alpha):
+            rows.append(tuple(design) + (better, worse, difference, std_err, power))
+    return pd.DataFrame(rows, columns=["blocks", "docs", "annotators", "better", "worse", "difference", "std_err", "power"])
+
+
+def needs_simulation(power, target=0.8, margin=0.1):
+    # Designs whose approximate power is far from the target do not need to
+    # be simulated
+    return np.abs(np.asarray(power) - target) <= margin
+
+
+def simulated_power(model, path, pattern, alpha=0.05):
+    # Share of simulated replicates that found each difference in the right
+    # direction, from obspower style files named <model><blocks>_<docs>_<annotators>.csv
+    coefficients = dict(zip(model.systems, model.coefficients))
+    rows = []
+    for csv_path in sorted(Path(path).glob(pattern)):
+        n_blocks, n_docs, n_annotators = map(int, re.match(r".*?(\d+)_(\d+)_(\d+).csv", csv_path.name).groups())
+        data = pd.read_csv(csv_path, header=0, names=["better", "worse", "p_value"])
+        correct = [coefficients[better] > coefficients[worse] for better, worse in zip(data["better"], data["worse"])]
+        data["found"] = np.array(correct) & (data["p_value"] < alpha)
+        # Pairs are counted in the order of the model
+        data["pair"] = [tuple(sorted((better, worse), key=lambda s: -coefficients[s])) for better, worse in zip(data["better"], data["worse"])]
+        for (better, worse), found in data.groupby("pair")["found"]:
+            rows.append((n_blocks, n_docs, n_annotators, better, worse, found.mean(), len(found)))
+    return pd.DataFrame(rows, columns=["blocks", "docs", "annotators", "better", "worse", "simulated_power", "replicates"])
+
+
+def calibrate(model, path, pattern, alpha=0.05):
+    simulated = simulated_power(model, path, pattern, alpha)
+    designs = simulated[["blocks", "docs", "annotators"]].drop_duplicates().itertuples(index=False)
+    analytic = power_frame(model, [tuple(design) for design in designs], alpha)
+    df = simulated.merge(analytic, on=["blocks", "docs", "annotators", "better", "worse"])
+    df["error"] = df["power"] - df["simulated_power"]
+    return df
+
+
+if __name__ == "__main__":
+    from .sweep import parse_designs
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    power_parser = subparsers.add_parser("power")
+    power_parser.add_argument("model_file")
+    power_parser.add_argument("-g", dest="grids", action="append", default=[], help="blocks:docs:annotators, each a comma separated list of values or ranges, e.g. 1-20:5:3")
+    power_parser.add_argument("-o", dest="out_file", default=None)
+
+    calibrate_parser = subparsers.add_parser("calibrate")
+    calibrate_parser.add_argument("model_file")
+    calibrate_parser.add_argument("obspower_dir")
+    calibrate_parser.add_argument("pattern", nargs="?", default=None, help="defaults to <model name>*.csv")
+    calibrate_parser.add_argument("-o", dest="out_file", default=None)
+
+    for subparser in (power_parser, calibrate_parser):
+        subparser.add_argument("--alpha", dest="alpha", default=0.05, type=float)
+
+    args = parser.parse_args()
+
+    model = ordinal.OrdinalModel.from_file(args.model_file)
+    if args.command == "power":
+        df = power_frame(model, [d for grid in args.grids for d in parse_designs(grid)], args.alpha)
+        print(df.groupby(["blocks", "docs", "annotators"])["power"].mean().to_string())
+    else:
+        pattern = args.pattern or Path(args.model_file).stem + "*.csv"
+        df = calibrate(model, args.obspower_dir, pattern, args.alpha)
+        print(df.groupby(["blocks", "docs", "annotators"])[["simulated_power", "power"]].mean().to_string())
+        print(f"Mean absolute error {df['error'].abs().mean():.3f}, correlation {df['power'].corr(df['simulated_power']):.3f}")
+
+    if args.out_file is not None:
+        df.to_csv(args.out_file, index=False)
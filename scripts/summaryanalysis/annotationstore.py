@@ -0,0 +1,270 @@
+import argparse
+import contextlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .powerstore import file_lock
+
+
+# Compact binary copies of judgement and timing CSVs. A store is a directory
+# with a manifest.json and one raw row file per imported CSV. Text columns
+# (document hashes, systems, corpora, annotators) are stored as uint32 codes
+# into vocabularies that are shared by all files of the store and persisted
+# in the manifest, so the codes of the same annotator or document agree
+# between the judgement and timing files. Scores and ranks are stored as
+# int8. CSVs are imported in chunks and rows are appended to the file as they
+# are encoded, so memory use does not grow with the size of the file. The
+# types of the other columns follow the first chunk and are widened (to int64
+# or float64) when a later chunk does not fit, e.g. because of an empty cell.
+# Numeric columns that turn into text in a later chunk are not supported.
+# Files are imported again when their size or modification time changes.
+# Imports hold a lock on the store and start from the current manifest, so
+# several processes can import into one store.
+
+
+DEFAULT_CHUNKSIZE = 1 << 16
+ENCODED_COLUMNS = ["annotator", "document", "system", "corpus"]
+SMALL_COLUMNS = ["score", "rank"]
+DEFAULT_STORE_NAME = ".annotationstore"
+
+
+def column_dtype(name, values):
+    if name in ENCODED_COLUMNS or not pd.api.types.is_numeric_dtype(values):
+        return np.dtype("<u4")
+    if name in SMALL_COLUMNS:
+        return np.dtype("i1")
+    if pd.api.types.is_integer_dtype(values):
+        return np.dtype("<i4")
+    return np.dtype("<f8")
+
+
+def fits(values, dtype):
+    if dtype.kind != "i":
+        return True
+    values = np.asarray(values, dtype=float)
+    limits = np.iinfo(dtype)
+    return bool(np.all(np.isfinite(values) & (values == np.round(values)) & (values >= limits.min) & (values <= limits.max)))
+
+
+def widened_dtype(values, dtype):
+    # Smallest of the current type, int64 and float64 that holds values
+    for candidate in (dtype, np.dtype("<i8"), np.dtype("<f8")):
+        if fits(values, candidate):
+            return candidate
+
+
+def widen_rows(path, dtype, new_dtype, n_rows, chunksize=DEFAULT_CHUNKSIZE):
+    # Rewrites the rows already in path with new_dtype, chunk by chunk
+    tmp_path = path.with_suffix(".widen")
+    old_rows = np.memmap(path, dtype=dtype, mode="r", shape=(n_rows,)) if n_rows > 0 else np.empty(0, dtype=dtype)
+    with open(tmp_path, "wb") as f:
+        for start in range(0, n_rows, chunksize):
+            old = old_rows[start:start + chunksize]
+            rows = np.empty(len(old), dtype=new_dtype)
+            for name in new_dtype.names:
+                rows[name] = old[name]
+            f.write(rows.tobytes())
+    del old_rows
+    os.replace(tmp_path, path)
+
+
+class AnnotationStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.path / "manifest.json"
+        self._read_manifest()
+
+    def _read_manifest(self):
+        if self.manifest_path.exists():
+            self.manifest = json.loads(self.manifest_path.read_text())
+        else:
+            self.manifest = {"vocabularies": {}, "files": {}}
+        self._lookups = {}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with file_lock(self.path / "manifest.lock"):
+            self._read_manifest()
+            yield
+
+    def vocabulary(self, column):
+        return self.manifest["vocabularies"].setdefault(column, [])
+
+    def codes(self, column, values):
+        # Codes of values in the vocabulary of column, new values are added
+        vocabulary = self.vocabulary(column)
+        if column not in self._lookups:
+            self._lookups[column] = {value: idx for idx, value in enumerate(vocabulary)}
+        lookup = self._lookups[column]
+
+        inverse, uniques = pd.factorize(values)
+        if np.any(inverse < 0):
+            raise ValueError(f"Column {column} has missing values")
+        unique_codes = np.empty(len(uniques), dtype=np.uint32)
+        for idx, value in enumerate(np.asarray(uniques).tolist()):
+            if value not in lookup:
+                lookup[value] = len(vocabulary)
+                vocabulary.append(value)
+            unique_codes[idx] = lookup[value]
+        return unique_codes[inverse]
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.manifest))
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def source_key(csv_path):
+        return str(Path(csv_path).resolve())
+
+    def entry(self, csv_path):
+        # Manifest entry of the file, None if it was not imported or changed
+        # since
+        entry = self.manifest["files"].get(self.source_key(csv_path))
+        stat = os.stat(csv_path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def import_csv(self, csv_path, chunksize=DEFAULT_CHUNKSIZE, force=False):
+        with self._locked():
+            # Another process may have imported the file in the meantime
+            if not force and self.entry(csv_path) is not None:
+                return self.entry(csv_path)
+            return self._import_csv(csv_path, chunksize)
+
+    def _import_csv(self, csv_path, chunksize):
+        key = self.source_key(csv_path)
+        stat = os.stat(csv_path)
+        file_name = f"file-{uuid.uuid4().hex}.bin"
+        tmp_path = self.path / (file_name + ".tmp")
+
+        dtype = np.dtype([])
+        n_rows = 0
+        f = open(tmp_path, "wb")
+        try:
+            for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+                if len(dtype) == 0:
+                    dtype = np.dtype([(name, column_dtype(name, chunk[name])) for name in chunk.columns])
+                for name in dtype.names:
+                    if dtype[name] != np.uint32 and not pd.api.types.is_numeric_dtype(chunk[name]):
+                        raise ValueError(f"Column {name} of {csv_path} has text after row {n_rows}, but only numbers or empty cells before")
+                new_dtype = np.dtype([
+                    (name, dtype[name] if dtype[name] == np.uint32 else widened_dtype(chunk[name].to_numpy(), dtype[name]))
+                    for name in dtype.names
+                ])
+                if new_dtype != dtype:
+                    f.close()
+                    widen_rows(tmp_path, dtype, new_dtype, n_rows, chunksize)
+                    f = open(tmp_path, "ab")
+                    dtype = new_dtype
+
+                rows = np.empty(len(chunk), dtype=dtype)
+                for name in dtype.names:
+                    if dtype[name] == np.uint32:
+                        rows[name] = self.codes(name, chunk[name].to_numpy())
+                    else:
+                        rows[name] = chunk[name].to_numpy(dtype=float if dtype[name].kind == "f" else None)
+                f.write(rows.tobytes())
+                n_rows += len(rows)
+        except BaseException:
+            f.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            f.close()
+        os.replace(tmp_path, self.path / file_name)
+
+        previous = self.manifest["files"].get(key)
+        self.manifest["files"][key] = {
+            "file": file_name,
+            "rows": n_rows,
+            "columns": [[name, dtype[name].str] for name in dtype.names],
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns
+        }
+        self._write_manifest()
+        if previous is not None:
+            (self.path / previous["file"]).unlink(missing_ok=True)
+        return self.manifest["files"][key]
+
+    def read_arrays(self, csv_path, chunksize=DEFAULT_CHUNKSIZE):
+        # Memory-mapped rows of the file with the codes of the store, the
+        # file is imported first if needed
+        entry = self.entry(csv_path)
+        if entry is None or not (self.path / entry["file"]).exists():
+            entry = self.import_csv(csv_path, chunksize)
+        dtype = np.dtype([(name, dtype_str) for name, dtype_str in entry["columns"]])
+        if entry["rows"] == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.path / entry["file"], dtype=dtype, mode="r", shape=(entry["rows"],))
+
+    def categorical(self, column, codes):
+        # Only the values that occur in codes become categories, the codes
+        # are renumbered in the smallest integer type that fits them
+        used = np.flatnonzero(np.bincount(codes, minlength=len(self.vocabulary(column))))
+        renumbered = np.zeros(len(self.vocabulary(column)), dtype=np.min_scalar_type(-len(used)))
+        renumbered[used] = np.arange(len(used))
+        categories = pd.Index([self.vocabulary(column)[code] for code in used])
+        return pd.Categorical.from_codes(renumbered[codes], categories)
+
+    def read(self, csv_path, index_col=None, chunksize=DEFAULT_CHUNKSIZE):
+        # Same frame as pd.read_csv(csv_path, index_col=index_col), with the
+        # encoded columns as categoricals of the values in the file
+        rows = self.read_arrays(csv_path, chunksize)
+        columns = {}
+        for name in rows.dtype.names or []:
+            if rows.dtype[name] == np.uint32:
+                columns[name] = self.categorical(name, rows[name])
+            else:
+                columns[name] = np.array(rows[name])
+        df = pd.DataFrame(columns)
+        if index_col is not None:
+            df = df.set_index([df.columns[i] if isinstance(i, int) else i for i in index_col])
+        return df
+
+
+def default_store(csv_path):
+    # Next to the imported file, pass a common store to share vocabularies
+    # between directories
+    return Path(csv_path).resolve().parent / DEFAULT_STORE_NAME
+
+
+def read_csv(csv_path, index_col=None, store=None, chunksize=DEFAULT_CHUNKSIZE):
+    if not isinstance(store, AnnotationStore):
+        store = AnnotationStore(store if store is not None else default_store(csv_path))
+    return store.read(csv_path, index_col=index_col, chunksize=chunksize)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("store")
+    import_parser.add_argument("csv_files", nargs="+")
+    import_parser.add_argument("--chunksize", dest="chunksize", default=DEFAULT_CHUNKSIZE, type=int)
+    import_parser.add_argument("-f", "--force", dest="force", default=False, action="store_true", help="import files again even if they did not change")
+
+    show_parser = subparsers.add_parser("show")
+    show_parser.add_argument("store")
+
+    args = parser.parse_args()
+
+    store = AnnotationStore(args.store)
+    if args.command == "import":
+        for csv_path in args.csv_files:
+            if args.force or store.entry(csv_path) is None:
+                store.import_csv(csv_path, args.chunksize, force=args.force)
+    else:
+        for source, entry in sorted(store.manifest["files"].items()):
+            columns = ", ".join(f"{name}:{np.dtype(dtype_str).name}" for name, dtype_str in entry["columns"])
+            print(f"{source}: {entry['rows']} rows, {os.path.getsize(store.path / entry['file'])} bytes ({columns})")
+        for column, vocabulary in store.manifest["vocabularies"].items():
+            print(f"{column}: {len(vocabulary)} values")
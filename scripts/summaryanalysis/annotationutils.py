@@ -1,12 +1,112 @@
 from collections import Counter, defaultdict
 import itertools as it
 
+import numpy as np
+import pandas as pd
+
+
 def get_annotator_groups(annotations):
+    index = annotations.index.to_frame(index=False)
     all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
+    for annotator, documents in index.groupby("annotator")["document"]:
+        docs = tuple(sorted(set(documents)))
         all_groups[docs].append(annotator)
 
     all_annotator_groups = list(map(tuple, all_groups.values()))
     return all_annotator_groups
 
+
+class AnnotationIndex:
+    # Integer coded view of a judgements frame indexed by annotator, document
+    # and system. Rows are sorted by annotator, so the rows of annotator a are
+    # rows[annotator_offsets[a]:annotator_offsets[a + 1]]. Groups are the sets
+    # of annotators that judged the same documents, in the same order as
+    # get_annotator_groups. Scores are summed and counted per (annotator,
+    # system), so system means of any set of annotators are a sum over a few
+    # rows of these tables.
+    def __init__(self, annotations, score_names=None):
+        frame = annotations.reset_index()
+        if score_names is None:
+            score_names = [c for c in frame.columns if c not in ("annotator", "document", "system") and pd.api.types.is_numeric_dtype(frame[c])]
+        self.score_names = list(score_names)
+
+        self.annotators, annotator_codes = np.unique(frame["annotator"].to_numpy(), return_inverse=True)
+        self.documents, document_codes = np.unique(frame["document"].astype(str).to_numpy(), return_inverse=True)
+        self.systems, system_codes = np.unique(frame["system"].astype(str).to_numpy(), return_inverse=True)
+
+        order = np.lexsort((system_codes, document_codes, annotator_codes))
+        # Position of every row in the original frame
+        self.source_rows = order
+        self.frame = frame.iloc[order].reset_index(drop=True)
+        self.annotator_codes = annotator_codes[order]
+        self.document_codes = document_codes[order]
+        self.system_codes = system_codes[order]
+        self.scores = self.frame[self.score_names].to_numpy(dtype=float)
+
+        n_annotators = len(self.annotators)
+        n_systems = len(self.systems)
+
+        self.annotator_offsets = np.zeros(n_annotators + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.annotator_codes, minlength=n_annotators), out=self.annotator_offsets[1:])
+
+        all_groups = defaultdict(list)
+        for annotator in range(n_annotators):
+            docs = self.document_codes[self.annotator_offsets[annotator]:self.annotator_offsets[annotator + 1]]
+            all_groups[tuple(np.unique(docs))].append(annotator)
+        self.groups = [np.array(g) for g in all_groups.values()]
+        self.annotator_groups = np.empty(n_annotators, dtype=np.int64)
+        for group_idx, group in enumerate(self.groups):
+            self.annotator_groups[group] = group_idx
+
+        cells = self.annotator_codes * n_systems + self.system_codes
+        self.counts = np.bincount(cells, minlength=n_annotators * n_systems).reshape(n_annotators, n_systems).astype(float)
+        self.sums = np.stack([
+            np.bincount(cells, weights=self.scores[:, i], minlength=n_annotators * n_systems)
+            for i in range(len(self.score_names))
+        ], axis=-1).reshape(n_annotators, n_systems, len(self.score_names))
+
+    @classmethod
+    def from_csv(cls, path, score_names=None, store=None):
+        # With a store, the compact copy from annotationstore is read
+        if store is not None:
+            from .annotationstore import read_csv
+            return cls(read_csv(path, index_col=[0, 1, 2], store=store), score_names)
+        return cls(pd.read_csv(path, index_col=[0, 1, 2]), score_names)
+
+    def score_index(self, score_name):
+        return self.score_names.index(score_name)
+
+    def group_labels(self):
+        # Groups with the original annotator labels, like get_annotator_groups
+        return [tuple(self.annotators[g]) for g in self.groups]
+
+    def annotator_rows(self, annotators):
+        annotators = np.asarray(annotators, dtype=np.int64)
+        starts = self.annotator_offsets[annotators]
+        lengths = self.annotator_offsets[annotators + 1] - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def select(self, annotators):
+        # Same rows as annotations.loc[labels] for the coded annotators
+        return self.frame.iloc[self.annotator_rows(annotators)].set_index(["annotator", "document", "system"])
+
+    def group_annotators(self, groups):
+        return np.concatenate([self.groups[g] for g in groups])
+
+    def system_means(self, annotators, score_name=None):
+        annotators = np.asarray(annotators, dtype=np.int64)
+        means = self.sums[annotators].sum(axis=0) / self.counts[annotators].sum(axis=0)[:, np.newaxis]
+        if score_name is None:
+            return means
+        return means[:, self.score_index(score_name)]
+
+    def batch_system_means(self, weights, score_name=None):
+        # weights has shape (samples, annotators), e.g. a 0/1 selection mask.
+        # Returns system means of shape (samples, systems, scores).
+        weights = np.asarray(weights, dtype=float)
+        sums = np.einsum("na,ask->nsk", weights, self.sums)
+        counts = weights @ self.counts
+        means = sums / counts[..., np.newaxis]
+        if score_name is None:
+            return means
+        return means[..., self.score_index(score_name)]
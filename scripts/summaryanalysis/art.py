@@ -1,23 +1,68 @@
-import random
 import numpy as np
 
-def paired_approximate_randomization_test(x, y, n=1000):
+from .seeding import get_rng
+
+
+MAX_EXACT_ITEMS = 24
+
+
+def paired_approximate_randomization_test(x, y, n=1000, rng=None):
+    assert x.shape == y.shape
+    return batched_paired_approximate_randomization_test(x.reshape(1, -1), y.reshape(1, -1), n, rng=rng)[0]
+
+
+def batched_paired_approximate_randomization_test(x, y, n=1000, exact=False, chunk_size=1 << 22, rng=None):
+    # x and y have shape (tests, items). Swapping the pair of items i flips
+    # the sign of x_i - y_i in the difference of the sums, so all permutation
+    # statistics are a product of a +-1 matrix with the item differences.
+    # Random permutations are drawn in the same order as one call to
+    # paired_approximate_randomization_test per row would draw them.
     assert x.shape == y.shape
-    x_sum = x.sum()
-    y_sum = y.sum()
-    original_difference = abs(x_sum - y_sum)
+    rng = get_rng(rng)
+    n_tests, n_items = x.shape
+    differences = (x - y).astype(float)
+    original_differences = np.abs(x.sum(axis=1) - y.sum(axis=1))
 
-    num_successes = 0
-    for _ in range(n):
-        mask = np.random.choice(a=[True, False], size=x.shape)
-        x_sample_sum = x[~mask].sum()
-        y_sample_sum = y[mask].sum()
+    if exact:
+        return _exact_randomization_test(differences, original_differences, chunk_size)
 
-        sample_a_sum = (x_sum - x_sample_sum) + (y_sum - y_sample_sum)
-        sample_b_sum = x_sample_sum + y_sample_sum
+    num_successes = np.zeros(n_tests, dtype=int)
+    tests_per_chunk = max(1, chunk_size // (n * n_items))
+    perms_per_chunk = max(1, chunk_size // n_items)
 
-        sample_difference = abs(sample_a_sum - sample_b_sum)
-        if sample_difference >= original_difference:
-            num_successes += 1
+    for start in range(0, n_tests, tests_per_chunk):
+        end = min(start + tests_per_chunk, n_tests)
+        if end - start > 1 or n * n_items <= chunk_size:
+            mask = rng.choice(a=[True, False], size=(end - start, n, n_items))
+            sample_differences = np.abs(np.where(mask, 1., -1.) @ differences[start:end, :, np.newaxis])[..., 0]
+            num_successes[start:end] = (sample_differences >= original_differences[start:end, np.newaxis]).sum(axis=1)
+            continue
+
+        for perm_start in range(0, n, perms_per_chunk):
+            mask = rng.choice(a=[True, False], size=(min(perms_per_chunk, n - perm_start), n_items))
+            sample_differences = np.abs(np.where(mask, 1., -1.) @ differences[start])
+            num_successes[start] += (sample_differences >= original_differences[start]).sum()
 
     return (num_successes + 1) / (n + 1)
+
+
+def _exact_randomization_test(differences, original_differences, chunk_size):
+    n_tests, n_items = differences.shape
+    if n_items > MAX_EXACT_ITEMS:
+        raise ValueError(f"Exact randomization test is limited to {MAX_EXACT_ITEMS} items, got {n_items}")
+
+    # The identity permutation is part of the enumeration and has to count as
+    # a success even if the two ways of summing round differently
+    tolerance = 1e-9 * np.maximum(np.abs(differences).sum(axis=1), 1.)
+
+    n_perms = 1 << n_items
+    num_successes = np.zeros(n_tests, dtype=int)
+    perms_per_chunk = max(1, chunk_size // n_items)
+
+    for perm_start in range(0, n_perms, perms_per_chunk):
+        perm_ids = np.arange(perm_start, min(perm_start + perms_per_chunk, n_perms))
+        signs = np.where((perm_ids[:, np.newaxis] >> np.arange(n_items)) & 1, 1., -1.)
+        sample_differences = np.abs(differences @ signs.T)
+        num_successes += (sample_differences >= (original_differences - tolerance)[:, np.newaxis]).sum(axis=1)
+
+    return num_successes / n_perms
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import sys
+import time
+
+from . import cache as result_cache
+from . import telemetry
+from .power import parse_contrast_line
+
+
+# Runs analyse-ordinal.r style analyzers as asyncio subprocesses. Samples are
+# piped to the analyzer's stdin as CSV (the script reads "-" as stdin) and the
+# contrast lines are parsed as they are printed. A semaphore keeps at most one
+# analyzer per core running, so sampling the next replicates and collecting
+# finished fits overlap with the running analyzers in one event loop.
+
+
+ANALYZERS = {
+    "async": (["Rscript", "scripts/r/analyse-ordinal.r"], "rscript"),
+    "async-python": ([sys.executable, "-m", "summaryanalysis.stubanalyzer"], "python")
+}
+
+
+class RegressionDispatcher:
+    def __init__(self, command=None, concurrency=None, cache=None, cache_name=None):
+        # cache_name is the backend name results are cached under, analyzers
+        # that produce the same output as a synchronous backend can share its
+        # cached results
+        if command is None:
+            command = ANALYZERS["async"][0]
+        self.command = list(command)
+        self.concurrency = concurrency or os.cpu_count()
+        self.cache = result_cache.get_cache(cache)
+        self.cache_name = cache_name
+        self._semaphore = None
+        self._loop = None
+
+    @classmethod
+    def from_name(cls, name, concurrency=None, cache=None):
+        command, cache_name = ANALYZERS[name]
+        return cls(command, concurrency, cache, cache_name)
+
+    @property
+    def semaphore(self):
+        # One semaphore per event loop, run() starts a new loop every time
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.BoundedSemaphore(self.concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    async def run_analyzer(self, group_df, score_name, mode):
+        with telemetry.timer("regression.serialize"):
+            data = group_df.to_csv().encode("utf8")
+        differences = set()
+        p_values = {}
+
+        async with self.semaphore:
+            # Output is parsed while the analyzer runs, so the phases are
+            # timed by hand
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *self.command, "-", score_name, mode,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            launched = time.perf_counter()
+            telemetry.add_time("regression.launch", launched - start)
+            parse_time = 0.
+
+            process.stdin.write(data)
+            try:
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            process.stdin.close()
+
+            async for line in process.stdout:
+                parse_start = time.perf_counter()
+                contrast = parse_contrast_line(line.decode("utf8"))
+                parse_time += time.perf_counter() - parse_start
+                if contrast is None:
+                    continue
+                sys_a, sys_b, significant, p_value = contrast
+                if significant:
+                    differences.add((sys_a, sys_b))
+                p_values[sys_a, sys_b] = p_value
+
+            await process.wait()
+            finished = time.perf_counter()
+
+        telemetry.add_time("regression.fit", finished - launched - parse_time)
+        telemetry.add_time("regression.parse", parse_time)
+        telemetry.add_time("regression", finished - start)
+        if process.returncode != 0:
+            telemetry.count("regression.failed")
+            return set(), {}
+
+        return differences, p_values
+
+    async def regress(self, group_df, nested=False):
+        # Same as power.run_regression
+        mode = "nested" if nested else "crossed"
+        mode += ":none"
+
+        key = None
+        if self.cache is not None and self.cache_name is not None:
+            key = result_cache.hash_key("regression", result_cache.frame_key(group_df, "score"), mode, self.cache_name)
+            cached = self.cache.get_contrasts(key)
+            if cached is not None:
+                telemetry.count("regression.cached")
+                return cached
+
+        differences, p_values = await self.run_analyzer(group_df, "score", mode)
+
+        if key is not None and len(p_values) > 0:
+            self.cache.put_contrasts(key, differences, p_values)
+
+        return differences, p_values
+
+    async def map_samples(self, frames, nested=False):
+        # frames is an iterable that produces sample frames lazily; every frame
+        # is handed to an analyzer as soon as it is drawn. Results are returned
+        # in the order of the frames.
+        tasks = []
+        for frame in frames:
+            tasks.append(asyncio.ensure_future(self.regress(frame, nested)))
+            # Let started analyzers make progress while sampling the next frame
+            await asyncio.sleep(0)
+        return await asyncio.gather(*tasks)
+
+    def run(self, frames, nested=False):
+        return asyncio.run(self.map_samples(frames, nested))
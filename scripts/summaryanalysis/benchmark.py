@@ -0,0 +1,247 @@
+import argparse
+import atexit
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Benchmarks for the simulation and resampling hot paths. Every benchmark is
+# a setup function that prepares its inputs from the bundled annotations,
+# models and obspower results and returns the function to time. Results are
+# written as JSON, and a run can be compared against a stored baseline:
+#
+#   python -m summaryanalysis.benchmark -o benchmarks/baseline.json
+#   python -m summaryanalysis.benchmark --compare benchmarks/baseline.json
+#
+# Timings only compare on the same machine and versions, a baseline recorded
+# elsewhere gives a warning (or an error with --strict).
+
+
+ROOT = Path(__file__).resolve().parents[2]
+MODEL_FILE = ROOT / "models" / "model_logit_likert_cnndm_coherence.json"
+JUDGEMENTS_FILE = ROOT / "anonymized_annotations" / "judgements" / "likert_coherence_cnn_dm.csv"
+OBSPOWER_DIR = ROOT / "obspower"
+BASELINE_FILE = ROOT / "benchmarks" / "baseline.json"
+ENVIRONMENT_FIELDS = ["python", "numpy", "pandas", "machine", "processor"]
+
+# Prints every contrast of the systems it reads as insignificant, so the
+# regression round trip is timed without the cost of fitting
+FAKE_ANALYZER = """
+import itertools as it, sys
+import pandas as pd
+data = pd.read_csv(sys.stdin)
+for a, b in it.combinations(sorted(data["system"].unique()), 2):
+    print(f"{a} - {b}\\to\\t1")
+"""
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def load_judgements():
+    return pd.read_csv(JUDGEMENTS_FILE, index_col=[0, 1, 2]).drop(columns="corpus")
+
+
+@benchmark("create_design")
+def setup_create_design():
+    from .design import Design
+    return lambda: Design.from_blocks([5] * 200, 3)
+
+
+def setup_sample(design_size):
+    from . import ordinal
+    model = ordinal.OrdinalModel.from_file(MODEL_FILE)
+    design = ordinal.create_design(*design_size)
+    rng = np.random.default_rng(0)
+    return lambda: model.sample(design, rng=rng)
+
+
+for _size in [(20, 5, 3), (100, 5, 3), (1, 100, 3), (60, 5, 1)]:
+    benchmark("sample_{}_{}_{}".format(*_size))(lambda size=_size: setup_sample(size))
+
+
+@benchmark("sample_batch_1000_20_5_3")
+def setup_sample_batch():
+    from . import ordinal
+    model = ordinal.OrdinalModel.from_file(MODEL_FILE)
+    design = ordinal.create_design(20, 5, 3)
+    rng = np.random.default_rng(0)
+    return lambda: model.sample_batch(design, 1000, rng=rng)
+
+
+@benchmark("art_paired")
+def setup_art():
+    from .art import paired_approximate_randomization_test
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=(2, 100))
+    return lambda: paired_approximate_randomization_test(x, y, rng=rng)
+
+
+@benchmark("art_batched_1000")
+def setup_art_batched():
+    from .art import batched_paired_approximate_randomization_test
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=(2, 1000, 20))
+    return lambda: batched_paired_approximate_randomization_test(x, y, rng=rng)
+
+
+@benchmark("annotator_shr")
+def setup_shr():
+    from .shr import compute_annotator_shr
+    annotations = load_judgements()
+    return lambda: compute_annotator_shr(annotations, limit=1000, score_names=("score",), rng=0)
+
+
+@benchmark("grouped_subsample_variance")
+def setup_subsample_variance():
+    from .timereliability import compute_grouped_subsample_variance
+    annotations = load_judgements()
+    return lambda: compute_grouped_subsample_variance(annotations, crossed=True, score_name="score", limit=1000, rng=0)
+
+
+@benchmark("read_obspower_files")
+def setup_read_obspower():
+    from .montecarlo import read_obspower_files
+    return lambda: read_obspower_files(OBSPOWER_DIR, "model_logit_likert_cnndm_coherence*_5_*.csv")
+
+
+@benchmark("read_obspower_store")
+def setup_read_obspower_store():
+    from .montecarlo import read_obspower_store
+    from .powerstore import PowerStore, import_obspower_files
+    directory = tempfile.mkdtemp(prefix="summaryanalysis-benchmark-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    import_obspower_files(PowerStore(directory), OBSPOWER_DIR)
+    return lambda: read_obspower_store(directory, "model_logit_likert_cnndm_coherence", docs=5)
+
+
+@benchmark("regression_round_trip")
+def setup_regression_round_trip():
+    from . import ordinal
+    from .asyncdispatch import RegressionDispatcher
+    model = ordinal.OrdinalModel.from_file(MODEL_FILE)
+    design = ordinal.create_design(20, 5, 3)
+    frames = [model.sample(design, rng=seed) for seed in range(8)]
+    dispatcher = RegressionDispatcher([sys.executable, "-c", FAKE_ANALYZER])
+    return lambda: dispatcher.run(frames)
+
+
+def run_benchmark(name, repeat=5):
+    function = BENCHMARKS[name]()
+    function()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured in a separate run, tracing slows everything down
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"median": statistics.median(times), "min": min(times), "repeat": repeat, "peak_memory": peak_memory}
+
+
+def run_benchmarks(names=None, repeat=5):
+    if names is None:
+        names = list(BENCHMARKS)
+
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(name, repeat)
+        print(f"{name}: {results[name]['median'] * 1000:.2f} ms, {results[name]['peak_memory'] / 2 ** 20:.2f} MiB", file=sys.stderr)
+
+    return dict(platform_info(), created=time.strftime("%Y-%m-%dT%H:%M:%S"), benchmarks=results)
+
+
+def platform_info():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor()
+    }
+
+
+def environment_differences(results, baseline):
+    # Returns (field, baseline value, current value) for every field of the
+    # environment that differs
+    return [(field, baseline.get(field), results.get(field)) for field in ENVIRONMENT_FIELDS if baseline.get(field) != results.get(field)]
+
+
+def compare(results, baseline, threshold=1.25):
+    # Returns (name, metric, baseline value, current value) for every metric
+    # that got worse by more than threshold
+    regressions = []
+    for name, current in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        for metric in ("median", "peak_memory"):
+            reference = baseline["benchmarks"][name][metric]
+            if reference > 0 and current[metric] / reference > threshold:
+                regressions.append((name, metric, reference, current[metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", dest="out_file", default=None, help="write the results as JSON, e.g. to store a new baseline")
+    parser.add_argument("-k", dest="names", action="append", default=None, choices=sorted(BENCHMARKS), help="only run these benchmarks")
+    parser.add_argument("-r", "--repeat", dest="repeat", default=5, type=int)
+    parser.add_argument("--compare", dest="baseline", nargs="?", const=str(BASELINE_FILE), default=None, help=f"baseline to compare against, defaults to {BASELINE_FILE.relative_to(ROOT)}")
+    parser.add_argument("--strict", dest="strict", default=False, action="store_true", help="refuse to compare against a baseline from another environment")
+    parser.add_argument("--threshold", dest="threshold", default=1.25, type=float, help="slowdown factor that counts as a regression")
+    parser.add_argument("-l", "--list", dest="list", default=False, action="store_true")
+
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        sys.exit(0)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        differences = environment_differences(platform_info(), baseline)
+        for field, reference, current in differences:
+            print(f"Baseline was recorded with {field} {reference}, this is {current}", file=sys.stderr)
+        if len(differences) > 0 and args.strict:
+            sys.exit(2)
+
+    results = run_benchmarks(args.names, args.repeat)
+
+    if args.out_file is not None:
+        Path(args.out_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out_file, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, reference, current in regressions:
+            print(f"{name} {metric}: {reference:.4g} -> {current:.4g} ({current / reference:.2f}x)", file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,112 @@
+import os
+import tempfile
+
+import numpy as np
+
+from . import ordinal
+from . import telemetry
+from .design import Design
+
+
+# Publishes read-only arrays to process pool workers once instead of pickling
+# them into every task. The arrays are written to one file (in /dev/shm where
+# available) that every worker memory-maps in its initializer, so the pages
+# are shared between all processes. Tasks then only carry replicate indices
+# and seeds.
+
+
+ALIGNMENT = 64
+
+
+class Broadcast:
+    def __init__(self, arrays, metadata=None):
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        handle, self.path = tempfile.mkstemp(prefix="summaryanalysis-", suffix=".bin", dir=directory)
+
+        layout = {}
+        offset = 0
+        with os.fdopen(handle, "wb") as f:
+            for name, array in arrays.items():
+                if array is None:
+                    layout[name] = None
+                    continue
+                array = np.ascontiguousarray(array)
+                padding = -offset % ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += padding
+                layout[name] = (offset, array.dtype.str, array.shape)
+                f.write(array.tobytes())
+                offset += array.nbytes
+
+        self.descriptor = (self.path, layout, metadata or {})
+
+    def close(self):
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(descriptor):
+    path, layout, metadata = descriptor
+    arrays = {}
+    for name, entry in layout.items():
+        if entry is None:
+            arrays[name] = None
+            continue
+        offset, dtype, shape = entry
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, mode="r", dtype=dtype, shape=shape, offset=offset)
+    return arrays, metadata
+
+
+def publish_model(model, design, **metadata):
+    # Covariance factors are published as well, so workers skip the
+    # decomposition
+    arrays = {
+        "coefficients": model.coefficients,
+        "thresholds": model.thresholds,
+        "annotator_covariance_matrix": model.annotator_covariance_matrix,
+        "document_covariance_matrix": model.document_covariance_matrix,
+        "annotator_factor": model.annotator_factor,
+        "document_factor": model.document_factor,
+        "annotators": design.annotators,
+        "documents": design.documents,
+        "blocks": design.blocks
+    }
+    return Broadcast(arrays, dict(metadata, systems=model.systems, design_key=design.key, telemetry=telemetry.enabled()))
+
+
+def attach_model(descriptor):
+    arrays, metadata = attach(descriptor)
+    model = ordinal.OrdinalModel(
+        metadata["systems"],
+        arrays["coefficients"],
+        arrays["thresholds"],
+        arrays["annotator_covariance_matrix"],
+        arrays["document_covariance_matrix"],
+        annotator_factor=arrays["annotator_factor"],
+        document_factor=arrays["document_factor"]
+    )
+    design = Design(arrays["annotators"], arrays["documents"], arrays["blocks"], metadata["design_key"])
+    return model, design, metadata
+
+
+_worker_state = None
+
+
+def initialize_model_worker(descriptor):
+    global _worker_state
+    _worker_state = attach_model(descriptor)
+    telemetry.initialize_worker(_worker_state[2]["telemetry"])
+
+
+def get_worker_state():
+    return _worker_state
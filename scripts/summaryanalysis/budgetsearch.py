@@ -0,0 +1,273 @@
+import argparse
+import math
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from . import analyticpower
+from . import annotationstore
+from . import design_power
+from . import fasttests
+from . import ordinal
+from .seeding import get_rng, get_seed_sequence, child_seeds, spawn_seeds
+from .stopping import wilson_interval
+from .sweep import parse_designs, fixed_budget_designs
+
+
+# Searches for the cheapest design (blocks, docs, annotators) whose power
+# reaches a target for every system pair of interest. Cost is annotator time
+# predicted from the times data. Designs are first screened with the analytic
+# approximation, and the remaining ones are raced with successive halving:
+# every round simulates all candidates up to the same number of replicates,
+# drops designs that fail the target with confidence or cost more than a
+# design that passes with confidence, keeps the most promising share of the
+# rest and multiplies the number of replicates by eta.
+
+
+class TimeCostModel:
+    # Expected time an annotator needs for the item at every position of
+    # their session, which captures the slower first items. Positions beyond
+    # the observed ones take the mean time of the last quarter of positions.
+    def __init__(self, position_times, items_per_document=1, bootstrap_times=None):
+        self.position_times = np.asarray(position_times, dtype=float)
+        self.items_per_document = items_per_document
+        self.bootstrap_times = bootstrap_times
+
+    @classmethod
+    def from_times(cls, times, items_per_document=1, n_bootstrap=200, rng=None):
+        # times has annotator, position and time_stamp columns, the time an
+        # annotator spent on the item at that position. Bootstrapping the
+        # annotators gives the uncertainty of the cost.
+        table = times.pivot_table(index="annotator", columns="position", values="time_stamp", aggfunc="sum").to_numpy()
+        rng = get_rng(rng)
+        resampled = rng.integers(0, len(table), size=(n_bootstrap, len(table)))
+        bootstrap_times = np.nanmean(table[resampled], axis=1)
+        return cls(np.nanmean(table, axis=0), items_per_document, bootstrap_times)
+
+    @staticmethod
+    def infer_items_per_document(times, judgements):
+        # Likert judgements are timed per summary, rankings per document
+        items = times.groupby("annotator").size()
+        documents = judgements.reset_index().groupby("annotator")["document"].nunique()
+        return max(1, int(round((items / documents).median())))
+
+    def _annotator_time(self, position_times, n_documents):
+        n_items = n_documents * self.items_per_document
+        observed = position_times[..., :n_items].sum(axis=-1)
+        tail = position_times[..., -max(1, position_times.shape[-1] // 4):].mean(axis=-1)
+        return observed + max(0, n_items - position_times.shape[-1]) * tail
+
+    def annotator_time(self, n_documents):
+        return float(self._annotator_time(self.position_times, n_documents))
+
+    def design_time(self, design):
+        n_blocks, n_docs, n_annotators = design
+        return n_blocks * n_annotators * self.annotator_time(n_docs)
+
+    def design_time_std(self, design):
+        if self.bootstrap_times is None:
+            return 0.
+        n_blocks, n_docs, n_annotators = design
+        return float(np.std(n_blocks * n_annotators * self._annotator_time(self.bootstrap_times, n_docs)))
+
+
+def interest_pairs(model, pairs=None):
+    # Pairs of interest ordered better first by the model, by default every
+    # pair of systems with different coefficients
+    coefficients = dict(zip(model.systems, model.coefficients))
+    if pairs is None:
+        pairs = [(a, b) for i, a in enumerate(model.systems) for b in model.systems[i + 1:] if coefficients[a] != coefficients[b]]
+    return [tuple(sorted(pair, key=lambda s: -coefficients[s])) for pair in pairs]
+
+
+class DesignRace:
+    # Simulated power of one design, replicates are added incrementally and
+    # are the same no matter in how many rounds they were run
+    def __init__(self, model, design, pairs, method="python", seed=None, alpha=0.05, workers=None):
+        self.model = model
+        self.design = tuple(design)
+        self.pairs = pairs
+        self.method = method
+        # Samples and the randomness of fast tests come from separate streams
+        self.seed, self.test_seed = child_seeds(get_seed_sequence(seed), 0, 2)
+        self.coefficients = dict(zip(model.systems, model.coefficients))
+        self.alpha = alpha
+        self.workers = workers
+        self.replicates = 0
+        self.successes = Counter()
+        self.trials = Counter()
+
+    def simulate(self, num_iters):
+        if num_iters <= self.replicates:
+            return
+        sample_design = ordinal.create_design(*self.design)
+        if self.method.startswith("fast:"):
+            seeds = child_seeds(self.seed, self.replicates, num_iters)
+            scores = self.model.sample_replicates(sample_design, seeds)
+            test = self.method[len("fast:"):]
+            if test in fasttests.RANDOMIZED_TESTS:
+                # Every replicate is tested with its own generator, so
+                # permutation tests do not depend on the rounds either
+                test_seeds = child_seeds(self.test_seed, self.replicates, num_iters)
+                p_values, differences = map(np.concatenate, zip(*[
+                    fasttests.run_test(test, scores[idx:idx + 1], sample_design, rng=test_seed)
+                    for idx, test_seed in enumerate(test_seeds)
+                ]))
+            else:
+                p_values, differences = fasttests.run_test(test, scores, sample_design)
+            sys_1, sys_2 = fasttests.system_pairs(len(self.model.systems))
+            systems = np.array(self.model.systems, dtype=object)
+            better = np.where(differences < 0, systems[sys_2], systems[sys_1]).ravel()
+            worse = np.where(differences < 0, systems[sys_1], systems[sys_2]).ravel()
+            rows = zip(better, worse, p_values.ravel())
+        else:
+            df = design_power.test_design_power(
+                self.model, sample_design, nested=self.design[2] == 1, num_iters=num_iters, backend=self.method,
+                seed=self.seed, workers=self.workers, start=self.replicates
+            )
+            rows = zip(df.index.get_level_values(0), df.index.get_level_values(1), df["p_value"])
+
+        interest = set(self.pairs)
+        for better, worse, p_value in rows:
+            # Differences found in the wrong direction do not count
+            key = tuple(sorted((better, worse), key=lambda s: -self.coefficients[s]))
+            if key not in interest:
+                continue
+            self.trials[key] += 1
+            self.successes[key] += (better, worse) == key and p_value < self.alpha
+        self.replicates = num_iters
+
+    def power(self, confidence=0.95):
+        # Estimate and interval of every pair of interest
+        successes = np.array([self.successes[pair] for pair in self.pairs], dtype=float)
+        trials = np.array([max(self.trials[pair], 1) for pair in self.pairs], dtype=float)
+        low, high = wilson_interval(successes, trials, confidence)
+        return successes / trials, low, high
+
+    def bounds(self, confidence=0.95):
+        # The design reaches the target if its weakest pair does
+        estimates, low, high = self.power(confidence)
+        return estimates.min(), low.min(), high.min()
+
+
+def search_designs(model, designs, cost_model, target=0.8, pairs=None, method="python", seed=None, initial_iters=20, max_iters=320, eta=2, screen_margin=0.15, confidence=0.95, alpha=0.05, workers=None, log=print):
+    # Returns the cheapest design that reaches the target power, or None
+    # when no design does, together with a frame of all candidates
+    pairs = interest_pairs(model, pairs)
+    designs = list(dict.fromkeys(map(tuple, designs)))
+    costs = {design: cost_model.design_time(design) for design in designs}
+
+    summary = pd.DataFrame({
+        "blocks": [d[0] for d in designs],
+        "docs": [d[1] for d in designs],
+        "annotators": [d[2] for d in designs],
+        "time": [costs[d] for d in designs],
+        "time_std": [cost_model.design_time_std(d) for d in designs]
+    })
+
+    analytic = analyticpower.power_frame(model, designs, alpha)
+    analytic = analytic[[pair in set(pairs) for pair in zip(analytic["better"], analytic["worse"])]]
+    analytic_power = analytic.groupby(["blocks", "docs", "annotators"])["power"].min()
+    summary["analytic_power"] = [analytic_power[d] for d in designs]
+
+    # Designs far below the target are dropped, and so are those more
+    # expensive than a design that is far above it
+    candidates = sorted((d for d in designs if analytic_power[d] >= target - screen_margin), key=lambda d: costs[d])
+    safe = [d for d in candidates if analytic_power[d] >= target + screen_margin]
+    if len(safe) > 0:
+        candidates = [d for d in candidates if costs[d] <= costs[safe[0]]]
+    log(f"{len(candidates)} of {len(designs)} designs pass the analytic screening")
+
+    races = {design: DesignRace(model, design, pairs, method, design_seed, alpha, workers) for design, design_seed in zip(candidates, spawn_seeds(seed, len(candidates)))}
+    num_iters = initial_iters
+    while len(candidates) > 0:
+        for design in candidates:
+            races[design].simulate(num_iters)
+        bounds = {design: races[design].bounds(confidence) for design in candidates}
+
+        # Failing designs are out, and so is everything more expensive than
+        # the cheapest design that passes with confidence
+        candidates = [d for d in candidates if bounds[d][2] >= target]
+        passing = [d for d in candidates if bounds[d][1] >= target]
+        if len(passing) > 0:
+            candidates = [d for d in candidates if costs[d] <= costs[passing[0]]]
+        log(f"{num_iters} replicates: {len(candidates)} candidates, cheapest passing {passing[0] if passing else None}")
+
+        if num_iters >= max_iters or candidates == passing[:1]:
+            break
+
+        # Designs estimated to pass first, cheapest first
+        keep = max(1, math.ceil(len(candidates) / eta))
+        ranked = sorted(candidates, key=lambda d: (bounds[d][0] < target, costs[d]))
+        candidates = sorted(set(ranked[:keep]) | set(passing[:1]), key=lambda d: costs[d])
+        num_iters = min(num_iters * eta, max_iters)
+
+    for column, index in (("simulated_power", 0), ("power_low", 1), ("power_high", 2)):
+        summary[column] = [races[d].bounds(confidence)[index] if d in races and races[d].replicates > 0 else np.nan for d in designs]
+    summary["replicates"] = [races[d].replicates if d in races else 0 for d in designs]
+
+    best = None
+    reaching = [d for d in candidates if races[d].bounds(confidence)[0] >= target]
+    if len(reaching) > 0:
+        best = min(reaching, key=lambda d: costs[d])
+    return best, summary.sort_values("time").reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_file")
+    parser.add_argument("times_file")
+
+    parser.add_argument("-g", dest="grids", action="append", default=[], help="blocks:docs:annotators, each a comma separated list of values or ranges, e.g. 1-20:5:3")
+    parser.add_argument("--budget", dest="budget", default=None, type=int, help="fixed number of documents spread over the blocks given by --budget-blocks")
+    parser.add_argument("--budget-blocks", dest="budget_blocks", default="1,2,5,10,20", type=lambda x: list(map(int, x.split(","))))
+    parser.add_argument("--budget-annotators", dest="budget_annotators", default="1,3", type=lambda x: list(map(int, x.split(","))))
+    parser.add_argument("--judgements", dest="judgements_file", default=None, help="judgements matching the times file, to tell how many timed items a document has")
+    parser.add_argument("-p", "--target-power", dest="target", default=0.8, type=float)
+    parser.add_argument("--pair", dest="pairs", action="append", default=None, type=lambda x: tuple(x.split(",")), help="better,worse system pair of interest, all pairs by default")
+    parser.add_argument("-m", "--method", dest="method", default="python", help="regression backend or fast:<test> from fasttests")
+    parser.add_argument("--initial-iters", dest="initial_iters", default=20, type=int)
+    parser.add_argument("-i", dest="max_iters", default=320, type=int)
+    parser.add_argument("--eta", dest="eta", default=2, type=int)
+    parser.add_argument("--screen-margin", dest="screen_margin", default=0.15, type=float)
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+    parser.add_argument("-j", dest="workers", default=None, type=int)
+    parser.add_argument("-o", dest="out_file", default=None)
+    parser.add_argument("--store", dest="store", default=None, help="read the times and judgements through this annotation store")
+
+    args = parser.parse_args()
+
+    read_csv = pd.read_csv
+    if args.store is not None:
+        read_csv = annotationstore.AnnotationStore(args.store).read
+
+    model = ordinal.OrdinalModel.from_file(args.model_file)
+    times = read_csv(args.times_file)
+    items_per_document = 1
+    if args.judgements_file is not None:
+        items_per_document = TimeCostModel.infer_items_per_document(times, read_csv(args.judgements_file))
+    cost_model = TimeCostModel.from_times(times, items_per_document, rng=args.seed)
+
+    designs = [d for grid in args.grids for d in parse_designs(grid)]
+    if args.budget is not None:
+        try:
+            for n_annotators in args.budget_annotators:
+                designs.extend(fixed_budget_designs(args.budget, n_annotators, args.budget_blocks))
+        except ValueError as e:
+            parser.error(str(e))
+
+    best, summary = search_designs(
+        model, designs, cost_model, target=args.target, pairs=args.pairs, method=args.method, seed=args.seed,
+        initial_iters=args.initial_iters, max_iters=args.max_iters, eta=args.eta, screen_margin=args.screen_margin, workers=args.workers
+    )
+
+    print(summary.to_string())
+    if best is None:
+        print(f"No design reaches a power of {args.target}")
+    else:
+        row = summary[(summary["blocks"] == best[0]) & (summary["docs"] == best[1]) & (summary["annotators"] == best[2])].iloc[0]
+        print(f"Cheapest design {best}: {row['time'] / 3600:.2f} +- {row['time_std'] / 3600:.2f} annotator hours, power {row['simulated_power']:.3f} ({row['power_low']:.3f}-{row['power_high']:.3f}) after {int(row['replicates'])} replicates")
+
+    if args.out_file is not None:
+        summary.to_csv(args.out_file, index=False)
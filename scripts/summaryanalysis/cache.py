@@ -0,0 +1,267 @@
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+# Disk cache for simulated samples and regression results. Entries are
+# addressed by a hash of everything that determines them (model parameters,
+# design, seeds, analysis mode or the sampled scores themselves), so a cache
+# directory can be shared between runs, scripts and worker processes. The
+# directory is kept below max_bytes by removing the least recently used
+# entries, reads refresh the modification time that serves as access time.
+
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def _update_hash(h, value):
+    if value is None:
+        h.update(b"N")
+    elif isinstance(value, (bool, np.bool_)):
+        h.update(b"B" + bytes([bool(value)]))
+    elif isinstance(value, (int, np.integer)):
+        h.update(b"I" + str(int(value)).encode("ascii") + b";")
+    elif isinstance(value, (float, np.floating)):
+        h.update(b"F" + np.float64(value).tobytes())
+    elif isinstance(value, str):
+        data = value.encode("utf8")
+        h.update(b"S" + str(len(data)).encode("ascii") + b";" + data)
+    elif isinstance(value, bytes):
+        h.update(b"Y" + str(len(value)).encode("ascii") + b";" + value)
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(b"A" + value.dtype.str.encode("ascii") + str(value.shape).encode("ascii") + b";")
+        h.update(value.tobytes())
+    elif isinstance(value, np.random.SeedSequence):
+        h.update(b"Q")
+        _update_hash(h, (value.entropy, tuple(value.spawn_key), value.pool_size))
+    elif isinstance(value, (tuple, list)):
+        h.update(b"T" + str(len(value)).encode("ascii") + b";")
+        for item in value:
+            _update_hash(h, item)
+    else:
+        raise TypeError(f"Cannot hash values of type {type(value).__name__}")
+
+
+def hash_key(*parts):
+    h = hashlib.sha256()
+    _update_hash(h, parts)
+    return h.hexdigest()
+
+
+def model_key(model):
+    return (
+        "model",
+        tuple(model.systems),
+        np.asarray(model.coefficients, dtype=float),
+        np.asarray(model.thresholds, dtype=float),
+        np.asarray(model.annotator_covariance_matrix, dtype=float),
+        None if model.document_covariance_matrix is None else np.asarray(model.document_covariance_matrix, dtype=float)
+    )
+
+
+def design_key(design):
+    annotators, documents = design
+    return ("design", np.asarray(annotators, dtype=np.int64), np.asarray(documents, dtype=np.int64))
+
+
+def seed_key(seed):
+    # Only seeds that reproduce the same stream every time can be cached,
+    # None and existing generators depend on state we do not know about
+    if isinstance(seed, (int, np.integer)):
+        return ("seed", int(seed))
+    if isinstance(seed, np.random.SeedSequence):
+        return ("seed", seed)
+    if isinstance(seed, (tuple, list)) and len(seed) > 0 and all(seed_key(s) is not None for s in seed):
+        return ("seeds", tuple(seed_key(s) for s in seed))
+    return None
+
+
+def frame_key(group_df, score_name):
+    index = group_df.index
+    if hasattr(index, "codes"):
+        levels = tuple(tuple(map(str, level)) for level in index.levels)
+        codes = tuple(np.asarray(c, dtype=np.int64) for c in index.codes)
+    else:
+        levels = (tuple(map(str, index)),)
+        codes = ()
+    return ("frame", tuple(map(str, index.names)), levels, codes, group_df[score_name].to_numpy(dtype=float))
+
+
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+# Pairwise results are stored as the list of system names followed by one
+# (better, worse, significant, p value) record per pair
+PAIR_DTYPE = np.dtype([("better", "<u2"), ("worse", "<u2"), ("significant", "u1"), ("p_value", "<f8")])
+
+
+def encode_pair_records(records):
+    names = sorted(set(s for better, worse, _, _ in records for s in (better, worse)))
+    ids = {name: idx for idx, name in enumerate(names)}
+    array = np.array([(ids[better], ids[worse], significant, p) for better, worse, significant, p in records], dtype=PAIR_DTYPE)
+    header = "\t".join(names).encode("utf8")
+    return len(header).to_bytes(4, "little") + header + array.tobytes()
+
+
+def decode_pair_records(data):
+    header_length = int.from_bytes(data[:4], "little")
+    names = data[4:4 + header_length].decode("utf8").split("\t")
+    array = np.frombuffer(data[4 + header_length:], dtype=PAIR_DTYPE)
+    return [(names[better], names[worse], bool(significant), float(p)) for better, worse, significant, p in array]
+
+
+def encode_contrasts(differences, p_values):
+    return encode_pair_records([(a, b, (a, b) in differences, p) for (a, b), p in p_values.items()])
+
+
+def decode_contrasts(data):
+    differences = set()
+    p_values = {}
+    for better, worse, significant, p_value in decode_pair_records(data):
+        if significant:
+            differences.add((better, worse))
+        p_values[better, worse] = p_value
+    return differences, p_values
+
+
+class ResultCache:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._size = None
+
+    def __reduce__(self):
+        # Worker processes recount the directory size themselves, once: all
+        # tasks a worker receives share one cache per directory
+        return (_process_cache, (str(self.path), self.max_bytes))
+
+    def _entry_path(self, key):
+        return self.path / key[:2] / key
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._entry_path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        # Write and rename, so concurrent readers never see partial entries
+        handle, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data)
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        result = []
+        for directory in self.path.iterdir():
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, entry.path))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = 0
+
+    def get_array(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        return decode_array(data)
+
+    def put_array(self, key, array):
+        self.put(key, encode_array(array))
+
+    def get_contrasts(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        return decode_contrasts(data)
+
+    def put_contrasts(self, key, differences, p_values):
+        self.put(key, encode_contrasts(differences, p_values))
+
+
+_process_caches = {}
+
+
+def _process_cache(path, max_bytes):
+    key = (path, max_bytes)
+    if key not in _process_caches:
+        _process_caches[key] = ResultCache(path, max_bytes)
+    return _process_caches[key]
+
+
+def get_cache(cache):
+    # Accepts None, a directory or an existing cache
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(cache)
+
+
+def cached_sample_replicates(model, design, replicate_seeds, cache=None):
+    cache = get_cache(cache)
+    seeds = seed_key(list(replicate_seeds))
+    if cache is None or seeds is None:
+        return model.sample_replicates(design, replicate_seeds)
+
+    key = hash_key("sample_replicates", model_key(model), design_key(design), seeds)
+    samples = cache.get_array(key)
+    if samples is None:
+        samples = model.sample_replicates(design, replicate_seeds)
+        cache.put_array(key, samples)
+    return samples
@@ -0,0 +1,467 @@
+import itertools as it
+
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
+import scipy.special
+import scipy.stats
+
+
+# In-process replacement for the clmm fits in scripts/r/analyse-ordinal.r.
+# The model is the same cumulative logit model
+#
+#   logit P(score <= k) = threshold_k - coefficient_system - z' b_annotator [- z' b_document]
+#
+# with treatment coded random slopes per system. Random effects are integrated
+# out with a Laplace approximation, the covariance of the coefficients is taken
+# from the joint Hessian of thresholds, coefficients and random effects at the
+# conditional mode.
+
+
+class ClmmFit:
+    def __init__(self, systems, thresholds, coefficients, covariances, coefficient_covariance, loglik):
+        self.systems = list(systems)
+        self.thresholds = thresholds
+        self.coefficients = coefficients
+        self.covariances = covariances
+        self.coefficient_covariance = coefficient_covariance
+        self.loglik = loglik
+
+    def to_model(self):
+        from .ordinal import OrdinalModel
+        return OrdinalModel(
+            self.systems,
+            self.coefficients,
+            self.thresholds,
+            self.covariances[0],
+            self.covariances[1] if len(self.covariances) > 1 else None
+        )
+
+    def pairwise_contrasts(self, adjust="tukey"):
+        results = []
+        n_systems = len(self.systems)
+        for idx_a, idx_b in it.combinations(range(n_systems), 2):
+            contrast = np.zeros(n_systems)
+            contrast[idx_a] = 1.
+            contrast[idx_b] = -1.
+
+            estimate = contrast @ self.coefficients
+            std_err = np.sqrt(contrast @ self.coefficient_covariance @ contrast)
+            z = estimate / std_err
+
+            if adjust == "tukey":
+                p_value = scipy.stats.studentized_range.sf(abs(z) * np.sqrt(2), n_systems, np.inf)
+            elif adjust == "none":
+                p_value = 2 * scipy.stats.norm.sf(abs(z))
+            else:
+                raise ValueError(f"Unsupported p-value adjustment {adjust}")
+
+            results.append((self.systems[idx_a], self.systems[idx_b], estimate, std_err, p_value))
+
+        return results
+
+
+class _Factorization:
+    def __init__(self, random_effects, blocks, design_matrices, weights):
+        # Hessian of the penalized likelihood in the random effects, which is
+        # block diagonal within each grouping factor. With two crossed factors
+        # the first factor is eliminated blockwise and only the Schur
+        # complement of the second factor is factorized densely.
+        self.random_effects = random_effects
+        self.n_systems = random_effects.n_systems
+
+        first_chol = np.linalg.cholesky(blocks[0])
+        self.logdet = 2 * np.log(np.diagonal(first_chol, axis1=1, axis2=2)).sum()
+        self.first_inv = np.linalg.inv(blocks[0])
+        self.n_first = self.first_inv.shape[0] * self.n_systems
+
+        self.cross = None
+        if len(blocks) == 1:
+            return
+
+        first_design, second_design = design_matrices
+        self.cross = (first_design.T @ scipy.sparse.diags(weights) @ second_design).toarray()
+        self.first_inv_cross = self.first_solve(self.cross)
+
+        schur = -self.cross.T @ self.first_inv_cross
+        block_index = np.arange(len(blocks[1])).reshape(-1, 1, 1) * self.n_systems
+        block_range = np.arange(self.n_systems)
+        schur[block_index + block_range.reshape(-1, 1), block_index + block_range] += blocks[1]
+
+        self.schur_chol = scipy.linalg.cho_factor(schur, lower=True)
+        self.logdet += 2 * np.log(np.diag(self.schur_chol[0])).sum()
+
+    def first_solve(self, r):
+        return (self.first_inv @ r.reshape(len(self.first_inv), self.n_systems, -1)).reshape(r.shape)
+
+    def solve(self, r):
+        if self.cross is None:
+            return self.first_solve(r)
+
+        first_r = self.first_solve(r[:self.n_first])
+        second = scipy.linalg.cho_solve(self.schur_chol, r[self.n_first:] - self.cross.T @ first_r)
+        first = first_r - self.first_inv_cross @ second
+        return np.concatenate((first, second))
+
+    def inverse_rows(self, values):
+        # Rows of the inverse Hessian times the random effect design, restricted
+        # to the groups each observation belongs to
+        groups = self.random_effects.groups
+        first_values = values[0]
+
+        if self.cross is None:
+            return [np.einsum("ikl,il->ik", self.first_inv[groups[0]], first_values)]
+
+        second_values = values[1]
+        n_second = self.cross.shape[1] // self.n_systems
+        schur_inv = scipy.linalg.cho_solve(self.schur_chol, np.eye(self.cross.shape[1]))
+        first_inv_cross = self.first_inv_cross.reshape(-1, self.n_systems, self.cross.shape[1])
+        off_diagonal = -(self.first_inv_cross @ schur_inv).reshape(-1, self.n_systems, self.cross.shape[1])
+
+        first_blocks = self.first_inv - np.einsum("gkn,gln->gkl", off_diagonal, first_inv_cross)
+        second_blocks = schur_inv.reshape(n_second, self.n_systems, n_second, self.n_systems)
+        second_blocks = second_blocks[np.arange(n_second), :, np.arange(n_second), :]
+        cross_blocks = off_diagonal.reshape(-1, self.n_systems, n_second, self.n_systems)[groups[0], :, groups[1], :]
+
+        first = np.einsum("ikl,il->ik", first_blocks[groups[0]], first_values) + np.einsum("ikl,il->ik", cross_blocks, second_values)
+        second = np.einsum("ilk,il->ik", cross_blocks, first_values) + np.einsum("ikl,il->ik", second_blocks[groups[1]], second_values)
+        return [first, second]
+
+
+class _RandomEffects:
+    def __init__(self, groups, n_systems):
+        self.n_obs = len(groups[0])
+        self.n_systems = n_systems
+        self.groups = groups
+        self.sizes = [np.max(g) + 1 for g in groups]
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes) * n_systems))
+        self.n_random = self.offsets[-1]
+
+        self.indicators = [
+            scipy.sparse.csr_matrix((np.ones(self.n_obs), (g, np.arange(self.n_obs))), shape=(size, self.n_obs))
+            for g, size in zip(groups, self.sizes)
+        ]
+        self.rows = np.repeat(np.arange(self.n_obs), n_systems)
+        self.cols = [(g.reshape(-1, 1) * n_systems + np.arange(n_systems)).ravel() for g in groups]
+
+    def split(self, u):
+        return [u[start:end].reshape(-1, self.n_systems) for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def design_matrices(self, values):
+        return [
+            scipy.sparse.csr_matrix((v.ravel(), (self.rows, cols)), shape=(self.n_obs, size * self.n_systems))
+            for v, cols, size in zip(values, self.cols, self.sizes)
+        ]
+
+    def linear_predictor(self, values, u):
+        return sum(np.einsum("ik,ik->i", v, u_f[g]) for v, u_f, g in zip(values, self.split(u), self.groups))
+
+    def transpose_product(self, values, r):
+        return np.concatenate([(ind @ (v * r.reshape(-1, 1))).ravel() for v, ind in zip(values, self.indicators)])
+
+    def factorize(self, values, weights):
+        blocks = []
+        for v, ind in zip(values, self.indicators):
+            outer = (v[:, :, np.newaxis] * v[:, np.newaxis, :] * weights.reshape(-1, 1, 1)).reshape(self.n_obs, -1)
+            block = (ind @ outer).reshape(-1, self.n_systems, self.n_systems)
+            blocks.append(block + np.eye(self.n_systems))
+
+        design_matrices = None
+        if len(blocks) > 1:
+            design_matrices = self.design_matrices(values)
+
+        return _Factorization(self, blocks, design_matrices, weights)
+
+
+class _ObservationTerms:
+    def __init__(self, thresholds, scores, eta):
+        # Derivatives of -log(F(upper) - F(lower)) with respect to the upper
+        # and lower bound of the latent interval of every observation
+        upper = np.append(thresholds, np.inf)[scores] - eta
+        lower = np.insert(thresholds, 0, -np.inf)[scores] - eta
+
+        cdf_upper = scipy.special.expit(upper)
+        cdf_lower = scipy.special.expit(lower)
+        self.prob = np.maximum(cdf_upper - cdf_lower, 1e-300)
+
+        pdf_upper = cdf_upper * (1 - cdf_upper)
+        pdf_lower = cdf_lower * (1 - cdf_lower)
+
+        p_u = pdf_upper / self.prob
+        p_l = -pdf_lower / self.prob
+        p_uu = pdf_upper * (1 - 2 * cdf_upper) / self.prob
+        p_ll = -pdf_lower * (1 - 2 * cdf_lower) / self.prob
+        p_uuu = pdf_upper * (1 - 6 * cdf_upper + 6 * cdf_upper ** 2) / self.prob
+        p_lll = -pdf_lower * (1 - 6 * cdf_lower + 6 * cdf_lower ** 2) / self.prob
+
+        self.grad_upper = -p_u
+        self.grad_lower = -p_l
+        self.hess_upper = -p_uu + p_u ** 2
+        self.hess_lower = -p_ll + p_l ** 2
+        self.hess_cross = p_u * p_l
+
+        third_upper = -p_uuu + 3 * p_u * p_uu - 2 * p_u ** 3
+        third_lower = -p_lll + 3 * p_l * p_ll - 2 * p_l ** 3
+        third_uul = p_uu * p_l - 2 * p_u ** 2 * p_l
+        third_ull = p_u * p_ll - 2 * p_u * p_l ** 2
+
+        # Derivatives of the curvature in the linear predictor
+        self.weight_upper = third_upper + 2 * third_uul + third_ull
+        self.weight_lower = third_uul + 2 * third_ull + third_lower
+
+    @property
+    def weights(self):
+        return self.hess_upper + 2 * self.hess_cross + self.hess_lower
+
+    @property
+    def eta_grad(self):
+        return -(self.grad_upper + self.grad_lower)
+
+
+class _LaplaceObjective:
+    def __init__(self, scores, systems, groups, n_levels, n_systems):
+        self.scores = scores
+        self.n_levels = n_levels
+        self.n_systems = n_systems
+        self.n_obs = len(scores)
+
+        self.slope_coding = np.eye(n_systems)
+        self.slope_coding[0, :] = 1.
+
+        self.systems = systems
+        self.fixed_design = scipy.sparse.csr_matrix(
+            (np.ones(np.sum(systems > 0)), (np.flatnonzero(systems > 0), systems[systems > 0] - 1)),
+            shape=(self.n_obs, n_systems - 1)
+        )
+
+        # Eliminating the factor with more levels first keeps the dense Schur
+        # complement small
+        self.order = sorted(range(len(groups)), key=lambda idx: -(np.max(groups[idx]) + 1))
+        self.random_effects = _RandomEffects([groups[idx] for idx in self.order], n_systems)
+        self.n_groups = len(groups)
+
+        self.n_cov_params = n_systems * (n_systems + 1) // 2
+        self.tril = np.tril_indices(n_systems)
+
+        self.mode = np.zeros(self.random_effects.n_random)
+
+    def unpack(self, params):
+        n_thresholds = self.n_levels - 1
+        thresholds = params[0] + np.concatenate(([0.], np.cumsum(np.exp(params[1:n_thresholds]))))
+        offset = n_thresholds
+        coefficients = np.concatenate(([0.], params[offset:offset + self.n_systems - 1]))
+        offset += self.n_systems - 1
+
+        factors = []
+        for _ in range(self.n_groups):
+            factor = np.zeros((self.n_systems, self.n_systems))
+            factor[self.tril] = params[offset:offset + self.n_cov_params]
+            factor[np.diag_indices(self.n_systems)] = np.exp(np.diag(factor))
+            factors.append(factor)
+            offset += self.n_cov_params
+
+        return thresholds, coefficients, factors
+
+    def initial_params(self):
+        counts = np.bincount(self.scores, minlength=self.n_levels)
+        cumulative = np.cumsum(counts)[:-1] / self.n_obs
+        thresholds = scipy.special.logit(cumulative)
+
+        cov_params = np.zeros(self.n_cov_params)
+        cov_params[np.arange(self.n_systems) * (np.arange(self.n_systems) + 3) // 2] = np.log(.5)
+
+        return np.concatenate((
+            [thresholds[0]], np.log(np.maximum(np.diff(thresholds), 1e-3)),
+            np.zeros(self.n_systems - 1),
+            np.tile(cov_params, self.n_groups)
+        ))
+
+    def random_values(self, factors):
+        return [(factors[idx].T @ self.slope_coding)[:, self.systems].T for idx in self.order]
+
+    def find_mode(self, thresholds, fixed_eta, values, start, max_iters=50, tol=1e-8):
+        def penalized_nll(u):
+            eta = fixed_eta + self.random_effects.linear_predictor(values, u)
+            prob = _ObservationTerms(thresholds, self.scores, eta).prob
+            return -np.log(prob).sum() + .5 * u @ u
+
+        u = start
+        current = penalized_nll(u)
+        for _ in range(max_iters):
+            eta = fixed_eta + self.random_effects.linear_predictor(values, u)
+            terms = _ObservationTerms(thresholds, self.scores, eta)
+
+            grad = self.random_effects.transpose_product(values, terms.eta_grad) + u
+            factorization = self.random_effects.factorize(values, terms.weights)
+            if np.max(np.abs(grad)) < tol:
+                break
+
+            step = factorization.solve(grad)
+            step_size = 1.
+            while True:
+                candidate = u - step_size * step
+                candidate_value = penalized_nll(candidate)
+                if candidate_value <= current or step_size < 1e-8:
+                    break
+                step_size /= 2
+
+            u = candidate
+            current = candidate_value
+
+        return u, current, terms, factorization
+
+    def __call__(self, params):
+        thresholds, coefficients, factors = self.unpack(params)
+        values = self.random_values(factors)
+        u, penalized_nll, terms, factorization = self.find_mode(thresholds, coefficients[self.systems], values, self.mode)
+        self.mode = u
+
+        value = penalized_nll + .5 * factorization.logdet
+
+        # Gradient of the Laplace approximation, including the dependence of
+        # the conditional mode and of the log determinant on the parameters
+        inverse_rows = factorization.inverse_rows(values)
+        leverages = sum(np.einsum("ik,ik->i", v, r) for v, r in zip(values, inverse_rows))
+
+        mode_sensitivity = factorization.solve(self.random_effects.transpose_product(values, -.5 * (terms.weight_upper + terms.weight_lower) * leverages))
+        mode_shift = self.random_effects.linear_predictor(values, mode_sensitivity)
+
+        upper_grad = terms.grad_upper + .5 * terms.weight_upper * leverages + (terms.hess_upper + terms.hess_cross) * mode_shift
+        lower_grad = terms.grad_lower + .5 * terms.weight_lower * leverages + (terms.hess_cross + terms.hess_lower) * mode_shift
+        eta_grad = -(upper_grad + lower_grad)
+
+        n_thresholds = self.n_levels - 1
+        has_upper = self.scores < n_thresholds
+        has_lower = self.scores > 0
+        threshold_grad = np.bincount(self.scores[has_upper], upper_grad[has_upper], minlength=n_thresholds) \
+            + np.bincount(self.scores[has_lower] - 1, lower_grad[has_lower], minlength=n_thresholds)
+        threshold_param_grad = np.concatenate(([threshold_grad.sum()], np.exp(params[1:n_thresholds]) * np.cumsum(threshold_grad[::-1])[::-1][1:]))
+
+        coefficient_grad = np.bincount(self.systems, eta_grad, minlength=self.n_systems)[1:]
+
+        factor_grads = [None] * self.n_groups
+        slope_values = self.slope_coding[:, self.systems]
+        for idx, group, u_f, s_f, r_f in zip(self.order, self.random_effects.groups, self.random_effects.split(u), self.random_effects.split(mode_sensitivity), inverse_rows):
+            sensitivity = terms.weights.reshape(-1, 1) * r_f - terms.eta_grad.reshape(-1, 1) * s_f[group] + eta_grad.reshape(-1, 1) * u_f[group]
+            factor_grad = slope_values @ sensitivity
+            factor_grad[np.diag_indices(self.n_systems)] *= np.diag(factors[idx])
+            factor_grads[idx] = factor_grad[self.tril]
+
+        return value, np.concatenate([threshold_param_grad, coefficient_grad] + factor_grads)
+
+    def update_mode(self, params):
+        thresholds, coefficients, factors = self.unpack(params)
+        self.mode = self.find_mode(thresholds, coefficients[self.systems], self.random_values(factors), self.mode)[0]
+
+    def coefficient_covariance(self, params):
+        thresholds, coefficients, factors = self.unpack(params)
+        random_design = scipy.sparse.hstack(self.random_effects.design_matrices(self.random_values(factors))).tocsr()
+        eta = coefficients[self.systems] + random_design @ self.mode
+        terms = _ObservationTerms(thresholds, self.scores, eta)
+        hess_upper, hess_lower, hess_cross = terms.hess_upper, terms.hess_lower, terms.hess_cross
+
+        n_thresholds = self.n_levels - 1
+        upper_design = scipy.sparse.csr_matrix(
+            (np.ones(np.sum(self.scores < n_thresholds)), (np.flatnonzero(self.scores < n_thresholds), self.scores[self.scores < n_thresholds])),
+            shape=(self.n_obs, n_thresholds)
+        )
+        lower_design = scipy.sparse.csr_matrix(
+            (np.ones(np.sum(self.scores > 0)), (np.flatnonzero(self.scores > 0), self.scores[self.scores > 0] - 1)),
+            shape=(self.n_obs, n_thresholds)
+        )
+
+        # Joint Hessian of the penalized negative log likelihood in
+        # (thresholds, coefficients, random effects)
+        eta_design = scipy.sparse.hstack((self.fixed_design, random_design)).tocsr()
+
+        def weighted(left, weights, right):
+            return left.T @ scipy.sparse.diags(weights) @ right
+
+        threshold_block = weighted(upper_design, hess_upper, upper_design) + weighted(lower_design, hess_lower, lower_design) \
+            + weighted(upper_design, hess_cross, lower_design) + weighted(lower_design, hess_cross, upper_design)
+        cross_block = -weighted(upper_design, hess_upper + hess_cross, eta_design) - weighted(lower_design, hess_cross + hess_lower, eta_design)
+        eta_block = weighted(eta_design, hess_upper + 2 * hess_cross + hess_lower, eta_design)
+        eta_block = eta_block + scipy.sparse.block_diag((scipy.sparse.csr_matrix((self.n_systems - 1, self.n_systems - 1)), scipy.sparse.identity(self.random_effects.n_random)))
+
+        hessian = scipy.sparse.bmat([[threshold_block, cross_block], [cross_block.T, eta_block]]).toarray()
+
+        n_fixed = n_thresholds + self.n_systems - 1
+        schur = hessian[:n_fixed, :n_fixed] - hessian[:n_fixed, n_fixed:] @ np.linalg.solve(hessian[n_fixed:, n_fixed:], hessian[n_fixed:, :n_fixed])
+        fixed_covariance = np.linalg.inv(schur)
+
+        covariance = np.zeros((self.n_systems, self.n_systems))
+        covariance[1:, 1:] = fixed_covariance[n_thresholds:, n_thresholds:]
+        return covariance
+
+
+def fit_clmm(scores, systems, groups, system_names=None):
+    scores = np.asarray(scores)
+    levels, score_codes = np.unique(scores, return_inverse=True)
+    system_codes = np.asarray(systems)
+    groups = [np.asarray(g) for g in groups]
+
+    n_systems = np.max(system_codes) + 1
+    if system_names is None:
+        system_names = list(range(n_systems))
+
+    objective = _LaplaceObjective(score_codes, system_codes, groups, len(levels), n_systems)
+
+    params = objective.initial_params()
+    for _ in range(10):
+        result = scipy.optimize.minimize(objective, params, method="L-BFGS-B", jac=True)
+        converged = np.max(np.abs(result.x - params)) < 1e-4
+        params = result.x
+        objective.update_mode(params)
+        if converged:
+            break
+
+    thresholds, coefficients, factors = objective.unpack(params)
+    coefficient_covariance = objective.coefficient_covariance(params)
+
+    return ClmmFit(
+        system_names,
+        thresholds,
+        coefficients,
+        [f @ f.T for f in factors],
+        coefficient_covariance,
+        -result.fun
+    )
+
+
+def encode(values, key=None):
+    levels = sorted(set(values), key=key)
+    lookup = {level: idx for idx, level in enumerate(levels)}
+    return levels, np.array([lookup[v] for v in values])
+
+
+def analyse(df, score_name="score", mode="crossed"):
+    mode_info = mode.split(":")
+    adjust = "tukey"
+    if len(mode_info) > 1:
+        adjust = mode_info[1]
+
+    data = df.reset_index()
+    scores = data[score_name].to_numpy()
+    if score_name == "rank":
+        scores = -scores
+
+    # Order systems the way R orders factor levels, so that the reference level
+    # and the direction of the contrasts agree with analyse-ordinal.r
+    system_names, systems = encode(data["system"], key=str.casefold)
+    groups = [encode(data["annotator"])[1]]
+    if mode_info[0] == "crossed":
+        groups.append(encode(data["document"])[1])
+
+    fit = fit_clmm(scores, systems, groups, system_names)
+
+    lines = []
+    for sys_a, sys_b, estimate, _, p_value in fit.pairwise_contrasts(adjust):
+        sign = "o"
+        if p_value < 0.05:
+            sign = "+"
+            if estimate < 0.:
+                sign = "-"
+        lines.append(f"{sys_a} - {sys_b}\t{sign}\t{p_value:.7g}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+import argparse
+import itertools as it
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import broadcast
+from . import ordinal
+from . import power
+from .design import as_design
+from .powerstore import PowerStore
+from .seeding import get_rng, get_seed_sequence, child_seeds
+from .sweep import parse_designs
+
+
+# Power estimation with common random numbers. Per replicate, the random
+# effects of the j-th annotator and the k-th document of block b and the
+# uniform variates of their judgements are drawn once for the largest
+# design, and every design takes the numbers of the blocks, annotators and
+# documents it has. Growing a design only adds judgements, the ones it
+# already had stay the same, so the power estimates of neighbouring designs
+# are strongly correlated and power curves are smooth with far fewer
+# replicates than independent simulations need.
+
+
+def block_positions(design):
+    # Block of every annotator and document and their position in the block,
+    # annotators and documents are numbered consecutively within blocks
+    design = as_design(design)
+    blocks = design.blocks
+
+    def positions(ids, n_ids):
+        id_blocks = np.zeros(n_ids, dtype=np.int64)
+        id_blocks[ids] = blocks
+        firsts = np.full(design.n_blocks, n_ids, dtype=np.int64)
+        np.minimum.at(firsts, blocks, ids)
+        return id_blocks, np.arange(n_ids) - firsts[id_blocks]
+
+    annotator_blocks, annotator_positions = positions(design.annotators, design.n_annotators)
+    document_blocks, document_positions = positions(design.documents, design.n_documents)
+    return annotator_blocks, annotator_positions, document_blocks, document_positions
+
+
+class CommonRandomNumbers:
+    def __init__(self, n_systems, n_blocks, n_annotators, n_documents, rng=None):
+        # Numbers for n_blocks blocks of up to n_annotators annotators and
+        # n_documents documents
+        rng = get_rng(rng)
+        self.annotator_normals = rng.standard_normal((n_blocks, n_annotators, n_systems))
+        self.document_normals = rng.standard_normal((n_blocks, n_documents, n_systems))
+        self.uniforms = rng.uniform(size=(n_blocks, n_annotators, n_documents, n_systems))
+
+    @classmethod
+    def for_designs(cls, n_systems, designs, rng=None):
+        n_blocks, n_annotators, n_documents = 0, 0, 0
+        for design in designs:
+            _, annotator_positions, _, document_positions = block_positions(design)
+            n_blocks = max(n_blocks, as_design(design).n_blocks)
+            n_annotators = max(n_annotators, int(annotator_positions.max()) + 1)
+            n_documents = max(n_documents, int(document_positions.max()) + 1)
+        return cls(n_systems, n_blocks, n_annotators, n_documents, rng)
+
+    def variates(self, design):
+        # Variates in the layout of OrdinalModel.draw_variates for one replicate
+        design = as_design(design)
+        annotator_blocks, annotator_positions, document_blocks, document_positions = block_positions(design)
+
+        annotator_normals = self.annotator_normals[annotator_blocks, annotator_positions]
+        document_normals = self.document_normals[document_blocks, document_positions]
+        uniforms = self.uniforms[
+            design.blocks,
+            annotator_positions[design.annotators],
+            document_positions[design.documents]
+        ]
+        return annotator_normals[np.newaxis], document_normals[np.newaxis], uniforms.T[np.newaxis, ..., np.newaxis]
+
+
+def sample_designs(model, designs, rng=None):
+    # One sample per design, all drawn from the same random numbers
+    designs = [as_design(design) for design in designs]
+    numbers = CommonRandomNumbers.for_designs(len(model.systems), designs, rng)
+    return [model.scores_from_variates(design, *numbers.variates(design))[0] for design in designs]
+
+
+def regress_on_replicate(args):
+    model, designs, replicate, parent_seed, backend = args
+    design_objects = [ordinal.create_design(*design) for design in designs]
+    samples = sample_designs(model, design_objects, child_seeds(parent_seed, replicate, replicate + 1)[0])
+
+    rows = []
+    for (n_blocks, n_docs, n_annotators), design, sample in zip(designs, design_objects, samples):
+        _, p_values = power.run_regression(model.to_frame(design, sample), nested=n_annotators == 1, backend=backend)
+
+        if len(p_values) == 0:
+            p_values = {pair: 1.0 for pair in it.combinations(model.systems, 2)}
+
+        for (left_system, right_system), p_val in p_values.items():
+            rows.append((n_blocks, n_docs, n_annotators, replicate, left_system, right_system, p_val))
+    return rows
+
+
+def regress_on_shared_replicate(args):
+    # Model and designs come from the broadcast the pool was started with
+    model, _, metadata = broadcast.get_worker_state()
+    return regress_on_replicate((model, metadata["designs"]) + args)
+
+
+def test_designs_power(model, designs, num_iters=100, backend="rscript", seed=None, workers=None):
+    # Designs are (blocks, docs, annotators), returns one row per design,
+    # replicate and system pair
+    designs = list(dict.fromkeys(map(tuple, designs)))
+    columns = ["blocks", "docs", "annotators", "replicate", "better", "worse", "p_value"]
+    if len(designs) == 0:
+        return pd.DataFrame([], columns=columns)
+    parent_seed = get_seed_sequence(seed)
+
+    # The model is published to the process pool once, the designs are a few
+    # tuples and travel in the metadata of the broadcast
+    shared = None
+    if backend in power.PROCESS_BACKENDS:
+        shared = broadcast.publish_model(model, ordinal.create_design(*designs[0]), designs=designs)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=broadcast.initialize_model_worker, initargs=(shared.descriptor,))
+        results = executor.map(regress_on_shared_replicate, [(replicate, parent_seed, backend) for replicate in range(num_iters)])
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        results = executor.map(regress_on_replicate, [(model, designs, replicate, parent_seed, backend) for replicate in range(num_iters)])
+
+    rows = []
+    try:
+        with executor:
+            for idx, replicate_rows in enumerate(results):
+                print(f"{idx + 1}/{num_iters}")
+                rows.extend(replicate_rows)
+    finally:
+        if shared is not None:
+            shared.close()
+
+    return pd.DataFrame(rows, columns=columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_file")
+    parser.add_argument("out_file")
+
+    parser.add_argument("-g", dest="grids", action="append", default=[], help="blocks:docs:annotators, each a comma separated list of values or ranges, e.g. 1-20:5:3")
+    parser.add_argument("-i", dest="num_iters", default=100, type=int)
+    parser.add_argument("-j", dest="workers", default=None, type=int)
+    parser.add_argument("-z", dest="zero_coefficients", default=False, action="store_true")
+    parser.add_argument("--backend", dest="backend", choices=sorted(power.BACKENDS), default="rscript")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+    parser.add_argument("--store", dest="store", default=None, help="also append the p-values to this power store")
+
+    args = parser.parse_args()
+
+    model = ordinal.OrdinalModel.from_file(args.model_file)
+    if args.zero_coefficients:
+        model.zero_coefficients()
+
+    designs = [d for grid in args.grids for d in parse_designs(grid)]
+    result = test_designs_power(model, designs, num_iters=args.num_iters, backend=args.backend, seed=args.seed, workers=args.workers)
+    result.to_csv(args.out_file, index=False)
+
+    if args.store is not None:
+        store = PowerStore(args.store)
+        for design, design_rows in result.groupby(["blocks", "docs", "annotators"]):
+            store.append(Path(args.model_file).stem, design, design_rows["better"], design_rows["worse"], design_rows["p_value"], design_rows["replicate"], source=str(Path(args.out_file).resolve()))
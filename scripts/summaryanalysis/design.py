@@ -0,0 +1,146 @@
+import functools
+from collections import defaultdict
+
+import numpy as np
+
+
+# A design lists which annotator judges which document. Observations are
+# ordered block by block and within a block annotator by annotator, like the
+# lists create_design used to build. Designs unpack as (annotators,
+# documents), so they can be used wherever such a tuple was expected.
+
+
+class Design:
+    def __init__(self, annotators, documents, blocks=None, key=None):
+        self.annotators = _frozen(annotators)
+        self.documents = _frozen(documents)
+        if blocks is not None:
+            self.blocks = _frozen(blocks)
+        if key is None:
+            key = ("arrays", self.annotators.tobytes(), self.documents.tobytes())
+        self.key = key
+
+        self.n_observations = len(self.annotators)
+        self.n_annotators = int(self.annotators.max()) + 1 if self.n_observations > 0 else 0
+        self.n_documents = int(self.documents.max()) + 1 if self.n_observations > 0 else 0
+
+    @classmethod
+    def from_blocks(cls, block_sizes, block_annotator_counts):
+        # Block b has block_sizes[b] documents that are each judged by the
+        # same block_annotator_counts[b] annotators
+        block_sizes = np.asarray(block_sizes, dtype=np.int64)
+        block_annotator_counts = np.broadcast_to(np.asarray(block_annotator_counts, dtype=np.int64), block_sizes.shape)
+
+        observation_counts = block_sizes * block_annotator_counts
+        blocks = np.repeat(np.arange(len(block_sizes)), observation_counts)
+        positions = np.arange(observation_counts.sum()) - np.repeat(np.cumsum(observation_counts) - observation_counts, observation_counts)
+
+        annotator_starts = np.cumsum(block_annotator_counts) - block_annotator_counts
+        document_starts = np.cumsum(block_sizes) - block_sizes
+        annotators = annotator_starts[blocks] + positions // block_sizes[blocks]
+        documents = document_starts[blocks] + positions % block_sizes[blocks]
+
+        key = ("blocks", tuple(map(int, block_sizes)), tuple(map(int, block_annotator_counts)))
+        return cls(annotators, documents, blocks, key)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def balanced(cls, block_count, block_size, block_annotator_count):
+        return cls.from_blocks([block_size] * block_count, block_annotator_count)
+
+    @classmethod
+    def fixed_budget(cls, budget, block_count, block_annotator_count):
+        # Spreads budget documents as evenly as possible over the blocks
+        block_sizes = np.full(block_count, budget // block_count)
+        block_sizes[:budget % block_count] += 1
+        return cls.from_blocks(block_sizes, block_annotator_count)
+
+    def __iter__(self):
+        return iter((self.annotators, self.documents))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, idx):
+        return (self.annotators, self.documents)[idx]
+
+    def __eq__(self, other):
+        return isinstance(other, Design) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Design({self.n_blocks} blocks, {self.n_documents} documents, {self.n_annotators} annotators)"
+
+    @functools.cached_property
+    def blocks(self):
+        # Only computed for designs that were not built from blocks
+        return _read_only(_blocks_from_documents(self.annotators, self.documents))
+
+    @property
+    def n_blocks(self):
+        return int(self.blocks.max()) + 1 if self.n_observations > 0 else 0
+
+    @functools.cached_property
+    def annotator_incidence(self):
+        # (observations, annotators)
+        return _incidence(self.annotators, self.n_annotators)
+
+    @functools.cached_property
+    def document_incidence(self):
+        # (observations, documents)
+        return _incidence(self.documents, self.n_documents)
+
+    @functools.cached_property
+    def block_incidence(self):
+        # (observations, blocks)
+        return _incidence(self.blocks, self.n_blocks)
+
+    @property
+    def groups(self):
+        # All annotators of a block judge the same documents, so blocks are
+        # the annotator groups of get_annotator_groups
+        return self.blocks
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def _frozen(values):
+    # Read-only int64 arrays, e.g. memory-mapped ones, are used without a copy
+    if isinstance(values, np.ndarray) and values.dtype == np.int64 and not values.flags.writeable:
+        return values
+    return _read_only(np.array(values, dtype=np.int64))
+
+
+def _incidence(codes, n_columns):
+    # scipy is only loaded when an incidence matrix is needed, the sampling
+    # code itself only depends on NumPy
+    import scipy.sparse
+    return scipy.sparse.csr_matrix((np.ones(len(codes)), (np.arange(len(codes)), codes)), shape=(len(codes), n_columns))
+
+
+def _blocks_from_documents(annotators, documents):
+    # Annotators with the same set of documents form a block, numbered in order
+    # of their first annotator
+    annotator_documents = defaultdict(set)
+    for annotator, document in zip(annotators, documents):
+        annotator_documents[annotator].add(document)
+
+    block_ids = {}
+    annotator_blocks = {}
+    for annotator in sorted(annotator_documents):
+        docs = tuple(sorted(annotator_documents[annotator]))
+        annotator_blocks[annotator] = block_ids.setdefault(docs, len(block_ids))
+
+    return np.array([annotator_blocks[a] for a in annotators], dtype=np.int64)
+
+
+def as_design(design):
+    if isinstance(design, Design):
+        return design
+    annotators, documents = design
+    return Design(annotators, documents)
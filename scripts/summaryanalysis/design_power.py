@@ -1,55 +1,150 @@
 import argparse
 
-import pandas as pd
 import numpy as np
 
 from . import ordinal
 from . import power
+from . import cache as result_cache
+from . import broadcast
+from . import asyncdispatch
+from . import telemetry
+from .design import as_design
+from .seeding import get_seed_sequence, child_seeds
+from .stopping import PowerTracker, INTERVALS
 
-from multiprocessing import Pool
 import itertools as it
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import contextlib
 import os
+from pathlib import Path
 
 
 def regress_on_sample(vals):
-    model, design, nested = vals
-    np.random.seed()
-    sample_df = model.sample(design)
-    diffs, p_values = power.run_regression(sample_df, nested=nested)
+    model, design, sample, nested, backend, cache = vals
+    with telemetry.timer("frame"):
+        sample_df = model.to_frame(design, sample)
+    diffs, p_values = power.run_regression(sample_df, nested=nested, backend=backend, cache=cache)
 
     return diffs, p_values
 
 
-def test_design_power(model, design, nested=False, num_iters=100):
+def regress_on_replicate(model, design, replicate, parent_seed, nested, backend, cache, cache_samples):
+    replicate_seeds = child_seeds(parent_seed, replicate, replicate + 1)
+    with telemetry.timer("sample"):
+        sample = result_cache.cached_sample_replicates(model, design, replicate_seeds, cache if cache_samples else None)[0]
+    return regress_on_sample((model, design, sample, nested, backend, cache))
+
+
+def regress_on_shared_replicate(args):
+    # Model and design were published to the pool once, tasks only carry the
+    # replicate and its seed
+    model, design, _ = broadcast.get_worker_state()
+    return telemetry.collect(regress_on_replicate, model, design, *args)
+
+
+def test_design_power(model, design, nested=False, num_iters=100, backend="rscript", seed=None, target_width=None, batch_size=20, interval="wilson", cache=None, workers=None, telemetry_file=None, start=0):
+    # With a target_width, num_iters is only an upper bound: replicates are
+    # run in batches until the power interval of every system pair is at
+    # most target_width wide. Replicate seeds do not depend on the batching,
+    # so a stopped run is a prefix of the full run, and it can be continued
+    # by running the replicates from start to num_iters.
+    # With a telemetry_file, a summary of where the time went is appended to
+    # it as one JSON line.
     results = []
     index = []
     idx = 0
 
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        for diffs, p_values in executor.map(regress_on_sample, [(model, design, nested)] * num_iters):
-    #with Pool() as pool:
-    #    for diffs, p_values in pool.imap_unordered(regress_on_sample, [(model, design, nested)] * num_iters):
-            idx += 1
-            print(f"{idx}/{num_iters}")
-            for (left_system, right_system), p_val in p_values.items():
-                results.append(p_val)
-                index.append((left_system, right_system))
-
-            if len(p_values) == 0:
-                for sys_1, sys_2 in it.combinations(model.systems, 2):
-                    results.append(1.0)
-                    index.append((sys_1, sys_2))
-
+    design = as_design(design)
+    cache = result_cache.get_cache(cache)
+    parent_seed = get_seed_sequence(seed)
+    tracker = PowerTracker()
+    step = num_iters if target_width is None else batch_size
+
+    # Unseeded runs never draw the same samples twice
+    task_args = (parent_seed, nested, backend, cache, seed is not None)
+
+    # Telemetry is only enabled for this run
+    shared = None
+    was_enabled = telemetry.enabled()
+    try:
+        design_telemetry = None
+        if telemetry_file is not None:
+            telemetry.enable()
+            telemetry.drain()
+            design_telemetry = telemetry.DesignTelemetry(design=repr(design), n_observations=design.n_observations, backend=backend, workers=workers or os.cpu_count(), num_iters=num_iters)
+            design_telemetry.begin()
+
+        if backend in asyncdispatch.ANALYZERS:
+            # Samples are drawn in the event loop while the analyzers run
+            dispatcher = asyncdispatch.RegressionDispatcher.from_name(backend, workers, cache)
+
+            def sample_frames(replicates):
+                for replicate in replicates:
+                    replicate_seeds = child_seeds(parent_seed, replicate, replicate + 1)
+                    with telemetry.timer("sample"):
+                        sample = result_cache.cached_sample_replicates(model, design, replicate_seeds, cache if seed is not None else None)[0]
+                    with telemetry.timer("frame"):
+                        frame = model.to_frame(design, sample)
+                    yield frame
+
+            # Everything runs in this thread, its measurements are drained below
+            executor = contextlib.nullcontext()
+            run_replicates = lambda replicates: [(result, None) for result in dispatcher.run(sample_frames(replicates), nested)]
+        elif backend in power.PROCESS_BACKENDS:
+            shared = broadcast.publish_model(model, design)
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=broadcast.initialize_model_worker, initargs=(shared.descriptor,))
+            run_replicates = lambda replicates: executor.map(regress_on_shared_replicate, [(r,) + task_args for r in replicates])
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+            run_replicates = lambda replicates: executor.map(lambda r: telemetry.collect(regress_on_replicate, model, design, r, *task_args), replicates)
+
+        with executor:
+            for batch_start in range(start, num_iters, step):
+                for (diffs, p_values), measurements in run_replicates(range(batch_start, min(batch_start + step, num_iters))):
+                    idx += 1
+                    print(f"{start + idx}/{num_iters}")
+
+                    with telemetry.timer("aggregate"):
+                        telemetry.count("replicates")
+                        if len(p_values) == 0:
+                            # Failed fits print no contrasts
+                            telemetry.count("empty_fits")
+                            p_values = {pair: 1.0 for pair in it.combinations(model.systems, 2)}
+
+                        for (left_system, right_system), p_val in p_values.items():
+                            results.append(p_val)
+                            index.append((left_system, right_system))
+                        tracker.update(p_values)
+
+                    if design_telemetry is not None:
+                        design_telemetry.merge(measurements)
+
+                if target_width is not None and tracker.converged(target_width, interval):
+                    break
+
+        if design_telemetry is not None:
+            design_telemetry.merge(telemetry.drain())
+            telemetry.write_summary(telemetry_file, design_telemetry.summary())
+    finally:
+        if shared is not None:
+            shared.close()
+        if not was_enabled:
+            telemetry.disable()
+
+    # pandas is only needed for the result, workers never import it
+    import pandas as pd
     df = pd.DataFrame.from_dict({"p_value": results})
     df.index = pd.MultiIndex.from_tuples(index)
+    df.attrs["iterations"] = tracker.iterations
 
     return df
 
 
 if __name__ == "__main__":
+    from .powerstore import PowerStore
+
     parser = argparse.ArgumentParser()
     parser.add_argument("model_file")
     parser.add_argument("out_file")
@@ -59,6 +154,16 @@ if __name__ == "__main__":
     parser.add_argument("-a", dest="num_annotators", default=3, type=int)
     parser.add_argument("-z", dest="zero_coefficients", default=False, action="store_true")
     parser.add_argument("-n", dest="condition_nested", default=False, action="store_true")
+    parser.add_argument("--backend", dest="backend", choices=sorted(power.BACKENDS) + sorted(asyncdispatch.ANALYZERS), default="rscript")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+    parser.add_argument("-i", dest="num_iters", default=100, type=int)
+    parser.add_argument("-w", "--target-width", dest="target_width", default=None, type=float, help="stop once every power interval is at most this wide, -i is then the maximum number of iterations")
+    parser.add_argument("--batch-size", dest="batch_size", default=20, type=int)
+    parser.add_argument("--interval", dest="interval", choices=sorted(INTERVALS), default="wilson")
+    parser.add_argument("--cache", dest="cache", default=None, help="directory for cached samples and regression results")
+    parser.add_argument("--store", dest="store", default=None, help="also append the p-values to this power store")
+    parser.add_argument("-j", dest="workers", default=None, type=int)
+    parser.add_argument("--telemetry", dest="telemetry_file", default=None, help="append timings and counters of the run to this JSON lines file")
 
     args = parser.parse_args()
 
@@ -67,29 +172,10 @@ if __name__ == "__main__":
     if args.zero_coefficients:
         model.zero_coefficients()
 
-    analysis_result = test_design_power(model, ordinal.create_design(args.num_blocks, args.num_docs, args.num_annotators), nested=args.num_annotators == 1)
+    analysis_result = test_design_power(model, ordinal.create_design(args.num_blocks, args.num_docs, args.num_annotators), nested=args.num_annotators == 1, backend=args.backend, seed=args.seed, num_iters=args.num_iters, target_width=args.target_width, batch_size=args.batch_size, interval=args.interval, cache=args.cache, workers=args.workers, telemetry_file=args.telemetry_file)
+    print(f"Used {analysis_result.attrs['iterations']} iterations")
     analysis_result.to_csv(args.out_file)
 
+    if args.store is not None:
+        PowerStore(args.store).append_frame(Path(args.model_file).stem, (args.num_blocks, args.num_docs, args.num_annotators), analysis_result, source=str(Path(args.out_file).resolve()))
 
-def old():
-    crossed_regression_results = []
-
-    for block_count in range(1, 21):
-        analysis_result = test_design_power(model, ordinal.create_design(block_count, 5, 3), nested=False)
-        crossed_regression_results.append(analysis_result)
-
-    result_df_crossed = pd.concat(crossed_regression_results, keys=[str(s * 3) for s in range(1, 21)], names=["annotator_count"])
-
-    nested_regression_results = []
-
-    for block_count in range(3, 61):
-        analysis_result = test_design_power(model, ordinal.create_design(block_count, 5, 1), nested=True)
-        nested_regression_results.append(analysis_result)
-
-    result_df_nested = pd.concat(nested_regression_results, keys=[str(s) for s in range(3, 61)], names=["annotator_count"])
-
-    result_df = pd.concat((result_df_crossed, result_df_nested), keys=["crossed", "nested"], names=["design"])
-
-    print(result_df.groupby(["design", "block_count"]).mean())
-
-    result_df.to_csv(args.out_file)
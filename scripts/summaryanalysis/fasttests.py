@@ -0,0 +1,260 @@
+import argparse
+import itertools as it
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from . import ordinal
+from .art import batched_paired_approximate_randomization_test
+from .design import as_design
+from .seeding import get_rng, spawn_seeds
+
+
+# Approximate significance tests that run on a whole batch of samples at
+# once. Every test takes scores of shape (replicates, systems, observations)
+# for the observations of a design and returns two-sided p-values of shape
+# (replicates, pairs) for the given system pairs. They are far cheaper than a
+# mixed model fit and are meant to screen designs before the regression
+# backends are run on the promising ones.
+
+
+TESTS = {}
+# Tests whose p-values depend on the generator they are given
+RANDOMIZED_TESTS = set()
+
+
+def register(name, randomized=False):
+    def add(test):
+        TESTS[name] = test
+        if randomized:
+            RANDOMIZED_TESTS.add(name)
+        return test
+    return add
+
+
+def system_pairs(n_systems):
+    sys_1, sys_2 = map(np.array, zip(*it.combinations(range(n_systems), 2)))
+    return sys_1, sys_2
+
+
+def pair_differences(scores, pairs):
+    sys_1, sys_2 = pairs
+    scores = np.asarray(scores, dtype=float)
+    return scores[:, sys_1] - scores[:, sys_2]
+
+
+def incidence_sums(values, incidence):
+    # Sums of the last axis of values per column of a sparse (observations,
+    # labels) incidence matrix
+    sums = values.reshape(-1, values.shape[-1]) @ incidence
+    return np.asarray(sums).reshape(values.shape[:-1] + (incidence.shape[1],))
+
+
+def incidence_means(values, incidence):
+    return incidence_sums(values, incidence) / np.asarray(incidence.sum(axis=0)).ravel()
+
+
+def t_pvalues(t, df):
+    p_values = 2 * scipy.stats.t.sf(np.abs(t), df)
+    # Constant differences carry no evidence, like an empty fit
+    return np.where(np.isfinite(t), p_values, 1.)
+
+
+def paired_t(differences):
+    n = differences.shape[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = differences.mean(axis=-1) / (differences.std(axis=-1, ddof=1) / np.sqrt(n))
+    return t_pvalues(t, n - 1)
+
+
+@register("ttest")
+def ttest(scores, design, pairs, rng=None):
+    return paired_t(pair_differences(scores, pairs))
+
+
+@register("ttest-agg")
+def ttest_aggregated(scores, design, pairs, rng=None):
+    # On the mean score of every document
+    design = as_design(design)
+    return paired_t(incidence_means(pair_differences(scores, pairs), design.document_incidence))
+
+
+@register("wilcoxon-agg")
+def wilcoxon_aggregated(scores, design, pairs, rng=None):
+    # Signed-rank test on document means with the normal approximation, zero
+    # differences are dropped and ties corrected for like scipy.stats.wilcoxon
+    design = as_design(design)
+    differences = incidence_means(pair_differences(scores, pairs), design.document_incidence)
+    magnitudes = np.abs(differences)
+
+    zeros = magnitudes == 0
+    n = (~zeros).sum(axis=-1)
+    # Zeros get the lowest ranks, so the ranks of the other differences are
+    # shifted by the number of zeros
+    ranks = scipy.stats.rankdata(magnitudes, axis=-1) - zeros.sum(axis=-1, keepdims=True)
+    tie_sizes = scipy.stats.rankdata(magnitudes, method="max", axis=-1) - scipy.stats.rankdata(magnitudes, method="min", axis=-1) + 1
+    tie_correction = np.where(zeros, 0., tie_sizes ** 2 - 1).sum(axis=-1)
+
+    positive_ranks = np.where(differences > 0, ranks, 0.).sum(axis=-1)
+    mean = n * (n + 1) / 4
+    variance = n * (n + 1) * (2 * n + 1) / 24 - tie_correction / 48
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (positive_ranks - mean) / np.sqrt(variance)
+    p_values = 2 * scipy.stats.norm.sf(np.abs(z))
+    return np.where(np.isfinite(z), p_values, 1.)
+
+
+def cluster_variance(residuals, incidence=None):
+    # Sandwich variance of the mean of the last axis with clusters given by a
+    # sparse incidence matrix (every observation its own cluster without
+    # one), with the usual G / (G - 1) small sample correction
+    n = residuals.shape[-1]
+    cluster_sums = residuals if incidence is None else incidence_sums(residuals, incidence)
+    n_clusters = cluster_sums.shape[-1]
+    return (cluster_sums ** 2).sum(axis=-1) / n ** 2 * n_clusters / max(n_clusters - 1, 1)
+
+
+def cluster_test(differences, variances, n_clusters):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = differences.mean(axis=-1) / np.sqrt(variances)
+    return t_pvalues(t, max(n_clusters - 1, 1))
+
+
+@register("cluster-annotator")
+def cluster_annotator(scores, design, pairs, rng=None):
+    # Mean score difference with standard errors clustered by annotator
+    design = as_design(design)
+    differences = pair_differences(scores, pairs)
+    residuals = differences - differences.mean(axis=-1, keepdims=True)
+    return cluster_test(differences, cluster_variance(residuals, design.annotator_incidence), design.n_annotators)
+
+
+@register("cluster-document")
+def cluster_document(scores, design, pairs, rng=None):
+    design = as_design(design)
+    differences = pair_differences(scores, pairs)
+    residuals = differences - differences.mean(axis=-1, keepdims=True)
+    return cluster_test(differences, cluster_variance(residuals, design.document_incidence), design.n_documents)
+
+
+@register("cluster-twoway")
+def cluster_twoway(scores, design, pairs, rng=None):
+    # Clustered by annotator and by document (Cameron, Gelbach and Miller):
+    # both one-way variances minus that of their intersection, which is the
+    # single observation. Falls back to the larger one-way variance where the
+    # difference is not positive.
+    design = as_design(design)
+    differences = pair_differences(scores, pairs)
+    residuals = differences - differences.mean(axis=-1, keepdims=True)
+
+    annotator_variance = cluster_variance(residuals, design.annotator_incidence)
+    document_variance = cluster_variance(residuals, design.document_incidence)
+    observation_variance = cluster_variance(residuals)
+    variances = annotator_variance + document_variance - observation_variance
+    variances = np.where(variances > 0, variances, np.maximum(annotator_variance, document_variance))
+    return cluster_test(differences, variances, min(design.n_annotators, design.n_documents))
+
+
+@register("permutation-group", randomized=True)
+def permutation_group(scores, design, pairs, rng=None, n=1000):
+    # Approximate randomization over annotator groups: the systems are
+    # swapped for all judgements of a group at once, which is ART on the group
+    # means as in montecarlo.get_art_pvals
+    design = as_design(design)
+    sys_1, sys_2 = pairs
+    group_means = incidence_means(np.asarray(scores, dtype=float), design.block_incidence)
+    samples_1 = group_means[:, sys_1].reshape(-1, group_means.shape[-1])
+    samples_2 = group_means[:, sys_2].reshape(-1, group_means.shape[-1])
+    p_values = batched_paired_approximate_randomization_test(samples_1, samples_2, n, rng=rng)
+    return p_values.reshape(len(group_means), len(sys_1))
+
+
+def run_test(test, scores, design, pairs=None, rng=None):
+    # Returns the p-values and the mean score differences of every replicate
+    # and pair, pairs default to all pairs of systems in order
+    if pairs is None:
+        pairs = system_pairs(np.shape(scores)[1])
+    if isinstance(test, str):
+        test = TESTS[test]
+    p_values = test(scores, design, pairs, rng=get_rng(rng))
+    return p_values, pair_differences(scores, pairs).mean(axis=-1)
+
+
+def test_design_power(model, design, test="cluster-twoway", num_iters=1000, seed=None, batch_size=200):
+    # Same output as design_power.test_design_power, pairs are ordered better
+    # first by their mean score difference
+    design = as_design(design)
+    sample_seed, test_seed = spawn_seeds(seed, 2)
+    sample_rng, test_rng = get_rng(sample_seed), get_rng(test_seed)
+    sys_1, sys_2 = system_pairs(len(model.systems))
+    systems = np.array(model.systems, dtype=object)
+
+    results = []
+    better = []
+    worse = []
+    for start in range(0, num_iters, batch_size):
+        scores = model.sample_batch(design, min(batch_size, num_iters - start), rng=sample_rng)
+        p_values, differences = run_test(test, scores, design, (sys_1, sys_2), rng=test_rng)
+        swapped = differences < 0
+        results.append(p_values.ravel())
+        better.append(np.where(swapped, systems[sys_2], systems[sys_1]).ravel())
+        worse.append(np.where(swapped, systems[sys_1], systems[sys_2]).ravel())
+
+    df = pd.DataFrame({"p_value": np.concatenate(results)})
+    df.index = pd.MultiIndex.from_arrays([np.concatenate(better), np.concatenate(worse)])
+    df.attrs["iterations"] = num_iters
+    return df
+
+
+def estimate_power(model, df, alpha=0.05):
+    # Share of replicates that find each difference of the model in the right
+    # direction, averaged over all pairs of systems with different
+    # coefficients
+    coefficients = dict(zip(model.systems, model.coefficients))
+    better, worse = (df.index.get_level_values(i) for i in range(2))
+    correct = np.array([coefficients[b] > coefficients[w] for b, w in zip(better, worse)])
+    n_pairs = sum(1 for a, b in it.combinations(model.coefficients, 2) if a != b)
+    n_replicates = df.attrs.get("iterations", len(df) // max(len(model.systems) * (len(model.systems) - 1) // 2, 1))
+    if n_pairs == 0:
+        return 0.
+    return float(np.sum(correct & (df["p_value"].to_numpy() < alpha)) / (n_pairs * n_replicates))
+
+
+def screen_designs(model, designs, test="cluster-twoway", num_iters=200, min_power=0.8, alpha=0.05, seed=None):
+    # Returns the designs (blocks, docs, annotators) whose power under the
+    # fast test is at least min_power and the estimated power of every design
+    powers = {}
+    for design, design_seed in zip(designs, spawn_seeds(seed, len(designs))):
+        df = test_design_power(model, ordinal.create_design(*design), test=test, num_iters=num_iters, seed=design_seed)
+        powers[tuple(design)] = estimate_power(model, df, alpha)
+    return [design for design in powers if powers[design] >= min_power], powers
+
+
+if __name__ == "__main__":
+    from .sweep import parse_designs
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_file")
+    parser.add_argument("out_file")
+
+    parser.add_argument("-g", dest="grids", action="append", default=[], help="blocks:docs:annotators, each a comma separated list of values or ranges, e.g. 1-20:5:3")
+    parser.add_argument("-t", "--test", dest="test", choices=sorted(TESTS), default="cluster-twoway")
+    parser.add_argument("-i", dest="num_iters", default=1000, type=int)
+    parser.add_argument("-z", dest="zero_coefficients", default=False, action="store_true")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+
+    args = parser.parse_args()
+
+    model = ordinal.OrdinalModel.from_file(args.model_file)
+    if args.zero_coefficients:
+        model.zero_coefficients()
+
+    designs = [d for grid in args.grids for d in parse_designs(grid)]
+    frames = []
+    for design, design_seed in zip(designs, spawn_seeds(args.seed, len(designs))):
+        df = test_design_power(model, ordinal.create_design(*design), test=args.test, num_iters=args.num_iters, seed=design_seed)
+        print(f"{design}: power {estimate_power(model, df):.3f}")
+        frames.append(df.rename_axis(["better", "worse"]).reset_index().assign(blocks=design[0], docs=design[1], annotators=design[2]))
+
+    pd.concat(frames)[["blocks", "docs", "annotators", "better", "worse", "p_value"]].to_csv(args.out_file, index=False)
@@ -1,9 +1,14 @@
+import numpy as np
 import pandas as pd
 import scipy.stats
 
 import summaryanalysis.ordinal as ordinal
-from summaryanalysis.art import paired_approximate_randomization_test
+from summaryanalysis.art import batched_paired_approximate_randomization_test
 from summaryanalysis.annotationutils import get_annotator_groups
+from summaryanalysis.seeding import get_rng, spawn_seeds
+from summaryanalysis.stopping import interval_width
+import summaryanalysis.cache as result_cache
+from summaryanalysis.powerstore import PowerStore, to_obspower_frame
 from pathlib import Path
 from tqdm.auto import tqdm
 import re
@@ -11,50 +16,157 @@ import itertools as it
 from collections import defaultdict, Counter
 
 
-def get_model_type1_error_rates(model, blocks):
+TYPE1_TESTS = ["ttest_no_agg", "ttest_agg", "art_no_agg", "art_agg"]
+TYPE1_ESTIMATORS = ["mc", "control-variate"]
+
+
+def get_model_type1_error_rates(model, blocks, seed=None, num_samples=1000, target_width=None, batch_size=100, interval="wilson", cache=None, estimator="mc"):
+    # Samples are drawn in batches of batch_size. With a target_width, they
+    # are only drawn until the confidence interval of every error rate is at
+    # most that wide (or num_samples is reached). The number of samples used
+    # per design is then reported under the additional "samples" key.
+    # The control-variate estimator corrects the rejection rates with the
+    # squared difference of the latent system means of every sample and pair,
+    # whose expectation is known from the model. Large latent differences go
+    # along with rejections, so the corrected rates need fewer samples.
     model = model.copy()
     model.zero_coefficients()
 
+    # Unseeded runs are never repeated exactly and are not cached
+    cache = result_cache.get_cache(cache) if seed is not None else None
+
     test_type_1_error_rates = defaultdict(list)
 
     tests = {
-        "ttest": lambda x, y: scipy.stats.ttest_rel(x, y).pvalue,
-        "art": paired_approximate_randomization_test
+        "ttest": lambda x, y: scipy.stats.ttest_rel(x, y, axis=1).pvalue,
+        "art": lambda x, y: batched_paired_approximate_randomization_test(x, y, rng=rng)
     }
 
-    for n_blocks, n_docs in tqdm(blocks):
+    for (n_blocks, n_docs), design_seed in zip(tqdm(blocks), spawn_seeds(seed, len(blocks))):
+        design = ordinal.create_design(n_blocks, n_docs, 3)
+
+        key = None
+        if cache is not None:
+            key_parts = [num_samples, target_width, batch_size, interval]
+            if estimator != "mc":
+                key_parts.append(estimator)
+            key = result_cache.hash_key(
+                "type1_error_rates", result_cache.model_key(model), result_cache.design_key(design), design_seed, *key_parts
+            )
+            counts = cache.get_array(key)
+            if counts is not None:
+                # Control-variate results are stored as rates
+                n_drawn, n_comb = counts[:2]
+                for name, value in zip(TYPE1_TESTS, counts[2:]):
+                    test_type_1_error_rates[name].append(value / n_comb if estimator == "mc" else float(value))
+                if target_width is not None:
+                    test_type_1_error_rates["samples"].append(int(n_drawn))
+                continue
+
         success_counts = Counter()
         n_comb = 0
+        n_drawn = 0
+        rng = get_rng(design_seed)
+
+        document_means = design.document_incidence.toarray()
+        document_means /= document_means.sum(axis=0)
+        sys_1, sys_2 = map(list, zip(*it.combinations(range(len(model.systems)), 2)))
+
+        # Sums of the centered controls and of their products with the
+        # rejection indicators
+        control_sums = Counter()
+        if estimator == "control-variate":
+            contrasts = np.eye(len(model.systems))[sys_1] - np.eye(len(model.systems))[sys_2]
+            control_variances = np.einsum("ij,jk,ik->i", contrasts, model.latent_mean_covariance(design), contrasts)
+
+        # Samples are drawn and tested in batches, also without a target
+        # width, so memory does not grow with num_samples
+        while n_drawn < num_samples:
+            # Same samples as sample_batch, the latent variables are only kept
+            # for the control variate
+            variates = model.draw_variates(design, min(batch_size, num_samples - n_drawn), rng=rng)
+            if estimator == "control-variate":
+                results, latent = model.scores_from_variates(design, *variates, return_latent=True)
+                latent_means = latent.mean(axis=-1)
+                controls = ((latent_means[:, sys_1] - latent_means[:, sys_2]) ** 2 / control_variances - 1).reshape(-1)
+                control_sums["control"] += controls.sum()
+                control_sums["control_squared"] += (controls ** 2).sum()
+            else:
+                results = model.scores_from_variates(design, *variates)
+            n_drawn += len(results)
+            aggregated_results = results @ document_means
+
+            # Every (sample, system pair) combination is one row
+            results_1 = results[:, sys_1].reshape(-1, results.shape[-1])
+            results_2 = results[:, sys_2].reshape(-1, results.shape[-1])
+            aggregated_results_1 = aggregated_results[:, sys_1].reshape(-1, aggregated_results.shape[-1])
+            aggregated_results_2 = aggregated_results[:, sys_2].reshape(-1, aggregated_results.shape[-1])
+            n_comb += len(results_1)
+
+            for name, test in tests.items():
+                p_values_no_agg = test(results_1, results_2)
+                p_values_agg = test(aggregated_results_1, aggregated_results_2)
+
+                success_counts[name + "_no_agg"] += np.sum(p_values_no_agg < 0.05)
+                success_counts[name + "_agg"] += np.sum(p_values_agg < 0.05)
+                if estimator == "control-variate":
+                    control_sums[name + "_no_agg"] += controls @ (p_values_no_agg < 0.05)
+                    control_sums[name + "_agg"] += controls @ (p_values_agg < 0.05)
+
+            if target_width is not None:
+                widths = interval_width([success_counts[name] for name in TYPE1_TESTS], n_comb, interval)
+                if estimator == "control-variate":
+                    # The corrected estimate has the residual variance of the
+                    # regression on the control
+                    widths = widths * np.sqrt([
+                        control_variate_variance_ratio(success_counts[name], control_sums[name], control_sums["control"], control_sums["control_squared"], n_comb)
+                        for name in TYPE1_TESTS
+                    ])
+                if max(widths) <= target_width:
+                    break
+
+        rates = [success_counts[name] / n_comb for name in TYPE1_TESTS]
+        if estimator == "control-variate":
+            rates = [control_variate_estimate(success_counts[name], control_sums[name], control_sums["control"], control_sums["control_squared"], n_comb) for name in TYPE1_TESTS]
+
+        for name, rate in zip(TYPE1_TESTS, rates):
+            test_type_1_error_rates[name].append(rate)
+
+        if key is not None:
+            if estimator == "mc":
+                cache.put_array(key, np.array([n_drawn, n_comb] + [success_counts[name] for name in TYPE1_TESTS], dtype=np.int64))
+            else:
+                cache.put_array(key, np.array([n_drawn, n_comb] + rates, dtype=np.float64))
+
+        if target_width is not None:
+            test_type_1_error_rates["samples"].append(n_drawn)
 
-        for _ in tqdm(range(1000)):
-            results = model.sample(ordinal.create_design(n_blocks, n_docs, 3))
-
-            aggregated_results = results.groupby(["system", "document"]).mean()
-
-            pairs = list(it.combinations(results.index.unique("system"), 2))
-
-            for sys_1, sys_2 in pairs:
-                sys_1_results_no_agg = results.xs(sys_1, level="system").to_numpy()
-                sys_1_results_agg = aggregated_results.xs(sys_1, level="system").to_numpy()
-
-                sys_2_results_no_agg = results.xs(sys_2, level="system").to_numpy()
-                sys_2_results_agg = aggregated_results.xs(sys_2, level="system").to_numpy()
-
-                for name, test in tests.items():
-                    p_value_no_agg = test(sys_1_results_no_agg, sys_2_results_no_agg)
-                    p_value_agg = test(sys_1_results_agg, sys_2_results_agg)
+    return test_type_1_error_rates
 
-                    if p_value_no_agg < 0.05:
-                        success_counts[name + "_no_agg"] += 1
-                    if p_value_agg < 0.05:
-                        success_counts[name + "_agg"] += 1
 
-                n_comb += 1
+def control_variate_estimate(successes, success_control_sum, control_sum, control_squared_sum, n):
+    # Mean of the indicators corrected with a zero mean control, using the
+    # regression coefficient estimated from the same samples
+    mean = successes / n
+    control_mean = control_sum / n
+    control_variance = control_squared_sum / n - control_mean ** 2
+    if control_variance <= 0:
+        return mean
+    coefficient = (success_control_sum / n - mean * control_mean) / control_variance
+    return mean - coefficient * control_mean
 
-        for key, n_succ in success_counts.items():
-            test_type_1_error_rates[key].append(n_succ / n_comb)
 
-    return test_type_1_error_rates
+def control_variate_variance_ratio(successes, success_control_sum, control_sum, control_squared_sum, n):
+    # Variance of the corrected estimate relative to the plain one, 1 - rho^2
+    # for the correlation rho of the indicators and the control
+    mean = successes / n
+    control_mean = control_sum / n
+    variance = mean * (1 - mean)
+    control_variance = control_squared_sum / n - control_mean ** 2
+    if variance <= 0 or control_variance <= 0:
+        return 1.
+    covariance = success_control_sum / n - mean * control_mean
+    return float(np.clip(1 - covariance ** 2 / (variance * control_variance), 0., 1.))
 
 
 def read_obspower_files(path, pattern, filter_func=lambda *args: True):
@@ -78,6 +190,13 @@ def read_obspower_files(path, pattern, filter_func=lambda *args: True):
     return df
 
 
+def read_obspower_store(path, model, **predicates):
+    # Same result as read_obspower_files for a store written by the
+    # simulation scripts or powerstore import, predicates filter on blocks,
+    # docs and annotators
+    return to_obspower_frame(PowerStore(path).read(model=model, **predicates))
+
+
 def filter_wrong_rankings(model, df):
     coefficients = dict(zip(model.systems, model.coefficients))
     correct_rankings = set((x, y) for ((x, cx), (y, cy)) in it.product(coefficients.items(), coefficients.items()) if cx > cy)
@@ -87,7 +206,12 @@ def filter_wrong_rankings(model, df):
     return new_df
 
 
-def add_grouping_column(df):
+def add_grouping_column(df, design=None):
+    if design is not None:
+        # Samples of a design are ordered by system and then by observation
+        groups = np.tile(design.groups, len(df) // design.n_observations)
+        return df.set_index(pd.Index(groups, name="group"), append=True)
+
     group_df_entries = []
 
     for idx, group in enumerate(get_annotator_groups(df)):
@@ -100,37 +224,52 @@ def add_grouping_column(df):
     return df
 
 
-def get_art_pvals(model, design):
+def get_art_pvals(model, design, seed=None, cache=None):
+    cache = result_cache.get_cache(cache) if result_cache.seed_key(seed) is not None else None
+    if cache is not None:
+        key = result_cache.hash_key("art_pvals", result_cache.model_key(model), result_cache.design_key(design), result_cache.seed_key(seed))
+        data = cache.get(key)
+        if data is not None:
+            records = [{"better": better, "worse": worse, "p_value": p_val} for better, worse, _, p_val in result_cache.decode_pair_records(data)]
+            return pd.DataFrame.from_records(records, index=["better", "worse"])
+
+    rng = get_rng(seed)
     result = []
+    systems = sorted(model.systems)
+    system_order = [model.systems.index(system) for system in systems]
+    pairs = list(it.combinations(range(len(systems)), 2))
     for _ in range(100):
-        sample = model.sample(design)
-        sample = add_grouping_column(sample)
-        sample = sample.groupby(["system", "group"]).mean()
+        sample = model.sample_scores(design, rng=rng)
+        group_means = sample.group_means("group")[system_order]
 
-        for sys_1, sys_2 in it.combinations(sample.index.unique("system"), 2):
-            sample_1 = sample.xs(sys_1, level="system").to_numpy()
-            sample_2 = sample.xs(sys_2, level="system").to_numpy()
-            p_val = paired_approximate_randomization_test(sample_1, sample_2)
+        samples_1 = group_means[[sys_1 for sys_1, _ in pairs]]
+        samples_2 = group_means[[sys_2 for _, sys_2 in pairs]]
+        p_vals = batched_paired_approximate_randomization_test(samples_1, samples_2, rng=rng)
 
+        for (sys_1, sys_2), sample_1, sample_2, p_val in zip(pairs, samples_1, samples_2, p_vals):
+            sys_1, sys_2 = systems[sys_1], systems[sys_2]
             if sample_2.mean() > sample_1.mean():
                 sys_1, sys_2 = sys_2, sys_1
 
-
             result.append({"better": sys_1, "worse": sys_2, "p_value": p_val})
 
+    if cache is not None:
+        cache.put(key, result_cache.encode_pair_records([(r["better"], r["worse"], False, r["p_value"]) for r in result]))
+
     return pd.DataFrame.from_records(result, index=["better", "worse"])
 
 
-def run_art_experiment(model, annotator_count, block_counts):
+def run_art_experiment(model, annotator_count, block_counts, seed=None, cache=None):
     all_pvals = []
     all_keys = []
 
+    design_seeds = iter(spawn_seeds(seed, 2 * len(block_counts)))
     for n_annotators in (1, annotator_count):
         for n_blocks in block_counts:
             if n_annotators == 1:
                 n_blocks *= annotator_count
 
-            all_pvals.append(get_art_pvals(model, ordinal.create_design(n_blocks, 5, n_annotators)))
+            all_pvals.append(get_art_pvals(model, ordinal.create_design(n_blocks, 5, n_annotators), seed=next(design_seeds), cache=cache if seed is not None else None))
             all_keys.append((n_annotators, n_blocks, 5))
 
     df = pd.concat(all_pvals, keys=all_keys, names=["annotators", "blocks", "documents"])
@@ -140,11 +279,11 @@ def run_art_experiment(model, annotator_count, block_counts):
     return df.set_index(["annotators", "effort", "total_annotators", "better", "worse"], drop=True)
 
 
-def run_art_experiment_fixed_budget(model, budget, annotator_count, block_counts):
+def run_art_experiment_fixed_budget(model, budget, annotator_count, block_counts, seed=None, cache=None):
     result = []
     all_keys = []
-    for n_blocks in block_counts:
-        pvals = get_art_pvals(model, ordinal.create_design(n_blocks, budget // n_blocks, annotator_count))
+    for n_blocks, design_seed in zip(block_counts, spawn_seeds(seed, len(block_counts))):
+        pvals = get_art_pvals(model, ordinal.create_design(n_blocks, budget // n_blocks, annotator_count), seed=design_seed, cache=cache if seed is not None else None)
         result.append(pvals)
         all_keys.append((n_blocks, budget * annotator_count, n_blocks * annotator_count))
 
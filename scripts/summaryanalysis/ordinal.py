@@ -1,15 +1,32 @@
 import numpy as np
-import pandas as pd
 import json
 
+from .seeding import get_rng
+from .design import Design, as_design
+
+
+# Replicates whose (systems, observations, thresholds) probabilities are held
+# in memory at once while sampling
+SAMPLE_CHUNK_SIZE = 64
+
 
 class OrdinalModel:
-    def __init__(self, systems, coefficients, thresholds, annotator_covariance_matrix, document_covariance_matrix=None):
+    def __init__(self, systems, coefficients, thresholds, annotator_covariance_matrix, document_covariance_matrix=None, annotator_factor=None, document_factor=None):
         self.systems = list(systems)
         self.coefficients = np.array(coefficients)
         self.thresholds = np.array(thresholds)
         self.annotator_covariance_matrix = np.array(annotator_covariance_matrix)
-        self.document_covariance_matrix = np.array(document_covariance_matrix)
+        self.document_covariance_matrix = None
+        if document_covariance_matrix is not None:
+            self.document_covariance_matrix = np.array(document_covariance_matrix)
+
+        # Factors can be passed in when they are already known, e.g. in workers
+        if annotator_factor is None:
+            annotator_factor = covariance_factor(self.annotator_covariance_matrix)
+        self.annotator_factor = annotator_factor
+        self.document_factor = document_factor
+        if self.document_factor is None and self.document_covariance_matrix is not None:
+            self.document_factor = covariance_factor(self.document_covariance_matrix)
 
     @classmethod
     def from_file(cls, path):
@@ -38,53 +55,186 @@ class OrdinalModel:
     def zero_coefficients(self):
         self.coefficients[:] = 0.
 
-    def sample(self, design):
+    def sample(self, design, rng=None):
+        return self.to_frame(design, self.sample_batch(design, 1, rng=rng)[0])
+
+    def sample_batch(self, design, n_replicates, as_frame=False, rng=None):
+        # Scores are computed chunk by chunk, so only the int8 result grows
+        # with the number of replicates
+        design = as_design(design)
+        samples = np.empty((n_replicates, len(self.systems), design.n_observations), dtype=np.int8)
+        start = 0
+        for variates in self.draw_variate_chunks(design, n_replicates, rng=rng):
+            chunk = self.scores_from_variates(design, *variates)
+            samples[start:start + len(chunk)] = chunk
+            start += len(chunk)
+
+        if as_frame:
+            import pandas as pd
+            return pd.concat([self.to_frame(design, s) for s in samples], keys=range(n_replicates), names=["replicate"])
+        return samples
+
+    def draw_variates(self, design, n_replicates, rng=None):
+        # Standard normal annotator and document effects and the uniform
+        # variates of every judgement, in the order sample_batch draws them
+        rng = get_rng(rng)
+        design = as_design(design)
+        n_systems = len(self.systems)
+
+        annotator_normals = rng.standard_normal((n_replicates, design.n_annotators, n_systems))
+        document_normals = None
+        if self.document_factor is not None:
+            document_normals = rng.standard_normal((n_replicates, design.n_documents, n_systems))
+        uniforms = rng.uniform(size=(n_replicates, n_systems, design.n_observations, 1))
+        return annotator_normals, document_normals, uniforms
+
+    def draw_variate_chunks(self, design, n_replicates, rng=None, chunk_size=SAMPLE_CHUNK_SIZE):
+        # draw_variates for at most chunk_size replicates at a time. The
+        # random effects of all replicates are drawn first and the uniforms
+        # continue the stream chunk by chunk, so the chunks hold the same
+        # variates as one call to draw_variates.
+        rng = get_rng(rng)
+        design = as_design(design)
+        n_systems = len(self.systems)
+
+        annotator_normals = rng.standard_normal((n_replicates, design.n_annotators, n_systems))
+        document_normals = None
+        if self.document_factor is not None:
+            document_normals = rng.standard_normal((n_replicates, design.n_documents, n_systems))
+        for start in range(0, n_replicates, chunk_size):
+            end = min(start + chunk_size, n_replicates)
+            uniforms = rng.uniform(size=(end - start, n_systems, design.n_observations, 1))
+            yield annotator_normals[start:end], None if document_normals is None else document_normals[start:end], uniforms
+
+    def scores_from_variates(self, design, annotator_normals, document_normals, uniforms, return_latent=False):
+        # Scores of shape (replicates, systems, observations), with
+        # return_latent also the latent logistic variables they were cut from
         annotators, documents = design
-        annotator_errors = np.random.multivariate_normal(np.zeros(len(self.systems)), self.annotator_covariance_matrix, size=np.max(annotators) + 1)
-        if self.document_covariance_matrix is not None:
-            document_errors = np.random.multivariate_normal(np.zeros(len(self.systems)), self.document_covariance_matrix, size=np.max(documents) + 1)
+        n_systems = len(self.systems)
+
+        # Random slopes are treatment coded: every system shares the intercept
+        # effect of the reference system and adds its own offset on top.
+        slope_coding = np.eye(n_systems)
+        slope_coding[0, :] = 1.
+
+        annotator_errors = (annotator_normals @ self.annotator_factor.T) @ slope_coding
+        offsets = annotator_errors[:, annotators, :]
+
+        if self.document_factor is not None:
+            document_errors = (document_normals @ self.document_factor.T) @ slope_coding
+            offsets += document_errors[:, documents, :]
 
-        samples = []
+        # (replicates, systems, observations, thresholds)
+        linear_predictor = self.coefficients.reshape(1, -1, 1) + offsets.transpose(0, 2, 1)
+        sampling_logits = self.thresholds - linear_predictor[..., np.newaxis]
+        sampling_probabilities = 1. / (1. + np.exp(-sampling_logits))
 
-        for idx, system in enumerate(self.systems):
-            sampling_logits = self.thresholds - self.coefficients[idx]
-            sampling_logits = sampling_logits.reshape(1, -1) - annotator_errors[annotators,0].reshape(-1, 1)
-            if idx >= 1:
-                sampling_logits -= annotator_errors[annotators,idx].reshape(-1, 1)
+        # Scores are small positive integers
+        samples = ((uniforms > sampling_probabilities).sum(axis=-1) + 1).astype(np.int8)
+        if not return_latent:
+            return samples
 
-            if self.document_covariance_matrix is not None:
-                if idx >= 1:
-                    sampling_logits -= document_errors[documents,idx].reshape(-1, 1)
-                sampling_logits -= document_errors[documents,0].reshape(-1, 1)
+        with np.errstate(divide="ignore"):
+            latent = linear_predictor + np.log(uniforms[..., 0]) - np.log1p(-uniforms[..., 0])
+        return samples, latent
 
+    def latent_mean_covariance(self, design):
+        # Covariance of the per system means of the latent variables of one
+        # sample, shape (systems, systems). Annotator and document effects
+        # are weighted by their share of the observations, the logistic
+        # noise is independent between systems.
+        design = as_design(design)
+        n_systems = len(self.systems)
+        slope_coding = np.eye(n_systems)
+        slope_coding[0, :] = 1.
 
-            sampling_odds = np.exp(sampling_logits)
-            sampling_probabilities = sampling_odds / (sampling_odds + 1)
-            rands = np.random.uniform(size=(len(annotators), 1))
-            samples.append((rands > sampling_probabilities).sum(axis=1) + 1)
+        annotator_weights = np.bincount(design.annotators, minlength=design.n_annotators) / design.n_observations
+        covariance = np.sum(annotator_weights ** 2) * slope_coding.T @ self.annotator_factor @ self.annotator_factor.T @ slope_coding
+        if self.document_factor is not None:
+            document_weights = np.bincount(design.documents, minlength=design.n_documents) / design.n_observations
+            covariance += np.sum(document_weights ** 2) * slope_coding.T @ self.document_factor @ self.document_factor.T @ slope_coding
+        covariance += np.eye(n_systems) * np.pi ** 2 / 3 / design.n_observations
+        return covariance
 
-        samples_dfs = [pd.DataFrame.from_dict({"score": d}) for d in samples]
+    def sample_scores(self, design, rng=None):
+        design = as_design(design)
+        return SampleBatch(design, self.systems, self.sample_batch(design, 1, rng=rng)[0])
+
+    def sample_replicates(self, design, replicate_seeds):
+        # One independent stream per replicate, so that replicate i is the same
+        # no matter how many replicates are drawn or who draws them
+        return np.stack([self.sample_batch(design, 1, rng=seed)[0] for seed in replicate_seeds])
+
+    def to_frame(self, design, sample):
+        # pandas is imported here, so that workers that only sample do not
+        # load it
+        import pandas as pd
+        annotators, documents = design
+        samples_dfs = [pd.DataFrame.from_dict({"score": d}) for d in sample]
         for df in samples_dfs:
             df.index = pd.MultiIndex.from_arrays([annotators, documents], names=["annotator", "document"])
         join_df = pd.concat(samples_dfs, keys=self.systems, names=["system"])
         return join_df
 
 
+class SampleBatch:
+    # Scores of one sample as an int8 array of shape (systems, observations),
+    # observations are those of the design
+    def __init__(self, design, systems, scores):
+        self.design = as_design(design)
+        self.systems = list(systems)
+        self.scores = np.ascontiguousarray(scores, dtype=np.int8)
+        assert self.scores.shape == (len(self.systems), self.design.n_observations)
+
+    def __len__(self):
+        return len(self.systems)
+
+    def system(self, system):
+        if not isinstance(system, (int, np.integer)):
+            system = self.systems.index(system)
+        return self.scores[system]
+
+    def labels(self, by):
+        if by == "group":
+            return self.design.groups
+        return {"annotator": self.design.annotators, "document": self.design.documents, "block": self.design.blocks}[by]
+
+    def group_means(self, by="group"):
+        # Mean score per system and label, shape (systems, labels)
+        labels = self.labels(by)
+        n_labels = int(labels.max()) + 1
+        n_systems = len(self.systems)
+        cells = (np.arange(n_systems)[:, np.newaxis] * n_labels + labels).ravel()
+        sums = np.bincount(cells, weights=self.scores.ravel(), minlength=n_systems * n_labels)
+        counts = np.bincount(labels, minlength=n_labels)
+        return sums.reshape(n_systems, n_labels) / counts
+
+    def means(self):
+        return self.scores.mean(axis=1)
+
+    def to_frame(self):
+        import pandas as pd
+        n_systems = len(self.systems)
+        index = pd.MultiIndex.from_arrays([
+            np.repeat(np.array(self.systems, dtype=object), self.design.n_observations),
+            np.tile(self.design.annotators, n_systems),
+            np.tile(self.design.documents, n_systems)
+        ], names=["system", "annotator", "document"])
+        return pd.DataFrame({"score": self.scores.ravel()}, index=index)
+
+
+def covariance_factor(covariance_matrix):
+    try:
+        return np.linalg.cholesky(covariance_matrix)
+    except np.linalg.LinAlgError:
+        # Fitted covariance matrices are not always positive definite, fall back
+        # to a factor of the nearest positive semi-definite matrix.
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance_matrix)
+        return eigenvectors * np.sqrt(np.clip(eigenvalues, 0., None))
+
+
 def create_design(block_count, block_size, block_annotator_count):
-    annotators = []
-    documents = []
-
-    curr_annotator = 0
-    curr_document = 0
-    for block_idx in range(block_count):
-        block_doc_set = list(range(curr_document, curr_document + block_size))
-        for block_annotator_idx in range(block_annotator_count):
-            documents.extend(block_doc_set)
-            annotators.extend([curr_annotator + block_annotator_idx] * len(block_doc_set))
-        curr_annotator += block_annotator_count
-        curr_document += block_size
-
-    return np.array(annotators), np.array(documents)
+    return Design.balanced(block_count, block_size, block_annotator_count)
 
 
 thresholds_mn_likertd = [-5.2598, -4.3442, -3.0329, -1.7464, -0.5523, 1.0697]
@@ -1,10 +1,13 @@
 from . import ordinal
+from . import cache as result_cache
+from . import broadcast
+from . import telemetry
+from .seeding import spawn_seeds
 import tempfile
 import os
 import subprocess
-import tqdm
 from collections import Counter
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import argparse
 import csv
 import numpy as np
@@ -12,14 +15,22 @@ import numpy as np
 
 
 def regress_on_sample(args):
-    num_blocks, distribution = args
-    np.random.seed()
-    sample = ordinal.MODELS[distribution].sample(ordinal.create_design(num_blocks, 5, 1))
-    differences, p_values = run_regression(sample, nested=True)
+    model, design, seed, backend, cache, cache_samples = args
+    with telemetry.timer("sample"):
+        sample = result_cache.cached_sample_replicates(model, design, [seed], cache if cache_samples else None)[0]
+    with telemetry.timer("frame"):
+        sample = model.to_frame(design, sample)
+    differences, p_values = run_regression(sample, nested=True, backend=backend, cache=cache)
     return differences, p_values
 
 
-def run_experiment(num_blocks, num_iters, log_filename=None, distribution="likertD:multi_news:modified"):
+def regress_on_shared_sample(args):
+    # Model and design come from the broadcast the pool was started with
+    model, design, _ = broadcast.get_worker_state()
+    return regress_on_sample((model, design) + args)
+
+
+def run_experiment(num_blocks, num_iters, log_filename=None, distribution="likertD:multi_news:modified", backend="rscript", seed=None, cache=None):
     diffs_of_interest = [
         ("__REFERENCE__", "BART"),
         ("abssentrw", "onmt_pg")
@@ -31,53 +42,152 @@ def run_experiment(num_blocks, num_iters, log_filename=None, distribution="liker
     if log_filename is not None:
         log_file = open(log_filename, "w")
         log_writer = csv.writer(log_file)
-    with Pool() as pool:
-        for differences, p_values in tqdm.tqdm(pool.imap_unordered(regress_on_sample, [(num_blocks, distribution)] * num_iters), total=num_iters):
-            diffs_found.update(differences.intersection(diffs_of_interest))
-            if log_writer:
-                vals = []
-                for diff in diffs_of_interest:
-                    vals.append(p_values[tuple(sorted(diff))])
-                log_writer.writerow(vals)
-
-    if log_file is not None:
-        log_file.close()
+    model = ordinal.MODELS[distribution]
+    design = ordinal.create_design(num_blocks, 5, 1)
+    # One cache for the whole run, so its size is only counted once
+    cache = result_cache.get_cache(cache)
+    tasks = [(s, backend, cache, seed is not None) for s in spawn_seeds(seed, num_iters)]
+
+    # Worker pools are shared between threads of this process, the other
+    # backends do their work in the calling process
+    shared = None
+    if backend in PROCESS_BACKENDS:
+        shared = broadcast.publish_model(model, design)
+        executor = ProcessPoolExecutor(initializer=broadcast.initialize_model_worker, initargs=(shared.descriptor,))
+        results = executor.map(regress_on_shared_sample, tasks)
+    else:
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        results = executor.map(regress_on_sample, [(model, design) + t for t in tasks])
+
+    import tqdm
+
+    try:
+        with executor:
+            for differences, p_values in tqdm.tqdm(results, total=num_iters):
+                diffs_found.update(differences.intersection(diffs_of_interest))
+                if log_writer:
+                    vals = []
+                    for diff in diffs_of_interest:
+                        vals.append(p_values[tuple(sorted(diff))])
+                    log_writer.writerow(vals)
+    finally:
+        if shared is not None:
+            shared.close()
+
+        if log_file is not None:
+            log_file.close()
 
     for key, val in diffs_found.items():
         print(key, val/num_iters)
 
 
-def run_regression(group_df, nested=False):
+def run_rscript(group_df, score_name, mode):
+    with telemetry.timer("regression.serialize"):
+        handle, path = tempfile.mkstemp()
+        f_temp = os.fdopen(handle, 'w')
+        group_df.to_csv(path)
+        f_temp.close()
+    with telemetry.timer("regression.launch"):
+        process = subprocess.Popen(["Rscript", "scripts/r/analyse-ordinal.r", path, score_name, mode], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf8")
+    with telemetry.timer("regression.fit"):
+        stdout, _ = process.communicate()
+    os.remove(path)
+
+    # Like a failing rpool fit, a failing Rscript call produces no contrasts
+    if process.returncode != 0:
+        telemetry.count("regression.failed")
+        return ""
+
+    return stdout
+
+
+# The python backends need scipy and pandas, which are only imported on the
+# first regression so that workers of the other backends start quickly
+def run_clmm(group_df, score_name, mode):
+    from . import clmm
+    return clmm.analyse(group_df, score_name, mode)
+
+
+def run_pooled(group_df, score_name, mode):
+    from . import rpool
+    return rpool.run_pooled(group_df, score_name, mode)
+
+
+def run_pooled_python(group_df, score_name, mode):
+    from . import rpool
+    return rpool.run_pooled(group_df, score_name, mode, command=rpool.PYTHON_WORKER_COMMAND)
+
+
+BACKENDS = {
+    "rscript": run_rscript,
+    "python": run_clmm,
+    "rpool": run_pooled,
+    "rpool-python": run_pooled_python
+}
+PROCESS_BACKENDS = ("rscript", "python")
+
+
+def run_regression(group_df, nested=False, backend="rscript", cache=None):
     mode = "crossed"
     if nested:
         mode = "nested"
 
     mode += ":none"
 
-    handle, path = tempfile.mkstemp()
-    f_temp = os.fdopen(handle, 'w')
-    group_df.to_csv(path)
-    f_temp.close()
-    regression_result = subprocess.run(["Rscript", "scripts/r/analyse-ordinal.r", path, "score", mode], capture_output=True, encoding="utf8")
-    os.remove(path)
+    # Results are cached by the sampled data itself, only for named backends
+    cache = result_cache.get_cache(cache)
+    key = None
+    if cache is not None and isinstance(backend, str):
+        key = result_cache.hash_key("regression", result_cache.frame_key(group_df, "score"), mode, backend)
+        cached = cache.get_contrasts(key)
+        if cached is not None:
+            telemetry.count("regression.cached")
+            return cached
+
+    if isinstance(backend, str):
+        backend = BACKENDS[backend]
+    with telemetry.timer("regression"):
+        output = backend(group_df, "score", mode)
+
+        with telemetry.timer("regression.parse"):
+            differences, p_values = parse_regression_output(output.split("\n"))
+
+    # Failed or empty fits are not cached, the failure may be transient
+    if key is not None and len(p_values) > 0:
+        cache.put_contrasts(key, differences, p_values)
+
+    return differences, p_values
 
-    diffs = regression_result.stdout.split("\n")
 
+def parse_contrast_line(line):
+    # One "A - B<tab>direction<tab>p" line of analyse-ordinal.r, returns the
+    # pair ordered better first, whether the difference is significant and
+    # the p-value, or None for empty lines
+    line = line.strip("\r\n")
+    if len(line) == 0:
+        return None
+    pair, direction, p_value = line.split("\t")
+    p_value = float(p_value)
+
+    sys_a, sys_b = pair.split(" - ")
+
+    if direction == "-":
+        sys_a, sys_b = sys_b, sys_a
+
+    return sys_a, sys_b, direction != "o", p_value
+
+
+def parse_regression_output(lines):
     differences = set()
     p_values = {}
 
-    for diff in diffs:
-        if len(diff) == 0:
+    for line in lines:
+        contrast = parse_contrast_line(line)
+        if contrast is None:
             continue
-        pair, direction, p_value = diff.split("\t")
-        p_value = float(p_value)
-
-        sys_a, sys_b = pair.split(" - ")
-
-        if direction == "-":
-        	sys_a, sys_b = sys_b, sys_a
+        sys_a, sys_b, significant, p_value = contrast
 
-        if direction != "o":
+        if significant:
             differences.add((sys_a, sys_b))
 
         p_values[sys_a, sys_b] = p_value
@@ -91,8 +201,11 @@ if __name__ == "__main__":
     parser.add_argument("-i", dest="num_iters", default=1000, type=int)
     parser.add_argument("-l", dest="log_filename", default=None)
     parser.add_argument("-d", dest="distribution", default="likertD:multi_news:modified")
+    parser.add_argument("--backend", dest="backend", choices=sorted(BACKENDS), default="rscript")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+    parser.add_argument("--cache", dest="cache", default=None, help="directory for cached samples and regression results")
 
     args = parser.parse_args()
 
-    run_experiment(args.num_blocks, args.num_iters, args.log_filename, args.distribution)
+    run_experiment(args.num_blocks, args.num_iters, args.log_filename, args.distribution, args.backend, args.seed, cache=args.cache)
 
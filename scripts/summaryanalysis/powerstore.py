@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import re
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Columnar store for simulated p-values. A store is a directory with one .npy
+# file per partition and a manifest.json that lists the partitions together
+# with their design (model, blocks, docs, annotators). Within a partition,
+# system pairs are stored as codes into the store-wide list of systems, so
+# the p-values of a design can be memory-mapped without parsing any text and
+# filters on design parameters only open the matching partitions. Partitions
+# also record the source (file or batch) they came from, and appending the
+# same source again replaces the earlier partition. Writers hold a lock on
+# the store and re-read the manifest first, so several processes can append
+# to one store.
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+ROW_DTYPE = np.dtype([("replicate", "<i4"), ("better", "<u2"), ("worse", "<u2"), ("p_value", "<f8")])
+DESIGN_COLUMNS = ["model", "blocks", "docs", "annotators"]
+
+
+class PowerStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.path / "manifest.json"
+        self._read_manifest()
+
+    def _read_manifest(self):
+        if self.manifest_path.exists():
+            self.manifest = json.loads(self.manifest_path.read_text())
+        else:
+            self.manifest = {"systems": [], "partitions": []}
+
+    @property
+    def systems(self):
+        return self.manifest["systems"]
+
+    def system_codes(self, systems):
+        codes = {name: idx for idx, name in enumerate(self.systems)}
+        for name in systems:
+            if name not in codes:
+                codes[name] = len(self.systems)
+                self.systems.append(name)
+        return np.array([codes[name] for name in systems], dtype=np.uint16)
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.manifest))
+        os.replace(tmp_path, self.manifest_path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with file_lock(self.path / "manifest.lock"):
+            self._read_manifest()
+            yield
+
+    def append(self, model, design, better, worse, p_values, replicates, source=None):
+        # Adds one partition, design is (blocks, docs, annotators). A
+        # partition of the same model, design and source is replaced.
+        n_blocks, n_docs, n_annotators = map(int, design)
+        partition = {
+            "file": f"part-{uuid.uuid4().hex}.npy",
+            "rows": len(p_values),
+            "model": model,
+            "blocks": n_blocks,
+            "docs": n_docs,
+            "annotators": n_annotators,
+            "source": source
+        }
+
+        with self._locked():
+            rows = np.empty(len(p_values), dtype=ROW_DTYPE)
+            rows["replicate"] = replicates
+            rows["better"] = self.system_codes(list(better))
+            rows["worse"] = self.system_codes(list(worse))
+            rows["p_value"] = p_values
+            np.save(self.path / partition["file"], rows)
+
+            key = [model, n_blocks, n_docs, n_annotators, source]
+            replaced = [p for p in self.manifest["partitions"] if source is not None and [p[c] for c in DESIGN_COLUMNS] + [p.get("source")] == key]
+            self.manifest["partitions"] = [p for p in self.manifest["partitions"] if p not in replaced] + [partition]
+            self._write_manifest()
+            for p in replaced:
+                (self.path / p["file"]).unlink(missing_ok=True)
+
+    def append_frame(self, model, design, df, replicates=None, source=None):
+        # df is indexed by (better, worse) like the output of test_design_power
+        better, worse = (df.index.get_level_values(i) for i in range(2))
+        if replicates is None:
+            replicates = replicate_numbers(better, worse)
+        self.append(model, design, better, worse, df["p_value"].to_numpy(), replicates, source)
+
+    def partitions(self, **predicates):
+        # Predicates are matched against the design of each partition and can
+        # be a single value, a collection of values or a callable
+        def matches(partition):
+            for column, predicate in predicates.items():
+                if predicate is None:
+                    continue
+                value = partition[column]
+                if callable(predicate):
+                    if not predicate(value):
+                        return False
+                elif isinstance(predicate, (list, tuple, set, frozenset, range)):
+                    if value not in predicate:
+                        return False
+                elif value != predicate:
+                    return False
+            return True
+
+        return [p for p in self.manifest["partitions"] if matches(p)]
+
+    def read_arrays(self, **predicates):
+        partitions = self.partitions(**predicates)
+        arrays = [np.load(self.path / p["file"], mmap_mode="r") for p in partitions]
+        return partitions, arrays
+
+    def read(self, **predicates):
+        partitions, arrays = self.read_arrays(**predicates)
+        lengths = [p["rows"] for p in partitions]
+        rows = np.concatenate(arrays) if len(arrays) > 0 else np.empty(0, dtype=ROW_DTYPE)
+
+        categories = pd.Index(self.systems)
+        columns = {}
+        for column in DESIGN_COLUMNS:
+            columns[column] = np.repeat([p[column] for p in partitions], lengths)
+        columns["model"] = pd.Categorical(columns["model"])
+        columns["replicate"] = rows["replicate"]
+        columns["better"] = pd.Categorical.from_codes(rows["better"].astype(np.int64), categories)
+        columns["worse"] = pd.Categorical.from_codes(rows["worse"].astype(np.int64), categories)
+        columns["p_value"] = rows["p_value"]
+        return pd.DataFrame(columns)
+
+
+def replicate_numbers(better, worse):
+    # Each replicate reports every system pair once, so the replicate of a row
+    # is the number of times its pair was seen before
+    counts = {}
+    replicates = np.empty(len(better), dtype=np.int32)
+    for idx, pair in enumerate(zip(better, worse)):
+        pair = tuple(sorted(pair))
+        replicates[idx] = counts.get(pair, 0)
+        counts[pair] = replicates[idx] + 1
+    return replicates
+
+
+OBSPOWER_FILE_PATTERN = re.compile(r"(.*?)(\d+)_(\d+)_(\d+)\.csv")
+
+
+def import_obspower_files(store, path, pattern="*.csv"):
+    for csv_path in sorted(Path(path).glob(pattern)):
+        match = OBSPOWER_FILE_PATTERN.match(csv_path.name)
+        if match is None:
+            continue
+        model = match.group(1)
+        design = tuple(map(int, match.groups()[1:]))
+
+        data = pd.read_csv(csv_path, header=0, names=["better", "worse", "p_value"], index_col=[0, 1])
+        store.append_frame(model, design, data, source=str(csv_path.resolve()))
+
+
+def to_obspower_frame(df):
+    # Same layout as montecarlo.read_obspower_files
+    df = df.assign(
+        effort=df["blocks"] * df["docs"] * df["annotators"],
+        total_annotators=df["blocks"] * df["annotators"],
+        better=df["better"].astype(str),
+        worse=df["worse"].astype(str)
+    )
+    return df.set_index(["annotators", "effort", "total_annotators", "better", "worse"])[["p_value"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("store")
+    import_parser.add_argument("obspower_dir")
+    import_parser.add_argument("pattern", nargs="?", default="*.csv")
+
+    show_parser = subparsers.add_parser("show")
+    show_parser.add_argument("store")
+
+    args = parser.parse_args()
+
+    store = PowerStore(args.store)
+    if args.command == "import":
+        import_obspower_files(store, args.obspower_dir, args.pattern)
+    else:
+        designs = store.read().groupby(DESIGN_COLUMNS, observed=True)["p_value"].agg(["count", lambda x: (x < 0.05).mean()])
+        designs.columns = ["rows", "significant"]
+        print(designs.to_string())
@@ -1,50 +1,26 @@
 import argparse
-import tempfile
-import subprocess
-import os
 import csv
 
 import pandas as pd
 import tqdm
 
-from .sample import generate_samples, get_annotator_groups
+from .sample import generate_sample_rows, get_annotator_groups
+from .annotationutils import AnnotationIndex
+from . import annotationstore
+from .power import BACKENDS, parse_regression_output
+from .seeding import get_rng
 
 
-def take(iterable, n):
-	for idx, item in enumerate(iterable):
-		if idx == n:
-			break
-		else:
-			yield item
-
-
-def run_regression(group_df, nested=False):
+def run_regression(group_df, nested=False, backend="rscript"):
 	mode = "crossed"
 	if nested:
 		mode = "nested"
 
-	handle, path = tempfile.mkstemp()
-	f_temp = os.fdopen(handle, 'w')
-	group_df.to_csv(path)
-	f_temp.close()
-	regression_result = subprocess.run(["Rscript", "analyse-ordinal.r", path, "coherence_score", mode], capture_output=True, encoding="utf8")
-	os.remove(path)
-
-	diffs = regression_result.stdout.split("\n")
-
-	differences = set()
-
-	for diff in diffs:
-		if len(diff) == 0:
-			continue
-		pair, direction = diff.split("\t")
-		sys_a, sys_b = pair.split(" - ")
-
-		if direction == "-":
-			sys_a, sys_b = sys_b, sys_a
-
-		differences.add((sys_a, sys_b))
+	if isinstance(backend, str):
+		backend = BACKENDS[backend]
+	output = backend(group_df, "coherence_score", mode)
 
+	differences, _ = parse_regression_output(output.split("\n"))
 	return differences
 
 
@@ -54,16 +30,25 @@ if __name__ == "__main__":
 	parser.add_argument("annotation_file")
 	parser.add_argument("out_file")
 	parser.add_argument("-n", dest="nested", action="store_true", default=False)
+	parser.add_argument("--backend", dest="backend", choices=sorted(BACKENDS), default="rscript")
+	parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+	parser.add_argument("--store", dest="store", default=None, help="read the annotations through this annotation store")
 
 	args = parser.parse_args()
 
-	annotations = pd.read_csv(args.annotation_file, index_col=[0, 1, 2])
+	if args.store is not None:
+		annotations = annotationstore.read_csv(args.annotation_file, index_col=[0, 1, 2], store=args.store)
+	else:
+		annotations = pd.read_csv(args.annotation_file, index_col=[0, 1, 2])
 
 	results_log = open("regression.log", "w")
 	result_file = open(args.out_file, "w")
 	result_writer = csv.writer(result_file)
 
-	base_differences = run_regression(annotations)
+	rng = get_rng(args.seed)
+	index = AnnotationIndex(annotations)
+
+	base_differences = run_regression(annotations, backend=args.backend)
 
 	contradictory_differences = set((b, a) for a, b in base_differences)
 
@@ -71,9 +56,9 @@ if __name__ == "__main__":
 		num_detected = 0
 		num_contradictions = 0
 		num_new = 0
-		for idx, (group_df, num_annotators) in enumerate(take(generate_samples(annotations, group_size, nested=args.nested), 10)):
+		for idx, (rows, num_annotators) in enumerate(generate_sample_rows(index, group_size, nested=args.nested, rng=rng, limit=10)):
 
-			detected_differences = run_regression(group_df, nested=args.nested)
+			detected_differences = run_regression(annotations.iloc[rows], nested=args.nested, backend=args.backend)
 			results_log.write(f"#{group_size} {num_annotators} {idx}\n")
 			for diff in sorted(detected_differences):
 				results_log.write("\t".join(diff))
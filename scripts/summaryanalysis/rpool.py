@@ -0,0 +1,258 @@
+import atexit
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Pool of long running regression workers (scripts/r/ordinal-worker.r) that
+# replaces one Rscript process per regression.
+#
+# Every worker connects back to a socket opened by the pool. Messages in both
+# directions are frames of a little endian uint32 length followed by that many
+# bytes. A request is a tab separated header frame
+#
+#   ping
+#   quit
+#   fit <score name> <mode> <rows> <system name>...
+#
+# where fit is followed by a payload frame holding the annotator, document and
+# system codes as int32 columns and the scores as a float64 column. Every
+# request except quit is answered with a single frame whose first line is
+# either "ok" or "error\t<message>". For fit the remaining lines are the
+# contrast table printed by analyse-ordinal.r.
+
+
+R_WORKER_COMMAND = ["Rscript", "scripts/r/ordinal-worker.r"]
+PYTHON_WORKER_COMMAND = [sys.executable, "-m", "summaryanalysis.stubworker"]
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    pass
+
+
+def send_frame(sock, body):
+    sock.sendall(struct.pack("<I", len(body)) + body)
+
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if len(chunk) == 0:
+            raise WorkerError("Worker closed the connection")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    length, = struct.unpack("<I", recv_exactly(sock, 4))
+    return recv_exactly(sock, length)
+
+
+def encode_request(group_df, score_name, mode):
+    data = group_df.reset_index()
+    annotators, _ = pd.factorize(data["annotator"])
+    documents, _ = pd.factorize(data["document"])
+    systems, system_names = pd.factorize(data["system"])
+
+    header = "\t".join(["fit", score_name, mode, str(len(data))] + [str(s) for s in system_names])
+    payload = b"".join([
+        annotators.astype("<i4").tobytes(),
+        documents.astype("<i4").tobytes(),
+        systems.astype("<i4").tobytes(),
+        data[score_name].to_numpy().astype("<f8").tobytes()
+    ])
+    return header.encode("utf8"), payload
+
+
+def decode_request(header, payload):
+    _, score_name, mode, n_rows, *system_names = header.decode("utf8").split("\t")
+    n_rows = int(n_rows)
+
+    columns = np.frombuffer(payload, dtype="<i4", count=3 * n_rows).reshape(3, n_rows)
+    scores = np.frombuffer(payload, dtype="<f8", count=n_rows, offset=12 * n_rows)
+
+    group_df = pd.DataFrame.from_dict({
+        "annotator": columns[0],
+        "document": columns[1],
+        "system": np.array(system_names, dtype=object)[columns[2]],
+        score_name: scores
+    })
+    return group_df.set_index(["system", "annotator", "document"]), score_name, mode
+
+
+class Worker:
+    def __init__(self, command=None, startup_timeout=600.):
+        self.command = command or R_WORKER_COMMAND
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.sock = None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            listener.settimeout(1.)
+            port = listener.getsockname()[1]
+            self.process = subprocess.Popen(self.command + [str(port)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+            deadline = time.monotonic() + self.startup_timeout
+            while True:
+                try:
+                    self.sock, _ = listener.accept()
+                    break
+                except socket.timeout:
+                    if self.process.poll() is not None:
+                        raise WorkerError(f"Worker exited with {self.process.returncode} during startup")
+                    if time.monotonic() > deadline:
+                        self.kill()
+                        raise WorkerTimeout("Worker did not connect in time")
+
+        self.sock.settimeout(None)
+
+    def kill(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def close(self):
+        if self.running:
+            try:
+                send_frame(self.sock, b"quit")
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def request(self, frames, timeout=None):
+        if not self.running:
+            raise WorkerError("Worker is not running")
+
+        self.sock.settimeout(timeout)
+        try:
+            for frame in frames:
+                send_frame(self.sock, frame)
+            response = recv_frame(self.sock).decode("utf8")
+        except socket.timeout:
+            self.kill()
+            raise WorkerTimeout("Worker did not answer in time")
+        except OSError as e:
+            self.kill()
+            raise WorkerError(str(e))
+
+        status, _, body = response.partition("\n")
+        if status != "ok":
+            raise WorkerError(status.partition("\t")[2])
+        return body
+
+    def ping(self, timeout=10.):
+        try:
+            return self.request([b"ping"], timeout=timeout) == "pong"
+        except WorkerError:
+            return False
+
+    def fit(self, group_df, score_name, mode, timeout=None):
+        return self.request(encode_request(group_df, score_name, mode), timeout=timeout)
+
+
+class WorkerPool:
+    def __init__(self, size=None, command=None, timeout=600., startup_timeout=600., ping_timeout=10.):
+        self.size = size or os.cpu_count()
+        self.timeout = timeout
+        self.ping_timeout = ping_timeout
+        self.workers = [Worker(command, startup_timeout) for _ in range(self.size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __call__(self, group_df, score_name, mode):
+        # Same signature and output as power.run_rscript. Like a failing
+        # Rscript call, fits that fail or time out produce no contrasts.
+        worker = self.idle.get()
+        try:
+            for attempt in range(2):
+                try:
+                    # A hung worker is replaced before it gets the fit
+                    if worker.running and not worker.ping(self.ping_timeout):
+                        worker.kill()
+                    if not worker.running:
+                        worker.start()
+                    return worker.fit(group_df, score_name, mode, timeout=self.timeout)
+                except WorkerTimeout:
+                    return ""
+                except WorkerError:
+                    # Errors raised inside the fit leave the worker running,
+                    # a crashed worker or one that failed to start gets one
+                    # more try
+                    if worker.running:
+                        return ""
+            return ""
+        finally:
+            self.idle.put(worker)
+
+    def health_check(self, timeout=10.):
+        healthy = 0
+        for _ in range(self.size):
+            worker = self.idle.get()
+            try:
+                if worker.running and not worker.ping(timeout):
+                    worker.kill()
+                if not worker.running:
+                    worker.start()
+                healthy += worker.ping(timeout)
+            except WorkerError:
+                pass
+            finally:
+                self.idle.put(worker)
+        return healthy
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+_shared_pools = {}
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool(command=None):
+    # One pool per worker command
+    command = tuple(command or R_WORKER_COMMAND)
+    with _shared_pool_lock:
+        if command not in _shared_pools:
+            _shared_pools[command] = WorkerPool(command=list(command))
+            atexit.register(_shared_pools[command].close)
+    return _shared_pools[command]
+
+
+def run_pooled(group_df, score_name, mode, command=None):
+    return get_shared_pool(command)(group_df, score_name, mode)
@@ -1,27 +1,54 @@
-import random
 import itertools as it
-from collections import defaultdict
+import math
 
+import numpy as np
 
-def get_annotator_groups(annotations):
-    all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
-        all_groups[docs].append(annotator)
-    
-    all_annotator_groups = list(map(tuple, all_groups.values()))
-    return all_annotator_groups
+from .annotationutils import get_annotator_groups, AnnotationIndex
+from .seeding import get_rng
 
 
-def generate_samples(annotations, size, nested=False):
-	groups = get_annotator_groups(annotations)
+def sample_group_combinations(n_groups, size, rng=None, limit=None):
+	# Distinct random combinations of size groups in random order. They are
+	# drawn by rejection until half of all combinations were drawn, the rest
+	# are enumerated and shuffled, so the work stays proportional to the
+	# number of combinations yielded
+	rng = get_rng(rng)
+	n_combinations = math.comb(n_groups, size)
+	total = n_combinations if limit is None else min(n_combinations, limit)
 
-	combinations = list(it.combinations(groups, size))
+	seen = set()
+	while len(seen) < total and 2 * len(seen) < n_combinations:
+		combination = tuple(sorted(rng.choice(n_groups, size, replace=False)))
+		if combination in seen:
+			continue
+		seen.add(combination)
+		yield combination
 
-	for group_combo in combinations:
+	if len(seen) < total:
+		remaining = [c for c in it.combinations(range(n_groups), size) if c not in seen]
+		for idx in rng.permutation(len(remaining))[:total - len(seen)]:
+			yield remaining[idx]
+
+
+def generate_sample_rows(index, size, nested=False, rng=None, limit=None):
+	# Yields the positions of the sampled rows in the frame the index was built
+	# from, together with the number of sampled annotators
+	rng = get_rng(rng)
+
+	for group_combo in sample_group_combinations(len(index.groups), size, rng, limit):
 		if nested:
-			group_combo = [random.choice(g) for g in group_combo]
+			annotators = np.array([index.groups[g][rng.choice(len(index.groups[g]))] for g in group_combo])
 		else:
-			group_combo = [m for g in group_combo for m in g]
+			annotators = index.group_annotators(group_combo)
+
+		yield index.source_rows[index.annotator_rows(annotators)], len(annotators)
+
+
+def generate_samples(annotations, size, nested=False, rng=None, limit=None, index=None):
+	# Copies the sampled rows, use generate_sample_rows to select them only
+	# where a frame is needed
+	if index is None:
+		index = AnnotationIndex(annotations)
 
-		yield annotations.loc[group_combo], len(group_combo)
\ No newline at end of file
+	for rows, num_annotators in generate_sample_rows(index, size, nested, rng, limit):
+		yield annotations.iloc[rows], num_annotators
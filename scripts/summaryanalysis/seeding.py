@@ -0,0 +1,37 @@
+import numpy as np
+
+
+# Simulation functions take a seed argument that may be None, an int, a
+# SeedSequence or an existing Generator/RandomState. None keeps drawing from
+# NumPy's global random state. Work that is spread over workers gets one child
+# SeedSequence per replicate, so results do not depend on how replicates are
+# scheduled.
+
+
+def get_rng(seed=None):
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed, (np.random.Generator, np.random.RandomState)):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def get_seed_sequence(seed=None):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return seed.bit_generator.seed_seq
+    if isinstance(seed, np.random.RandomState):
+        return np.random.SeedSequence(seed.randint(2 ** 32, size=4))
+    return np.random.SeedSequence(seed)
+
+
+def spawn_seeds(seed, n):
+    return get_seed_sequence(seed).spawn(n)
+
+
+def child_seeds(parent, start, stop):
+    # The same seeds as parent.spawn(stop)[start:stop] on a fresh parent,
+    # without spawning the ones before start
+    parent = get_seed_sequence(parent)
+    return [np.random.SeedSequence(parent.entropy, spawn_key=tuple(parent.spawn_key) + (i,), pool_size=parent.pool_size) for i in range(start, stop)]
@@ -1,54 +1,71 @@
 from collections import defaultdict
-import itertools as it
-import random
-import scipy.stats
 import numpy as np
 
-def get_annotator_groups(annotations):
-    all_groups = defaultdict(list)
-    for annotator, group in annotations.groupby("annotator").groups.items():
-        docs = tuple(sorted(set(group.to_frame()["document"])))
-        all_groups[docs].append(annotator)
-
-    all_annotator_groups = list(map(tuple, all_groups.values()))
-    return all_annotator_groups
-
-def compute_correlations_from_selection_mask(annotations, select_mask, score_name):
-    scores_1 = annotations.loc[~select_mask][score_name]
-    scores_2 = annotations.loc[select_mask][score_name]
-
-    system_scores_1 = scores_1.groupby("system").mean().sort_index().to_numpy()
-    system_scores_2 = scores_2.groupby("system").mean().sort_index().to_numpy()
-
-    corr,_ = scipy.stats.pearsonr(system_scores_1, system_scores_2)
-
-    sq_err = np.absolute((system_scores_1 - system_scores_2)).mean()
-    return corr, sq_err
-
-
-def compute_annotator_shr_raw(annotations, limit=1000, score_names=("coherence_score", "pronoun_score", "noun_phrase_score", "repetition_score")):
-    all_annotator_groups = get_annotator_groups(annotations)
-
-    #annotations = normalize_annotations(annotations)
-
-    annotators = annotations.index.levels[0]
+from .annotationutils import AnnotationIndex
+from .seeding import get_rng
+
+def draw_split_halves(n_groups, limit, rng=None):
+    # Row i marks the groups in the selected half of split i. Successive
+    # splits shuffle the previous order, like shuffling the group list did.
+    rng = get_rng(rng)
+    order = np.arange(n_groups)
+    splits = np.zeros((limit, n_groups), dtype=bool)
+    for idx in range(limit):
+        rng.shuffle(order)
+        splits[idx, order[:n_groups // 2]] = True
+    return splits
+
+
+def pearson_rows(x, y):
+    # Pearson correlation along the last axis
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    return (x * y).sum(axis=-1) / np.sqrt((x ** 2).sum(axis=-1) * (y ** 2).sum(axis=-1))
+
+
+def compute_split_half_scores(index, splits, chunk_size=10000):
+    # System means of both halves of every split are sums over per-group
+    # tables, returns correlations and mean absolute errors with shape
+    # (splits, scores)
+    membership = np.zeros((len(index.groups), len(index.annotators)))
+    membership[index.annotator_groups, np.arange(len(index.annotators))] = 1.
+    group_sums = np.einsum("ga,ask->gsk", membership, index.sums)
+    group_counts = membership @ index.counts
+    total_sums = group_sums.sum(axis=0)
+    total_counts = group_counts.sum(axis=0)
+
+    corrs = []
+    abs_errs = []
+    for start in range(0, len(splits), chunk_size):
+        weights = splits[start:start + chunk_size].astype(float)
+        sums_2 = np.einsum("ng,gsk->nsk", weights, group_sums)
+        counts_2 = weights @ group_counts
+        means_2 = sums_2 / counts_2[..., np.newaxis]
+        means_1 = (total_sums - sums_2) / (total_counts - counts_2)[..., np.newaxis]
+
+        # (splits, scores, systems)
+        means_1 = means_1.transpose(0, 2, 1)
+        means_2 = means_2.transpose(0, 2, 1)
+        corrs.append(pearson_rows(means_1, means_2))
+        abs_errs.append(np.abs(means_1 - means_2).mean(axis=-1))
+
+    return np.concatenate(corrs), np.concatenate(abs_errs)
+
+
+def compute_annotator_shr_raw(annotations, limit=1000, score_names=("coherence_score", "pronoun_score", "noun_phrase_score", "repetition_score"), rng=None):
+    if isinstance(annotations, AnnotationIndex):
+        index = annotations
+    else:
+        index = AnnotationIndex(annotations, score_names=list(score_names))
+
+    splits = draw_split_halves(len(index.groups), limit, rng)
+    pearson, abs_err = compute_split_half_scores(index, splits)
 
     corrs = defaultdict(lambda: defaultdict(list))
-
-    def combs_generator(all_annotator_groups, limit):
-        for _ in range(limit):
-            random.shuffle(all_annotator_groups)
-            yield all_annotator_groups[:len(all_annotator_groups) // 2]
-
-    combs = combs_generator(all_annotator_groups, limit)
-
-    for annotator_halfs in combs:
-        annotator_half = tuple(it.chain(*annotator_halfs))
-        select_mask = annotations.index.to_frame()["annotator"].isin(annotator_half)
-        for score_name in score_names:
-            p_corr, sq_err = compute_correlations_from_selection_mask(annotations, select_mask, score_name)
-            corrs["pearson"][score_name].append(p_corr)
-            corrs["sq_err"][score_name].append(sq_err)
+    for score_name in score_names:
+        score_idx = index.score_index(score_name)
+        corrs["pearson"][score_name] = pearson[:, score_idx]
+        corrs["sq_err"][score_name] = abs_err[:, score_idx]
 
     return corrs
 
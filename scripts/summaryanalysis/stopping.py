@@ -0,0 +1,78 @@
+from collections import Counter
+
+import numpy as np
+
+
+# Interval estimates for simulated power (the fraction of replicates with
+# p < alpha) used to stop simulating once the estimate is precise enough.
+# scipy is imported by the intervals themselves, as this module is also
+# loaded by the simulation workers.
+
+
+def wald_interval(successes, trials, confidence=0.95):
+    import scipy.stats
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+    p = successes / trials
+    std_err = np.sqrt(p * (1 - p) / trials)
+    return p - z * std_err, p + z * std_err
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    import scipy.stats
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+    p = successes / trials
+    center = (p + z ** 2 / (2 * trials)) / (1 + z ** 2 / trials)
+    half_width = z / (1 + z ** 2 / trials) * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2))
+    return center - half_width, center + half_width
+
+
+def clopper_pearson_interval(successes, trials, confidence=0.95):
+    import scipy.stats
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    alpha = 1 - confidence
+    low = np.where(successes > 0, scipy.stats.beta.ppf(alpha / 2, successes, trials - successes + 1), 0.)
+    high = np.where(successes < trials, scipy.stats.beta.ppf(1 - alpha / 2, successes + 1, trials - successes), 1.)
+    return low, high
+
+
+INTERVALS = {
+    "se": wald_interval,
+    "wilson": wilson_interval,
+    "clopper-pearson": clopper_pearson_interval
+}
+
+
+def interval_width(successes, trials, method="wilson", confidence=0.95):
+    low, high = INTERVALS[method](successes, trials, confidence)
+    return high - low
+
+
+class PowerTracker:
+    def __init__(self, alpha=0.05):
+        self.alpha = alpha
+        self.successes = Counter()
+        self.trials = Counter()
+        self.iterations = 0
+
+    def update(self, p_values):
+        # p_values maps system pairs to the p-values of one replicate, the
+        # direction of a pair does not matter for power
+        self.iterations += 1
+        for pair, p_value in p_values.items():
+            key = tuple(sorted(pair))
+            self.trials[key] += 1
+            self.successes[key] += p_value < self.alpha
+
+    def widths(self, method="wilson", confidence=0.95):
+        keys = sorted(self.trials)
+        return dict(zip(keys, interval_width([self.successes[k] for k in keys], [self.trials[k] for k in keys], method, confidence)))
+
+    def converged(self, target_width, method="wilson", confidence=0.95):
+        if len(self.trials) == 0:
+            return False
+        return max(self.widths(method, confidence).values()) <= target_width
@@ -0,0 +1,31 @@
+import argparse
+import sys
+
+import pandas as pd
+
+from . import clmm
+
+
+# Python stand-in for scripts/r/analyse-ordinal.r with the same command line
+# (a file name or "-" for stdin, the score column and the mode) and the same
+# output. Fits with the in-process clmm backend, so the async dispatcher can
+# be run and checked on machines without R.
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("score_name")
+    parser.add_argument("mode")
+
+    args = parser.parse_args()
+
+    data = pd.read_csv(sys.stdin if args.filename == "-" else args.filename)
+    try:
+        output = clmm.analyse(data, args.score_name, args.mode)
+    except Exception as e:
+        # Like R, failed fits print nothing
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    sys.stdout.write(output)
@@ -0,0 +1,45 @@
+import argparse
+import socket
+
+from . import clmm
+from .rpool import recv_frame, send_frame, decode_request, WorkerError
+
+
+# Python stand-in for scripts/r/ordinal-worker.r that speaks the same protocol
+# and fits with the in-process clmm backend. Used to run the worker pool on
+# machines without R.
+
+
+def serve(port):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        while True:
+            try:
+                header = recv_frame(sock)
+            except WorkerError:
+                break
+
+            command = header.split(b"\t", 1)[0]
+            if command == b"quit":
+                break
+
+            if command == b"ping":
+                send_frame(sock, b"ok\npong")
+                continue
+
+            payload = recv_frame(sock)
+            try:
+                group_df, score_name, mode = decode_request(header, payload)
+                response = "ok\n" + clmm.analyse(group_df, score_name, mode)
+            except Exception as e:
+                response = f"error\t{e}"
+
+            send_frame(sock, response.encode("utf8"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int)
+
+    args = parser.parse_args()
+
+    serve(args.port)
@@ -0,0 +1,326 @@
+import argparse
+import csv
+import itertools as it
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
+
+from . import broadcast
+from . import ordinal
+from . import power
+from . import telemetry
+from .cache import hash_key, model_key
+from .stopping import PowerTracker, INTERVALS
+
+
+# Runs test_design_power style simulations for a whole grid of designs. Work
+# is split into batches of replicates that are scheduled longest first on a
+# pool of workers. Every finished batch is appended to a single CSV file
+# (one row per replicate and system pair), so an interrupted sweep can be
+# resumed and only redoes the batches that had not been written yet.
+# With a target interval width, batches of a design are only scheduled until
+# its power estimates are precise enough.
+
+
+FIELDS = ["blocks", "docs", "annotators", "batch", "replicate", "better", "worse", "p_value"]
+
+
+def parse_designs(spec):
+    def parse_values(part):
+        values = []
+        for item in part.split(","):
+            if "-" in item:
+                start, end = map(int, item.split("-"))
+                values.extend(range(start, end + 1))
+            else:
+                values.append(int(item))
+        return values
+
+    blocks, docs, annotators = map(parse_values, spec.split(":"))
+    return list(it.product(blocks, docs, annotators))
+
+
+def fixed_budget_designs(budget, annotator_count, block_counts):
+    # Designs are (blocks, docs, annotators) with the same number of
+    # documents per block, so only block counts that divide the budget spend
+    # exactly budget documents (Design.fixed_budget spreads the rest unevenly)
+    invalid = [n_blocks for n_blocks in block_counts if n_blocks <= 0 or budget % n_blocks != 0]
+    if len(invalid) > 0:
+        raise ValueError(f"Block counts {', '.join(map(str, invalid))} do not divide the budget of {budget} documents")
+    return [(n_blocks, budget // n_blocks, annotator_count) for n_blocks in block_counts]
+
+
+def design_cost(design):
+    n_blocks, n_docs, n_annotators = design
+    cost = n_blocks * n_docs * n_annotators
+    if n_annotators > 1:
+        # Crossed designs are fit with an additional document effect
+        cost *= 2
+    return cost
+
+
+def replicate_seeds(seed, design, replicates):
+    return [np.random.SeedSequence(seed, spawn_key=tuple(design) + (replicate,)) for replicate in replicates]
+
+
+def run_batch(args):
+    model, design, batch, replicates, backend, seed = args
+    n_blocks, n_docs, n_annotators = design
+    sample_design = ordinal.create_design(n_blocks, n_docs, n_annotators)
+
+    rows = []
+    with telemetry.timer("sample"):
+        samples = model.sample_replicates(sample_design, replicate_seeds(seed, design, replicates))
+    for replicate, sample in zip(replicates, samples):
+        with telemetry.timer("frame"):
+            sample_df = model.to_frame(sample_design, sample)
+        _, p_values = power.run_regression(sample_df, nested=n_annotators == 1, backend=backend)
+
+        telemetry.count("replicates")
+        if len(p_values) == 0:
+            telemetry.count("empty_fits")
+            p_values = {pair: 1.0 for pair in it.combinations(model.systems, 2)}
+
+        for (left_system, right_system), p_val in p_values.items():
+            rows.append((n_blocks, n_docs, n_annotators, batch, replicate, left_system, right_system, p_val))
+
+    return design, batch, rows
+
+
+def run_instrumented_batch(args):
+    return telemetry.collect(run_batch, args)
+
+
+def run_shared_batch(args):
+    # The model was published to the pool once, tasks only carry the design,
+    # batch, replicates, backend and seed
+    model, _, _ = broadcast.get_worker_state()
+    return telemetry.collect(run_batch, (model,) + args)
+
+
+def update_tracker(tracker, rows):
+    # rows are (replicate, better, worse, p_value), one per system pair
+    replicate_p_values = {}
+    for replicate, better, worse, p_value in rows:
+        replicate_p_values.setdefault(int(replicate), {})[better, worse] = float(p_value)
+    for replicate in sorted(replicate_p_values):
+        tracker.update(replicate_p_values[replicate])
+
+
+def read_completed_batches(out_file, n_pairs, batch_sizes):
+    # Keeps the rows of fully written batches and drops everything written
+    # after the last complete batch, e.g. a half written line after a crash.
+    # Rows of designs that are not in batch_sizes, e.g. from an earlier
+    # sweep over another grid, are kept as they are.
+    if not os.path.exists(out_file):
+        return {}
+
+    with open(out_file, newline="") as f:
+        lines = f.readlines()
+    if len(lines) > 0 and not lines[-1].endswith("\n"):
+        lines = lines[:-1]
+
+    designs = {key[:3] for key in batch_sizes}
+    rows = list(csv.DictReader(lines))
+    batch_rows = {}
+    for row in rows:
+        key = (int(row["blocks"]), int(row["docs"]), int(row["annotators"]), int(row["batch"]))
+        batch_rows.setdefault(key, []).append(row)
+
+    completed = {key: rows for key, rows in batch_rows.items() if len(rows) == batch_sizes.get(key, -1) * n_pairs}
+
+    with open(out_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            key = (int(row["blocks"]), int(row["docs"]), int(row["annotators"]), int(row["batch"]))
+            if key[:3] not in designs or key in completed:
+                writer.writerow(row)
+
+    return completed
+
+
+def run_sweep(model, designs, out_file, num_iters=100, batch_size=10, backend="rscript", seed=None, workers=None, target_width=None, interval="wilson", store=None, model_name=None, telemetry_file=None):
+    # Finished batches are also appended to the power store, if given. With a
+    # telemetry_file, a JSON line with the timings of every design is
+    # appended to it once the design is done.
+    designs = list(dict.fromkeys(map(tuple, designs)))
+    if len(designs) == 0:
+        return {}
+    if store is not None:
+        from .powerstore import PowerStore
+    if store is not None and not isinstance(store, PowerStore):
+        store = PowerStore(store)
+
+    # Resuming must reuse the entropy of the interrupted run and the same
+    # model. Seeds are derived per design, so the grid may grow, the designs
+    # of all runs are recorded.
+    settings_file = Path(str(out_file) + ".json")
+    model_hash = hash_key(model_key(model))
+    if settings_file.exists():
+        settings = json.loads(settings_file.read_text())
+        if settings["num_iters"] != num_iters or settings["batch_size"] != batch_size:
+            raise ValueError(f"{out_file} was written with different num_iters or batch_size")
+        if settings.get("model", model_hash) != model_hash:
+            raise ValueError(f"{out_file} was written with a different model")
+        seed = settings["seed"]
+        previous_designs = [tuple(design) for design in settings.get("designs", [])]
+        settings["designs"] = list(dict.fromkeys(previous_designs + designs))
+    else:
+        seed = np.random.SeedSequence(seed).entropy
+        settings = {"seed": seed, "num_iters": num_iters, "batch_size": batch_size, "designs": designs}
+    settings["model"] = model_hash
+    settings_file.write_text(json.dumps(settings))
+
+    batches = []
+    for design in designs:
+        for batch, start in enumerate(range(0, num_iters, batch_size)):
+            batches.append((design, batch, list(range(start, min(start + batch_size, num_iters)))))
+
+    n_pairs = len(model.systems) * (len(model.systems) - 1) // 2
+    completed = read_completed_batches(out_file, n_pairs, {design + (batch,): len(replicates) for design, batch, replicates in batches})
+
+    trackers = {design: PowerTracker() for design in designs}
+    for key in sorted(completed):
+        update_tracker(trackers[key[:3]], [(row["replicate"], row["better"], row["worse"], row["p_value"]) for row in completed[key]])
+
+    pending = {design: [] for design in designs}
+    for design, batch, replicates in batches:
+        if design + (batch,) not in completed:
+            pending[design].append((batch, replicates))
+
+    # Telemetry is only enabled for this sweep
+    shared = None
+    was_enabled = telemetry.enabled()
+    try:
+        design_telemetry = {}
+        if telemetry_file is not None:
+            telemetry.enable()
+            telemetry.drain()
+            design_telemetry = {design: telemetry.DesignTelemetry(model=model_name, design=list(design), backend=backend, workers=workers or os.cpu_count(), num_iters=num_iters) for design in designs if len(pending[design]) > 0}
+
+        if backend in power.PROCESS_BACKENDS:
+            shared = broadcast.publish_model(model, ordinal.create_design(*designs[0]))
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=broadcast.initialize_model_worker, initargs=(shared.descriptor,))
+            run_task = lambda design, batch, replicates: executor.submit(run_shared_batch, (design, batch, replicates, backend, seed))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+            run_task = lambda design, batch, replicates: executor.submit(run_instrumented_batch, (model, design, batch, replicates, backend, seed))
+
+        # Without a target width everything is submitted at once. Otherwise each
+        # design only has a few batches in flight, and the next one is submitted
+        # when a batch finishes and the design has not converged yet.
+        if target_width is None:
+            in_flight = num_iters
+        else:
+            in_flight = max(1, (workers or os.cpu_count()) // len(designs))
+
+        futures = set()
+        running = {design: 0 for design in designs}
+
+        def submit(design):
+            if target_width is not None and trackers[design].converged(target_width, interval):
+                pending[design].clear()
+            if len(pending[design]) > 0:
+                batch, replicates = pending[design].pop(0)
+                if design in design_telemetry:
+                    design_telemetry[design].begin()
+                futures.add(run_task(design, batch, replicates))
+                running[design] += 1
+            elif running[design] == 0 and design in design_telemetry:
+                telemetry.write_summary(telemetry_file, design_telemetry.pop(design).summary())
+
+        new_file = not os.path.exists(out_file)
+        with executor, open(out_file, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(FIELDS)
+
+            # Longest designs first keeps workers busy until the end of the sweep
+            for design in sorted(designs, key=lambda d: -design_cost(d)):
+                for _ in range(in_flight):
+                    submit(design)
+
+            while len(futures) > 0:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (design, batch, rows), measurements = future.result()
+                    running[design] -= 1
+                    writer.writerows(rows)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    # Only after the checkpoint, a batch that is run again on
+                    # resume replaces its partition
+                    if store is not None:
+                        replicates, better, worse, p_values = zip(*[row[4:] for row in rows])
+                        store.append(model_name, design, better, worse, p_values, replicates, source=f"{Path(out_file).resolve()}#{batch}")
+
+                    with telemetry.timer("aggregate"):
+                        update_tracker(trackers[design], [row[4:] for row in rows])
+                    if design in design_telemetry:
+                        design_telemetry[design].merge(measurements)
+                        design_telemetry[design].merge(telemetry.drain())
+                    print(f"{design} batch {batch}, {trackers[design].iterations}/{num_iters} iterations")
+                    submit(design)
+    finally:
+        if shared is not None:
+            shared.close()
+        if not was_enabled:
+            telemetry.disable()
+
+    return {design: tracker.iterations for design, tracker in trackers.items()}
+
+
+if __name__ == "__main__":
+    from . import fasttests
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_file")
+    parser.add_argument("out_file")
+
+    parser.add_argument("-g", dest="grids", action="append", default=[], help="blocks:docs:annotators, each a comma separated list of values or ranges, e.g. 1-20:5:3")
+    parser.add_argument("--budget", dest="budget", default=None, type=int, help="fixed number of documents spread over the blocks given by --budget-blocks")
+    parser.add_argument("--budget-blocks", dest="budget_blocks", default="1,2,5,10,20", type=lambda x: list(map(int, x.split(","))))
+    parser.add_argument("--budget-annotators", dest="budget_annotators", default=3, type=int)
+    parser.add_argument("-i", dest="num_iters", default=100, type=int)
+    parser.add_argument("--batch-size", dest="batch_size", default=10, type=int)
+    parser.add_argument("-j", dest="workers", default=None, type=int)
+    parser.add_argument("-z", dest="zero_coefficients", default=False, action="store_true")
+    parser.add_argument("--backend", dest="backend", choices=sorted(power.BACKENDS), default="rscript")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int)
+    parser.add_argument("-w", "--target-width", dest="target_width", default=None, type=float, help="stop simulating a design once every power interval is at most this wide")
+    parser.add_argument("--interval", dest="interval", choices=sorted(INTERVALS), default="wilson")
+    parser.add_argument("--store", dest="store", default=None, help="also append finished batches to this power store")
+    parser.add_argument("--screen", dest="screen_test", default=None, choices=sorted(fasttests.TESTS), help="only sweep designs whose power under this fast test is at least --screen-power")
+    parser.add_argument("--screen-power", dest="screen_power", default=0.8, type=float)
+    parser.add_argument("--screen-iters", dest="screen_iters", default=200, type=int)
+    parser.add_argument("--telemetry", dest="telemetry_file", default=None, help="append timings and counters of every design to this JSON lines file")
+
+    args = parser.parse_args()
+
+    model = ordinal.OrdinalModel.from_file(args.model_file)
+    if args.zero_coefficients:
+        model.zero_coefficients()
+
+    designs = [d for grid in args.grids for d in parse_designs(grid)]
+    if args.budget is not None:
+        try:
+            designs.extend(fixed_budget_designs(args.budget, args.budget_annotators, args.budget_blocks))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.screen_test is not None:
+        designs, screen_powers = fasttests.screen_designs(model, designs, test=args.screen_test, num_iters=args.screen_iters, min_power=args.screen_power, seed=args.seed)
+        for design, screen_power in screen_powers.items():
+            print(f"{design}: {args.screen_test} power {screen_power:.3f}" + ("" if design in designs else ", skipped"))
+        if len(designs) == 0:
+            print(f"No design reaches a {args.screen_test} power of {args.screen_power}")
+            sys.exit()
+
+    iterations = run_sweep(model, designs, args.out_file, num_iters=args.num_iters, batch_size=args.batch_size, backend=args.backend, seed=args.seed, workers=args.workers, target_width=args.target_width, interval=args.interval, store=args.store, model_name=Path(args.model_file).stem, telemetry_file=args.telemetry_file)
+    for design, n_iterations in iterations.items():
+        print(f"{design}: {n_iterations} iterations")
@@ -0,0 +1,166 @@
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+
+# Opt-in timers and counters for the simulation hot paths. Nothing is recorded
+# until enable() is called, timer() and count() only check a flag otherwise.
+# Every thread records into its own recorder, so a task can hand exactly its
+# own measurements back to the caller with collect() (also from worker
+# processes) and the caller merges them into the recorder of its design.
+#
+# Timer names used by the simulations:
+#   sample                  drawing scores from the model
+#   frame                   building the sample data frame
+#   regression              one regression, including all phases below
+#   regression.serialize    writing the sample as CSV for R
+#   regression.launch       starting the analyzer process
+#   regression.fit          running the analyzer until its output is read
+#   regression.parse        parsing the contrast lines
+#   aggregate               collecting p-values and updating the power tracker
+
+
+_enabled = False
+_local = threading.local()
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def add_time(self, name, seconds):
+        self.timings[name].append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def drain(self):
+        measurements = {"timings": dict(self.timings), "counters": dict(self.counters)}
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        return measurements
+
+    def merge(self, measurements):
+        if measurements is None:
+            return
+        for name, times in measurements["timings"].items():
+            self.timings[name].extend(times)
+        for name, n in measurements["counters"].items():
+            self.counters[name] += n
+
+    def summary(self):
+        timers = {}
+        for name, times in sorted(self.timings.items()):
+            times = np.asarray(times)
+            timers[name] = {
+                "count": len(times),
+                "total": float(times.sum()),
+                "mean": float(times.mean()),
+                "p50": float(np.percentile(times, 50)),
+                "p95": float(np.percentile(times, 95))
+            }
+        return {"timers": timers, "counters": dict(sorted(self.counters.items()))}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def initialize_worker(enable_telemetry):
+    # Process pool initializer, workers started with spawn do not inherit
+    # the flag
+    if enable_telemetry:
+        enable()
+
+
+def get_recorder():
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        recorder = _local.recorder = Recorder()
+    return recorder
+
+
+@contextlib.contextmanager
+def timer(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_recorder().add_time(name, time.perf_counter() - start)
+
+
+def add_time(name, seconds):
+    if _enabled:
+        get_recorder().add_time(name, seconds)
+
+
+def count(name, n=1):
+    if _enabled:
+        get_recorder().count(name, n)
+
+
+def drain():
+    # Measurements of the current thread since the last drain, None when
+    # telemetry is disabled
+    if not _enabled:
+        return None
+    return get_recorder().drain()
+
+
+def collect(function, *args):
+    # Runs a task and returns its result together with its measurements
+    drain()
+    result = function(*args)
+    return result, drain()
+
+
+class DesignTelemetry:
+    # Measurements and wall time of the simulation of one design
+    def __init__(self, **fields):
+        self.fields = fields
+        self.recorder = Recorder()
+        self.start = None
+
+    def begin(self):
+        # Wall time is counted from the first call
+        if self.start is None:
+            self.start = time.perf_counter()
+
+    def merge(self, measurements):
+        self.recorder.merge(measurements)
+
+    def summary(self):
+        wall_time = time.perf_counter() - self.start if self.start is not None else 0.
+        replicates = self.recorder.counters.get("replicates", 0)
+        record = dict(self.fields)
+        record["replicates"] = replicates
+        record["wall_time"] = wall_time
+        record["throughput"] = replicates / wall_time if wall_time > 0 else None
+        # Empty fits are counted as p = 1.0 for every pair
+        record["empty_fits"] = self.recorder.counters.get("empty_fits", 0)
+        record["failed_fits"] = self.recorder.counters.get("regression.failed", 0)
+        record.update(self.recorder.summary())
+        return record
+
+
+def write_summary(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
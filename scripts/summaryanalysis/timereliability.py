@@ -1,68 +1,127 @@
-import random
 import itertools as it
+import math
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.auto import tqdm
-import scipy.stats
-from summaryanalysis.annotationutils import get_annotator_groups
 import numpy as np
+from summaryanalysis.annotationutils import AnnotationIndex
+from summaryanalysis.seeding import get_rng, spawn_seeds
+from summaryanalysis.shr import pearson_rows
+
+
+def sample_subsets(n_items, size, n_samples, rng=None):
+    # Floyd's algorithm for n_samples subsets at once, returns a boolean
+    # (n_samples, n_items) mask with size items set per row
+    rng = get_rng(rng)
+    rows = np.arange(n_samples)
+    chosen = np.zeros((n_samples, n_items), dtype=bool)
+    for j in range(n_items - size, n_items):
+        t = rng.integers(0, j + 1, size=n_samples) if isinstance(rng, np.random.Generator) else rng.randint(0, j + 1, size=n_samples)
+        chosen[rows, np.where(chosen[rows, t], j, t)] = True
+    return chosen
+
+
+def sample_distinct_subsets(n_items, size, n_samples, rng=None):
+    # Up to n_samples different subsets, all of them if there are fewer
+    if math.comb(n_items, size) <= n_samples:
+        chosen = np.zeros((math.comb(n_items, size), n_items), dtype=bool)
+        for row, comb in enumerate(it.combinations(range(n_items), size)):
+            chosen[row, list(comb)] = True
+        return chosen
+
+    rng = get_rng(rng)
+    chosen = np.zeros((0, n_items), dtype=bool)
+    while len(chosen) < n_samples:
+        candidates = np.concatenate([chosen, sample_subsets(n_items, size, n_samples - len(chosen), rng)])
+        _, first = np.unique(candidates, axis=0, return_index=True)
+        chosen = candidates[np.sort(first)]
+    return chosen
+
+
+def group_membership(index):
+    membership = np.zeros((len(index.groups), len(index.annotators)))
+    membership[index.annotator_groups, np.arange(len(index.annotators))] = 1.
+    return membership
+
+
+def nested_annotator_weights(index, chosen_groups, rng):
+    # One random annotator out of every chosen group
+    sizes = np.array([len(g) for g in index.groups])
+    padded = np.zeros((len(index.groups), sizes.max()), dtype=np.int64)
+    for group_idx, group in enumerate(index.groups):
+        padded[group_idx, :len(group)] = group
+
+    picks = (rng.random(chosen_groups.shape) * sizes).astype(np.int64)
+    samples, groups = np.nonzero(chosen_groups)
+    weights = np.zeros((len(chosen_groups), len(index.annotators)))
+    weights[samples, padded[groups, picks[samples, groups]]] = 1.
+    return weights
+
+
+def _subsample_quality(args):
+    index, sample_size, crossed, score_name, limit, seed = args
+    rng = get_rng(seed)
+    original_scores = index.system_means(np.arange(len(index.annotators)), score_name)
+
+    chosen_groups = sample_subsets(len(index.groups), sample_size, limit, rng)
+    if crossed:
+        weights = chosen_groups @ group_membership(index)
+    else:
+        weights = nested_annotator_weights(index, chosen_groups, rng)
+
+    sample_scores = index.batch_system_means(weights, score_name)
+    return pearson_rows(sample_scores, original_scores).mean()
+
+
+def _map(function, tasks, workers):
+    # workers=None runs in this process, otherwise on a process pool
+    if workers is None:
+        yield from map(function, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(function, tasks)
+
+
+def compute_grouped_subsample_variance(annotations, crossed=False, score_name="coherence_score", limit=10000, rng=None, workers=None):
+    index = annotations if isinstance(annotations, AnnotationIndex) else AnnotationIndex(annotations, [score_name])
+    sample_sizes = range(1, len(index.groups) + 1)
+    seeds = spawn_seeds(get_rng(rng), len(sample_sizes))
+
+    tasks = [(index, sample_size, crossed, score_name, limit, seed) for sample_size, seed in zip(sample_sizes, seeds)]
+    qualities = list(tqdm(_map(_subsample_quality, tasks, workers), total=len(tasks), leave=False))
 
-
-def compute_grouped_subsample_variance(annotations, crossed=False, score_name="coherence_score", limit=10000):
-    groups = get_annotator_groups(annotations)
-
-    annotations = annotations.sort_index()
-    original_scores = annotations.groupby("system").mean().sort_index()[score_name].to_numpy()
-    qualities = []
     annotation_costs = []
-
-    for sample_size in tqdm(range(len(groups)), leave=False):
-        sample_qualities = []
-
-        for idx in range(limit):
-            sampled_groups = random.sample(groups, sample_size + 1)
-            if crossed:
-                sampled_annotators = list(it.chain(*sampled_groups))
-            else:
-                sampled_annotators = [random.choice(g) for g in sampled_groups]
-
-            sampled_annotations = annotations.loc[sampled_annotators]
-
-            annotation_vec = sampled_annotations.groupby("system").mean().sort_index()[score_name].to_numpy()
-            correlation, _ = scipy.stats.pearsonr(
-                    annotation_vec,
-                    original_scores)
-            sample_qualities.append(correlation)
-
-        annotation_cost = (sample_size + 1)
+    for sample_size in sample_sizes:
+        annotation_cost = sample_size
         if crossed:
             annotation_cost *= 3
         annotation_costs.append(annotation_cost)
-        qualities.append(np.array(sample_qualities).mean())
 
     return annotation_costs, qualities
 
 
-def compute_time_reliability_curve(annotations, times, score_key="coherence_score"):
-    groups = get_annotator_groups(annotations)
+def _time_reliability(args):
+    index, annotator_times, sample_size, score_key, limit, seed = args
+    rng = get_rng(seed)
+    original_scores = index.system_means(np.arange(len(index.annotators)), score_key)
 
-    annotator_times = times.groupby("annotator").sum()
+    weights = sample_distinct_subsets(len(index.groups), sample_size, limit, rng) @ group_membership(index)
+    sample_scores = index.batch_system_means(weights, score_key)
 
-    original_scores = annotations.groupby("system").mean().sort_index()[score_key].to_numpy()
+    return pearson_rows(sample_scores, original_scores), weights @ annotator_times
 
-    all_scores = []
-    all_times = []
-    for sample_size in range(2, len(groups) - 1):
-        combs = it.combinations(groups, sample_size)
-        combs = list(combs)
-        random.shuffle(combs)
-        combs = combs[:500]
 
-        for comb in tqdm(combs, leave=False):
-            key = [a for b in comb for a in b]
+def compute_time_reliability_curve(annotations, times, score_key="coherence_score", rng=None, limit=500, workers=None):
+    index = annotations if isinstance(annotations, AnnotationIndex) else AnnotationIndex(annotations, [score_key])
+    annotator_times = times.groupby("annotator").sum().reindex(index.annotators, fill_value=0).to_numpy(dtype=float)
 
-            sample_scores = annotations.loc[key].groupby("system").mean().sort_index()[score_key].to_numpy()
-            corr = scipy.stats.pearsonr(original_scores, sample_scores)[0]
+    sample_sizes = range(2, len(index.groups) - 1)
+    seeds = spawn_seeds(get_rng(rng), len(sample_sizes))
 
-            all_scores.append(corr)
-            all_times.append(annotator_times.loc[key].sum())
+    all_scores = []
+    all_times = []
+    tasks = [(index, annotator_times, sample_size, score_key, limit, seed) for sample_size, seed in zip(sample_sizes, seeds)]
+    for scores, sample_times in tqdm(_map(_time_reliability, tasks, workers), total=len(tasks), leave=False):
+        all_scores.extend(scores)
+        all_times.extend(sample_times)
 
     return all_scores, all_times